@@ -2,7 +2,7 @@ from Commands import command_executor
 from DeployBrowsers import deploy_browser
 from Commands import profile_commands
 from Proxy import deploy_mitm_proxy
-from SocketInterface import clientsocket
+from SocketInterface import clientsocket, BATCH_SIZE, DRAIN_SIGNAL
 from MPLogger import loggingclient
 from Errors import ProfileLoadError, BrowserConfigError, BrowserCrashError
 
@@ -20,6 +20,8 @@ import time
 import sys
 import os
 
+DRAIN_TIMEOUT = 30  # seconds to wait for the records of a visit to be committed
+
 class Browser:
     """
      The Browser class is responsbile for holding all of the
@@ -45,7 +47,9 @@ class Browser:
         self.manager_params = manager_params
 
         # Queues and process IDs for BrowserManager
-        self.command_thread = None  # thread to run commands issues from TaskManager
+        self.command_thread = None  # long-lived thread to run commands issued from TaskManager
+        self.work_queue = None  # CommandSequences waiting for the command thread
+        self.num_pending = 0  # CommandSequences queued or running
         self.command_queue = None  # queue for passing command tuples to BrowserManager
         self.status_queue = None  # queue for receiving command execution status from BrowserManager
         self.browser_pid = None  # pid for browser instance controlled by BrowserManager
@@ -62,7 +66,7 @@ class Browser:
 
     def ready(self):
         """ return if the browser is ready to accept a command """
-        return self.command_thread is None or not self.command_thread.is_alive()
+        return self.num_pending == 0
 
     def set_visit_id(self, visit_id):
         self.curr_visit_id = visit_id
@@ -272,6 +276,13 @@ def BrowserManager(command_queue, status_queue, browser_params, manager_params,
         else:
             extension_socket = None
 
+        # one connection to the DataAggregator, shared by all commands
+        db_socket = clientsocket(serialization='marshal', batch_size=BATCH_SIZE,
+                                 reconnect=True)
+        db_socket.connect(*manager_params['aggregator_address'])
+        drain_socket = clientsocket()
+        drain_socket.connect(*manager_params['aggregator_drain_address'])
+
         # passes the profile folder, WebDriver pid and display pid back to the TaskManager
         # now, the TaskManager knows that the browser is successfully set up
         status_queue.put(('STATUS','Browser Ready','READY'))
@@ -279,14 +290,17 @@ def BrowserManager(command_queue, status_queue, browser_params, manager_params,
 
         # starts accepting arguments until told to die
         while True:
-            # no command for now -> sleep to avoid pegging CPU on blocking get
-            if command_queue.empty():
-                time.sleep(0.001)
-                continue
-
+            # blocks until the next command tuple arrives
             # reads in the command tuple of form (command, arg0, arg1, arg2, ..., argN) where N is variable
             command = command_queue.get()
             logger.info("BROWSER %i: EXECUTING COMMAND: %s" % (browser_params['crawl_id'], str(command)))
+            if command[0] == 'DRAIN':
+                if drain_visit(command[1], proxy_site_queue, extension_socket,
+                               db_socket, drain_socket, browser_params, logger):
+                    status_queue.put("OK")
+                else:
+                    status_queue.put(('FAILED', None))
+                continue
             # attempts to perform an action and return an OK signal
             # if command fails for whatever reason, tell the TaskMaster to kill and restart its worker processes
             command_executor.execute_command(command,
@@ -295,7 +309,9 @@ def BrowserManager(command_queue, status_queue, browser_params, manager_params,
                                              browser_settings,
                                              browser_params,
                                              manager_params,
-                                             extension_socket)
+                                             extension_socket,
+                                             db_socket)
+            db_socket.flush()  # the command's data is sent before it completes
             status_queue.put("OK")
 
     except (ProfileLoadError, BrowserConfigError, AssertionError) as e:
@@ -309,3 +325,36 @@ def BrowserManager(command_queue, status_queue, browser_params, manager_params,
         logger.info("BROWSER %i: Crash in driver, restarting browser manager \n %s" % (browser_params['crawl_id'], ''.join(excp)))
         status_queue.put(('FAILED',None))
         return
+
+
+def drain_visit(visit_id, proxy_queue, extension_socket, db_socket,
+                drain_socket, browser_params, logger):
+    """
+    Waits until the DataAggregator has committed the records of <visit_id>
+    sent by the BrowserManager, the proxy and the extension. Each of them
+    sends a drain marker through its connection to the DataAggregator after
+    its records, and the DataAggregator acknowledges a marker once the
+    records before it are committed.
+    Returns True if all markers were acknowledged within DRAIN_TIMEOUT
+    """
+    token = '%i-%i' % (browser_params['crawl_id'], visit_id)
+    drain_tokens = [token + '-manager']
+    db_socket.send((DRAIN_SIGNAL, token + '-manager'))
+    db_socket.flush()
+    if proxy_queue is not None:
+        proxy_queue.put((DRAIN_SIGNAL, token + '-proxy'))
+        drain_tokens.append(token + '-proxy')
+    if extension_socket is not None:
+        extension_socket.send([DRAIN_SIGNAL, token + '-extension'])
+        drain_tokens.append(token + '-extension')
+
+    # the markers are acknowledged concurrently, so the waits share a deadline
+    deadline = time.time() + DRAIN_TIMEOUT
+    drained = True
+    for drain_token in drain_tokens:
+        timeout = max(deadline - time.time(), 0)
+        if drain_socket.request([drain_token, timeout]) != '1':
+            logger.debug("BROWSER %i: No drain acknowledgement for %s" % (
+                browser_params['crawl_id'], drain_token))
+            drained = False
+    return drained
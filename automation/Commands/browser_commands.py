@@ -8,7 +8,6 @@ import os
 import random
 import time
 
-from ..SocketInterface import clientsocket
 from ..MPLogger import loggingclient
 from utils.lso import get_flash_cookies
 from utils.firefox_profile import get_cookies  # todo: add back get_localStorage,
@@ -117,19 +116,17 @@ def get_website(url, sleep, visit_id, webdriver, proxy_queue, browser_params, ex
     if browser_params['bot_mitigation']:
         bot_mitigation(webdriver)
 
-def extract_links(webdriver, browser_params, manager_params):
+def extract_links(webdriver, browser_params, db_socket):
     link_elements = webdriver.find_elements_by_tag_name('a')
     link_urls = set(element.get_attribute("href") for element in link_elements)
 
-    sock = clientsocket()
-    sock.connect(*manager_params['aggregator_address'])
     create_table_query = ("""
     CREATE TABLE IF NOT EXISTS links_found (
       found_on TEXT,
       location TEXT
     )
     """, ())
-    sock.send(create_table_query)
+    db_socket.send(create_table_query)
 
     if len(link_urls) > 0:
         current_url = webdriver.current_url
@@ -138,9 +135,7 @@ def extract_links(webdriver, browser_params, manager_params):
         VALUES (?, ?)
         """
         for link in link_urls:
-            sock.send((insert_query_string, (current_url, link)))
-
-    sock.close()
+            db_socket.send((insert_query_string, (current_url, link)))
 
 def browse_website(url, num_links, sleep, visit_id, webdriver, proxy_queue,
                    browser_params, manager_params, extension_socket):
@@ -175,17 +170,14 @@ def browse_website(url, num_links, sleep, visit_id, webdriver, proxy_queue,
         except Exception:
             pass
 
-def dump_flash_cookies(start_time, visit_id, webdriver, browser_params, manager_params):
+def dump_flash_cookies(start_time, visit_id, webdriver, browser_params, db_socket):
     """ Save newly changed Flash LSOs to database
 
     We determine which LSOs to save by the `start_time` timestamp.
     This timestamp should be taken prior to calling the `get` for
     which creates these changes.
     """
-    # Set up a connection to DataAggregator
     tab_restart_browser(webdriver)  # kills traffic so we can cleanly record data
-    sock = clientsocket()
-    sock.connect(*manager_params['aggregator_address'])
 
     # Flash cookies
     flash_cookies = get_flash_cookies(start_time)
@@ -194,12 +186,9 @@ def dump_flash_cookies(start_time, visit_id, webdriver, browser_params, manager_
                   key, content) VALUES (?,?,?,?,?,?,?)", (browser_params['crawl_id'], visit_id, cookie.domain,
                                                           cookie.filename, cookie.local_path,
                                                           cookie.key, cookie.content))
-        sock.send(query)
-
-    # Close connection to db
-    sock.close()
+        db_socket.send(query)
 
-def dump_profile_cookies(start_time, visit_id, webdriver, browser_params, manager_params):
+def dump_profile_cookies(start_time, visit_id, webdriver, browser_params, db_socket):
     """ Save changes to Firefox's cookies.sqlite to database
 
     We determine which cookies to save by the `start_time` timestamp.
@@ -210,10 +199,7 @@ def dump_profile_cookies(start_time, visit_id, webdriver, browser_params, manage
     as this is likely to miss changes still present in the sqlite `wal` files.
     This will likely be removed in a future version.
     """
-    # Set up a connection to DataAggregator
     tab_restart_browser(webdriver)  # kills traffic so we can cleanly record data
-    sock = clientsocket()
-    sock.connect(*manager_params['aggregator_address'])
 
     # Cookies
     rows = get_cookies(browser_params['profile_path'], start_time)
@@ -222,10 +208,7 @@ def dump_profile_cookies(start_time, visit_id, webdriver, browser_params, manage
             query = ("INSERT INTO profile_cookies (crawl_id, visit_id, baseDomain, name, value, \
                       host, path, expiry, accessed, creationTime, isSecure, isHttpOnly) \
                       VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", (browser_params['crawl_id'], visit_id) + row)
-            sock.send(query)
-
-    # Close connection to db
-    sock.close()
+            db_socket.send(query)
 
 def save_screenshot(screenshot_name, webdriver, browser_params, manager_params):
     webdriver.save_screenshot(os.path.join(manager_params['screenshot_path'], screenshot_name + '.png'))
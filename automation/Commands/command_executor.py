@@ -3,10 +3,11 @@ import profile_commands
 import measurement_commands
 
 
-def execute_command(command, webdriver, proxy_queue, browser_settings, browser_params, manager_params, extension_socket):
+def execute_command(command, webdriver, proxy_queue, browser_settings, browser_params, manager_params, extension_socket, db_socket):
     """
     executes BrowserManager commands by passing command tuples into necessary helper function
     commands are of form (COMMAND, ARG0, ARG1, ...)
+    <db_socket> is the BrowserManager's connection to the DataAggregator
     the only imports in this file should be imports to helper libraries
     """
     if command[0] == 'GET':
@@ -23,12 +24,12 @@ def execute_command(command, webdriver, proxy_queue, browser_settings, browser_p
     if command[0] == 'DUMP_FLASH_COOKIES':
         browser_commands.dump_flash_cookies(start_time=command[1], visit_id=command[2],
                                             webdriver=webdriver, browser_params=browser_params,
-                                            manager_params=manager_params)
+                                            db_socket=db_socket)
 
     if command[0] == 'DUMP_PROFILE_COOKIES':
         browser_commands.dump_profile_cookies(start_time=command[1], visit_id=command[2],
                                               webdriver=webdriver, browser_params=browser_params,
-                                              manager_params=manager_params)
+                                              db_socket=db_socket)
 
     if command[0] == 'DUMP_PROF':
         profile_commands.dump_profile(browser_profile_folder=browser_params['profile_path'],
@@ -40,7 +41,7 @@ def execute_command(command, webdriver, proxy_queue, browser_settings, browser_p
                                       save_flash=browser_params['disable_flash'] is False)
 
     if command[0] == 'EXTRACT_LINKS':
-        browser_commands.extract_links(webdriver, browser_params, manager_params)
+        browser_commands.extract_links(webdriver, browser_params, db_socket)
 
     if command[0] == 'SAVE_SCREENSHOT':
         browser_commands.save_screenshot(screenshot_name=command[1], webdriver=webdriver,
@@ -57,7 +58,8 @@ def execute_command(command, webdriver, proxy_queue, browser_settings, browser_p
                     "browser_settings": browser_settings,
                     "browser_params": browser_params,
                     "manager_params": manager_params,
-                    "extension_socket": extension_socket}
+                    "extension_socket": extension_socket,
+                    "db_socket": db_socket}
         command[1](*command[2], **arg_dict)
 
     #--------------------------------------------------------------------------
@@ -1,106 +1,391 @@
-from ..SocketInterface import serversocket
-from ..MPLogger import loggingclient
+from ..SocketInterface import serversocket, get_unix_socket_path, is_shutdown_signal, DRAIN_SIGNAL
+from ..MPLogger import loggingclient, get_cpu_usage
+from ..utilities.db_utils import apply_sqlite_profile
 from sqlite3 import OperationalError
 from sqlite3 import ProgrammingError
+from sqlite3 import InterfaceError
+from collections import OrderedDict
+from Queue import Empty as EmptyQueue
+import threading
 import sqlite3
 import time
+import re
 import os
 
+STATS_INTERVAL = 60  # seconds between two throughput log messages
+DRAIN_TIMEOUT = 3  # seconds without new queries before the queue counts as drained
+MAX_EXPIRED_TOKENS = 1000  # timed out drain tokens remembered in case their ack arrives late
+INSERT_RE = re.compile(r'^\s*INSERT\s+INTO\s+(\w+)\s*\(([^)]*)\)', re.IGNORECASE)
+NUMERIC_TYPE_RE = re.compile(r'INT|REAL|FLOA|DOUB|BOOL|NUMERIC|DECIMAL')
+NUMBER_TYPES = frozenset([int, long, float, bool, type(None)])
 
-def DataAggregator(manager_params, status_queue, commit_batch_size=1000):
+
+def DataAggregator(manager_params, status_queue, commit_batch_size=1000,
+                   commit_interval=5):
     """
      Receives SQL queries from other processes and writes them to the central database
      Executes queries until being told to die (then it will finish work and shut down)
      This process should never be terminated un-gracefully
      Currently uses SQLite but may move to different platform
 
+     Rows are grouped by statement and written with `executemany` in a single
+     transaction once <commit_batch_size> rows are pending or <commit_interval>
+     seconds have passed since the last write, whichever comes first.
+     Drain markers (see `DrainAcks`) are acknowledged as soon as the queue has
+     no more records to take into the same transaction.
+
      <manager_params> TaskManager configuration parameters
      <status_queue> is a queue connect to the TaskManager used for communication
-     <commit_batch_size> is the number of execution statements that should be made before a commit (used for speedup)
+     <commit_batch_size> is the number of pending rows that triggers a batch write
+     <commit_interval> is the maximum number of seconds rows are held before being written
     """
 
     # sets up DB connection
     db_path = manager_params['database_name']
     db = sqlite3.connect(db_path, check_same_thread=False)
+    apply_sqlite_profile(db, manager_params['sqlite_profile'])
+    db.isolation_level = None  # transactions are opened by flush_pending
     curr = db.cursor()
 
     # sets up logging connection
     logger = loggingclient(*manager_params['logger_address'])
 
     # sets up the serversocket to start accepting connections
-    sock = serversocket()
-    status_queue.put(sock.sock.getsockname())  # let TM know location
+    unix_path = None
+    if manager_params['unix_sockets']:
+        unix_path = get_unix_socket_path(manager_params['data_directory'],
+                                         'aggregator')
+    sock = serversocket(max_queue_size=manager_params['aggregator_queue_size'],
+                        unix_path=unix_path,
+                        event_loop=manager_params['aggregator_event_loop'])
+    status_queue.put(sock.get_addresses())  # let TM know location
     sock.start_accepting()
 
-    counter = 0  # number of executions made since last commit
-    commit_time = 0  # keep track of time since last commit
+    # answers whether the records sent before a drain marker are committed
+    drain_acks = DrainAcks()
+    drain_unix_path = None
+    if manager_params['unix_sockets']:
+        drain_unix_path = get_unix_socket_path(manager_params['data_directory'],
+                                               'aggregator_drain')
+    drain_sock = serversocket(unix_path=drain_unix_path,
+                              handler=drain_acks.handle_query)
+    status_queue.put(drain_sock.get_addresses())  # let TM know location
+    drain_sock.start_accepting()
+
+    pending = OrderedDict()  # (statement, num_args) -> list of argument lists
+    encoders = dict()  # (statement, num_args) -> compiled argument encoder
+    counter = 0  # number of rows pending since last write
+    commit_time = time.time()  # keep track of time since last write
+    drain_tokens = list()  # drain markers to acknowledge after the next write
+    throughput = ThroughputCounter(sock)
     while True:
+        # block until a query arrives or the pending rows are due to be written
+        if counter > 0:
+            timeout = max(commit_interval - (time.time() - commit_time), 0)
+        else:
+            timeout = None
+        try:
+            query = sock.queue.get(True, timeout)
+        except EmptyQueue:
+            # write every <commit_interval> seconds to avoid holding rows for too long
+            flush_pending(pending, db, curr, logger)
+            drain_acks.ack(drain_tokens)
+            throughput.add(counter)
+            counter = 0
+            commit_time = time.time()
+            throughput.log(logger)
+            continue
+
         # received KILL command from TaskManager
-        if not status_queue.empty():
-            status_queue.get()
+        if is_shutdown_signal(query):
             sock.close()
-            drain_queue(sock.queue, curr, logger)
+            drain_sock.close()
+            counter = drain_queue(sock.queue, pending, encoders, counter, curr, logger)
             break
 
-        # no command for now -> sleep to avoid pegging CPU on blocking get
-        if sock.queue.empty():
-            time.sleep(0.001)
-
-            # commit every five seconds to avoid blocking the db for too long
-            if counter > 0 and time.time() - commit_time > 5:
-                db.commit()
-            continue
-
-        # process query
-        query = sock.queue.get()
-        process_query(query, curr, logger)
+        # add query to the pending batch
+        if is_drain_marker(query):
+            drain_tokens.append(query[1])
+        else:
+            counter += process_query(query, pending, encoders, curr, logger)
 
-        # batch commit if necessary
-        counter += 1
-        if counter >= commit_batch_size:
+        # batch write if necessary, or to acknowledge drain markers once the
+        # records queued along with them are part of the batch
+        if (counter >= commit_batch_size or
+                time.time() - commit_time > commit_interval or
+                (drain_tokens and sock.queue.empty())):
+            flush_pending(pending, db, curr, logger)
+            drain_acks.ack(drain_tokens)
+            throughput.add(counter)
             counter = 0
             commit_time = time.time()
-            db.commit()
+            throughput.log(logger)
 
     # finishes work and gracefully stops
-    db.commit()
+    flush_pending(pending, db, curr, logger)
+    throughput.add(counter)
+    throughput.log(logger, force=True)
+    logger.debug(get_cpu_usage("DataAggregator", throughput.start_time))
     db.close()
 
 
-def process_query(query, curr, logger):
+def is_drain_marker(query):
+    """ Returns True if <query> is a (DRAIN_SIGNAL, token) marker """
+    return (type(query) in (tuple, list) and len(query) == 2 and
+            query[0] == DRAIN_SIGNAL)
+
+
+class DrainAcks(object):
     """
-    executes a query of form (template_string, arguments)
-    query is of form (template_string, arguments)
+    Tokens of the drain markers whose preceding records are committed. A
+    producer sends a (DRAIN_SIGNAL, token) marker through its data socket
+    after the records of a visit; since each connection is read in order,
+    all of them are committed once the marker is. `handle_query` answers
+    a request for a token as soon as it is acknowledged.
     """
-    if len(query) != 2:
-        print "ERROR: Query is not the correct length"
-        return
-    statement = query[0]
-    args = list(query[1])
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.tokens = set()
+        # tokens whose request timed out before the ack, oldest first. Acks
+        # that never arrive are forgotten after MAX_EXPIRED_TOKENS timeouts
+        self.expired = OrderedDict()
+
+    def ack(self, tokens):
+        """ Acknowledges and empties the list of <tokens> """
+        if not tokens:
+            return
+        with self.condition:
+            for token in tokens:
+                if token in self.expired:  # nobody waits for it anymore
+                    del self.expired[token]
+                else:
+                    self.tokens.add(token)
+            self.condition.notifyAll()
+        del tokens[:]
+
+    def handle_query(self, msg):
+        """
+        Answers a request [token, timeout] with '1' once <token> is
+        acknowledged, or with '0' if that takes more than <timeout> seconds.
+        Called by the drain server threads.
+        """
+        token, timeout = msg
+        deadline = time.time() + timeout
+        with self.condition:
+            while token not in self.tokens:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.expired[token] = True
+                    if len(self.expired) > MAX_EXPIRED_TOKENS:
+                        self.expired.popitem(last=False)
+                    return '0'
+                self.condition.wait(remaining)
+            self.tokens.remove(token)
+        return '1'
+
+
+class ThroughputCounter(object):
+    """
+    Keeps track of the number of rows written per second and logs them
+    together with the CPU share of the process and the queue metrics of the
+    serversocket <sock>
+    """
+    def __init__(self, sock, interval=STATS_INTERVAL):
+        self.sock = sock
+        self.interval = interval
+        self.start_time = time.time()
+        self.total_rows = 0
+        self.interval_start = self.start_time
+        self.interval_rows = 0
+        self.interval_cpu = sum(os.times()[:2])
+
+    def add(self, num_rows):
+        self.total_rows += num_rows
+        self.interval_rows += num_rows
+
+    def log(self, logger, force=False):
+        """ Logs throughput if <interval> seconds have passed (or <force>) """
+        now = time.time()
+        elapsed = now - self.interval_start
+        if not force and elapsed < self.interval:
+            return
+        total_elapsed = max(now - self.start_time, 1e-6)
+        cpu = sum(os.times()[:2])
+        logger.debug("DataAggregator throughput: %.1f rows/s over the last "
+                     "%.0f seconds (%.2f%% CPU), %.1f rows/s overall (%i rows)"
+                     % (self.interval_rows / max(elapsed, 1e-6), elapsed,
+                        100 * (cpu - self.interval_cpu) / max(elapsed, 1e-6),
+                        self.total_rows / total_elapsed, self.total_rows))
+        logger.debug("DataAggregator " + self.sock.get_queue_stats(reset=True))
+        self.interval_start = now
+        self.interval_rows = 0
+        self.interval_cpu = cpu
+
+
+def encode_args(args):
+    """ Converts the arguments of a query to types supported by sqlite3 """
+    args = list(args)
     for i in range(len(args)):
         if type(args[i]) == str:
             args[i] = unicode(args[i], errors='ignore')
         elif callable(args[i]):
             args[i] = str(args[i])
+    # no logging for login command (we dont want passwords to shop up in db)
+    if len(args) > 1 and args[1] == "LOGIN":
+        args[2] = "no args due to sensible data"
+    return args
+
+
+def encode_any(value):
+    """ Converts values of a column that may hold any python object """
+    if type(value) is str:
+        return unicode(value, errors='ignore')
+    elif callable(value):
+        return str(value)
+    return value
+
+
+def encode_text(value):
+    """ `encode_any` for text columns, returning unicode values untouched """
+    if type(value) is unicode:
+        return value
+    return encode_any(value)
+
+
+def encode_number(value):
+    """ `encode_any` for numeric columns, returning numbers untouched """
+    if type(value) in NUMBER_TYPES:
+        return value
+    return encode_any(value)
+
+
+def compile_encoder(statement, num_args, curr):
+    """
+    Builds an encoder for the arguments of <statement> from the schema of the
+    table it inserts into. The encoder applies one converter per column,
+    picked by the column type so that the values a column usually holds are
+    returned after a single type check. Every converter gives the same
+    result as `encode_args`. Statements that are not a plain
+    `INSERT INTO table (columns)` fall back to `encode_args`.
+    """
+    match = INSERT_RE.match(statement)
+    if match is None:
+        return encode_args
+    table = match.group(1)
+    columns = [column.strip() for column in match.group(2).split(',')]
+    if len(columns) != num_args:
+        return encode_args
+    column_types = dict((row[1].lower(), row[2].upper())
+                        for row in curr.execute("PRAGMA table_info(%s)" % table))
+    if not column_types:
+        return encode_args
+
+    converters = list()
+    for column in columns:
+        column_type = column_types.get(column.lower())
+        if column_type is None:
+            return encode_args
+        if NUMERIC_TYPE_RE.search(column_type):
+            converters.append(encode_number)
+        else:
+            converters.append(encode_text)
+    converters = tuple(converters)
+
+    def encoder(args):
+        return [convert(arg) for convert, arg in zip(converters, args)]
+
+    # no logging for login command (we dont want passwords to shop up in db)
+    if num_args > 2:
+        encode_row = encoder
+
+        def encoder(args):
+            args = encode_row(args)
+            if args[1] == "LOGIN":
+                args[2] = "no args due to sensible data"
+            return args
+    return encoder
+
+
+def process_query(query, pending, encoders, curr, logger):
+    """
+    adds a query of form (template_string, arguments) to the pending batch
+    queries without arguments are executed right away (after committing the
+    pending batch, so that they keep their order relative to the inserts)
+    arguments are converted by an encoder compiled on the first occurrence
+    of a statement and cached in <encoders>
+    returns the number of rows added to the batch
+    """
+    if len(query) != 2:
+        print "ERROR: Query is not the correct length"
+        return 0
+    statement, args = query
+    if len(args) == 0:
+        if pending:
+            flush_pending(pending, curr.connection, curr, logger)
+        execute_query(statement, (), curr, logger)
+        return 0
+
+    # rows are grouped by argument count as well, so that a binding error
+    # fails a whole group before any of its rows have been written
+    key = (statement, len(args))
+    encoder = encoders.get(key)
+    if encoder is None:
+        encoder = encoders[key] = compile_encoder(statement, len(args), curr)
+    pending.setdefault(key, list()).append(encoder(args))
+    return 1
+
+
+def execute_query(statement, args, curr, logger):
+    """ executes a single query, logging unsupported queries """
     try:
         if len(args) == 0:
             curr.execute(statement)
         else:
-            # no logging for login command (we dont want passwords to shop up in db)
-            if len(args) > 1 and args[1] == "LOGIN":
-                args[2] = "no args due to sensible data"
-            curr.execute(statement,args)
+            curr.execute(statement, args)
     except OperationalError as e:
         logger.error("Unsupported query" + '\n' + str(type(e)) + '\n' + str(e) + '\n' + statement + '\n' + str(args))
         pass
-    except ProgrammingError as e:
+    except (ProgrammingError, InterfaceError) as e:
         logger.error("Unsupported query" + '\n' + str(type(e)) + '\n' + str(e) + '\n' + statement + '\n' + str(args))
         pass
 
 
-def drain_queue(sock_queue, curr, logger):
+def write_pending(pending, curr, logger):
+    """
+    executes all pending rows with one `executemany` per statement
+    groups that fail are rolled back to a savepoint and retried row by row,
+    so that errors are logged per row and no row is written twice
+    """
+    for (statement, num_args), args_list in pending.iteritems():
+        curr.execute("SAVEPOINT pending_group")
+        try:
+            curr.executemany(statement, args_list)
+        except (OperationalError, ProgrammingError, InterfaceError):
+            curr.execute("ROLLBACK TO pending_group")
+            for args in args_list:
+                execute_query(statement, encode_args(args), curr, logger)
+        curr.execute("RELEASE pending_group")
+    pending.clear()
+
+
+def flush_pending(pending, db, curr, logger):
+    """
+    writes all pending rows and commits them in one transaction
+    <db> is expected in autocommit mode (isolation_level None), since the
+    sqlite3 module would otherwise commit before each savepoint
+    """
+    db.execute("BEGIN")
+    write_pending(pending, curr, logger)
+    db.execute("COMMIT")
+
+
+def drain_queue(sock_queue, pending, encoders, counter, curr, logger):
     """ Ensures queue is empty before closing """
-    time.sleep(3)  # TODO: the socket needs a better way of closing
-    while not sock_queue.empty():
-        query = sock_queue.get()
-        process_query(query, curr, logger)
+    # TODO: the socket needs a better way of closing
+    while True:
+        try:
+            query = sock_queue.get(True, DRAIN_TIMEOUT)
+        except EmptyQueue:
+            return counter
+        if not is_shutdown_signal(query) and not is_drain_marker(query):
+            counter += process_query(query, pending, encoders, curr, logger)
@@ -1,11 +1,116 @@
-from ..SocketInterface import serversocket
-from ..MPLogger import loggingclient
+from ..SocketInterface import serversocket, clientsocket, get_unix_socket_path, is_shutdown_signal
+from ..MPLogger import loggingclient, get_cpu_usage
+from Queue import Empty as EmptyQueue
 import plyvel
+import json
 import time
 import os
 
+COMMIT_INTERVAL = 5  # maximum number of seconds records are held before a write
+DRAIN_TIMEOUT = 3  # seconds without new records before the queue counts as drained
+BULK_WRITE_BUFFER_SIZE = 64 * 2**20  # minimum write buffer in bulk load mode
+BULK_BATCH_SIZE = 1000  # minimum write batch size in bulk load mode
 
-def LevelDBAggregator(manager_params, status_queue, batch_size=100):
+
+def get_leveldb_options(manager_params):
+    """
+    Returns the plyvel.DB options and the write batch size configured in
+    <manager_params>. The bulk load mode raises the write buffer and the
+    batch size, so that scripts are flushed to fewer, larger files, and the
+    database is compacted once when the aggregator shuts down.
+    """
+    options = {'create_if_missing': True,
+               'lru_cache_size': manager_params['leveldb_lru_cache_size'],
+               'write_buffer_size': manager_params['leveldb_write_buffer_size'],
+               'compression': manager_params['leveldb_compression']}
+    batch_size = manager_params['leveldb_batch_size']
+    if manager_params['leveldb_bulk_load']:
+        options['write_buffer_size'] = max(options['write_buffer_size'],
+                                           BULK_WRITE_BUFFER_SIZE)
+        batch_size = max(batch_size, BULK_BATCH_SIZE)
+    return options, batch_size
+
+
+class HashCache(object):
+    """
+    In-memory set of the content hashes written to the database or added to
+    the pending write batch. Duplicates are dropped without a LevelDB lookup;
+    hashes not in the set are looked up once, for content stored by an
+    earlier crawl into the same database.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.hashes = set()
+        self.lookups = 0
+        self.hits = 0  # duplicates found in the set
+        self.db_hits = 0  # duplicates found in the database
+        self.queries = 0  # hashes producers asked about
+        self.query_hits = 0  # hashes producers asked about which were known
+
+    def is_duplicate(self, content_hash):
+        """ Returns True if the content is known, else marks it as known """
+        self.lookups += 1
+        if content_hash in self.hashes:
+            self.hits += 1
+            return True
+        self.hashes.add(content_hash)
+        if self.db.get(content_hash) is not None:
+            self.db_hits += 1
+            return True
+        return False
+
+    def handle_query(self, content_hash):
+        """
+        Answers a producer's query whether <content_hash> is known with
+        '1' or '0'. Called by the query server threads, so it only reads
+        """
+        self.queries += 1
+        if content_hash in self.hashes or self.db.get(content_hash) is not None:
+            self.query_hits += 1
+            return '1'
+        return '0'
+
+    def get_stats(self):
+        """ Returns a string describing the duplicate hit rate """
+        duplicates = self.hits + self.db_hits
+        rate = 100.0 * duplicates / self.lookups if self.lookups else 0.0
+        return ("dropped %i duplicates of %i records (%.1f%% hit rate, "
+                "%i found in the database), %i distinct hashes, "
+                "%i of %i hashes queried by producers were known" % (
+                    duplicates, self.lookups, rate, self.db_hits,
+                    len(self.hashes), self.query_hits, self.queries))
+
+
+class ContentSender(object):
+    """
+    Producer side of the LevelDBAggregator. Sends the content of a script
+    only if neither this sender nor the aggregator has seen its hash yet,
+    so repeated scripts cost a short query instead of their whole body.
+    """
+    def __init__(self, manager_params):
+        self.sock = clientsocket(serialization='marshal')
+        self.sock.connect(*manager_params['ldb_address'])
+        self.query_sock = clientsocket()
+        self.query_sock.connect(*manager_params['ldb_query_address'])
+        self.sent_hashes = set()  # hashes sent by, or known to, this sender
+
+    def save(self, content, content_hash):
+        """ Sends <content> unless it is known. Returns True if it was sent """
+        content_hash = str(content_hash)
+        if content_hash in self.sent_hashes:
+            return False
+        self.sent_hashes.add(content_hash)
+        if self.query_sock.request(content_hash) == '1':
+            return False
+        self.sock.send((content, content_hash))
+        return True
+
+    def close(self):
+        self.sock.close()
+        self.query_sock.close()
+
+
+def LevelDBAggregator(manager_params, status_queue):
     """
      Receives <key, value> pairs from other processes and writes them to the
      central database. Executes queries until being told to die (then it will
@@ -14,78 +119,131 @@ def LevelDBAggregator(manager_params, status_queue, batch_size=100):
 
      <manager_params> TaskManager configuration parameters
      <status_queue> is a queue connect to the TaskManager used for communication
-     <batch_size> is the size of the write batch
     """
 
     # sets up logging connection
+    start_time = time.time()
     logger = loggingclient(*manager_params['logger_address'])
 
     # sets up the serversocket to start accepting connections
-    sock = serversocket()
-    status_queue.put(sock.sock.getsockname())  # let TM know location
+    unix_path = None
+    if manager_params['unix_sockets']:
+        unix_path = get_unix_socket_path(manager_params['data_directory'],
+                                         'ldb_aggregator')
+    sock = serversocket(max_queue_size=manager_params['aggregator_queue_size'],
+                        unix_path=unix_path,
+                        event_loop=manager_params['aggregator_event_loop'])
+    status_queue.put(sock.get_addresses())  # let TM know location
     sock.start_accepting()
 
     # sets up DB connection
     db_path = os.path.join(manager_params['data_directory'], 'javascript.ldb')
-    db = plyvel.DB(db_path,
-            create_if_missing = True,
-            lru_cache_size = 10**9,
-            write_buffer_size = 128*10**4,
-            compression = 'snappy')
+    options, batch_size = get_leveldb_options(manager_params)
+    db = plyvel.DB(db_path, **options)
     batch = db.write_batch()
+    # size and first seen time of the stored content, kept in a side database
+    # so that iterating javascript.ldb only yields content
+    meta_db = plyvel.DB(os.path.join(manager_params['data_directory'],
+                                     'javascript_meta.ldb'),
+                        create_if_missing=True)
+    meta_batch = meta_db.write_batch()
+    known_hashes = HashCache(db)
+
+    # answers producers whether a content hash is known, so they can skip
+    # sending the content of scripts already stored
+    query_unix_path = None
+    if manager_params['unix_sockets']:
+        query_unix_path = get_unix_socket_path(manager_params['data_directory'],
+                                               'ldb_query')
+    query_sock = serversocket(unix_path=query_unix_path,
+                              handler=known_hashes.handle_query)
+    status_queue.put(query_sock.get_addresses())  # let TM know location
+    query_sock.start_accepting()
 
     counter = 0  # number of executions made since last write
-    commit_time = 0  # keep track of time since last write
+    commit_time = time.time()  # keep track of time since last write
     while True:
+        # block until a record arrives or the batch is due to be written
+        if counter > 0:
+            timeout = max(COMMIT_INTERVAL - (time.time() - commit_time), 0)
+        else:
+            timeout = None
+        try:
+            record = sock.queue.get(True, timeout)
+        except EmptyQueue:
+            # commit every five seconds to avoid blocking the db for too long
+            counter = 0
+            commit_time = time.time()
+            write_batches(batch, meta_batch)
+            continue
+
         # received KILL command from TaskManager
-        if not status_queue.empty():
-            status_queue.get()
+        if is_shutdown_signal(record):
             sock.close()
-            drain_queue(sock.queue, batch, db, counter, logger)
+            query_sock.close()
+            drain_queue(sock.queue, batch, meta_batch, known_hashes, counter,
+                        logger)
             break
 
-        # no command for now -> sleep to avoid pegging CPU on blocking get
-        if sock.queue.empty():
-            time.sleep(0.1)
-
-            # commit every five seconds to avoid blocking the db for too long
-            if counter > 0 and time.time() - commit_time > 5:
-                batch.write()
-                batch = db.write_batch()
-            continue
-
         # process record
-        content, content_hash = sock.queue.get()
+        content, content_hash = record
         counter = process_content(content, content_hash,
-                batch, db, counter, logger)
+                batch, meta_batch, known_hashes, counter, logger)
 
         # batch commit if necessary
         if counter >= batch_size:
             counter = 0
             commit_time = time.time()
-            batch.write()
-            batch = db.write_batch()
+            write_batches(batch, meta_batch)
 
     # finishes work and gracefully stops
-    batch.write()
+    write_batches(batch, meta_batch)
+    meta_db.close()
+    if manager_params['leveldb_bulk_load']:
+        compact_time = time.time()
+        db.compact_range()
+        logger.debug("LevelDBAggregator compacted the database in %.1f seconds" %
+                     (time.time() - compact_time))
     db.close()
+    logger.debug("LevelDBAggregator " + known_hashes.get_stats())
+    logger.debug("LevelDBAggregator " + sock.get_queue_stats())
+    logger.debug(get_cpu_usage("LevelDBAggregator", start_time))
 
-def process_content(content, content_hash, batch, db, counter, logger):
+def process_content(content, content_hash, batch, meta_batch, known_hashes,
+                    counter, logger):
     """
-    adds content to the batch
+    adds content to the batch and its size and first seen time to
+    <meta_batch>, unless <known_hashes> has seen it before
     """
-    content = content.encode('utf-8')
     content_hash = str(content_hash)
-    if db.get(content_hash) is not None:
+    if known_hashes.is_duplicate(content_hash):
         return counter
 
+    content = content.encode('utf-8')
     batch.put(content_hash, content)
+    meta_batch.put(content_hash, json.dumps([len(content), time.time()]))
     return counter + 1
 
-def drain_queue(sock_queue, batch, db, counter, logger):
+def write_batches(batch, meta_batch):
+    """
+    writes the content batch, then its metadata, so that any hash with
+    metadata has its content stored, and empties both batches for reuse
+    """
+    batch.write()
+    meta_batch.write()
+    batch.clear()
+    meta_batch.clear()
+
+def drain_queue(sock_queue, batch, meta_batch, known_hashes, counter, logger):
     """ Ensures queue is empty before closing """
-    time.sleep(3)  # TODO: the socket needs a better way of closing
-    while not sock_queue.empty():
-        content, content_hash = sock_queue.get()
+    # TODO: the socket needs a better way of closing
+    while True:
+        try:
+            record = sock_queue.get(True, DRAIN_TIMEOUT)
+        except EmptyQueue:
+            return
+        if is_shutdown_signal(record):
+            continue
+        content, content_hash = record
         counter = process_content(content, content_hash,
-                batch, db, counter, logger)
+                batch, meta_batch, known_hashes, counter, logger)
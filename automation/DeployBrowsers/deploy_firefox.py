@@ -79,12 +79,15 @@ def deploy_firefox(status_queue, browser_params, manager_params, crash_recovery)
         fp.set_preference("extensions.@openwpm.sdk.console.logLevel", "all")
         extension_config = dict()
         extension_config.update(browser_params)
-        extension_config['logger_address'] = manager_params['logger_address']
-        extension_config['sqlite_address'] = manager_params['aggregator_address']
-        if manager_params.has_key('ldb_address'):
-            extension_config['leveldb_address'] = manager_params['ldb_address']
+        # the extension connects over tcp, even if local clients use unix sockets
+        extension_config['logger_address'] = manager_params['logger_tcp_address']
+        extension_config['sqlite_address'] = manager_params['aggregator_tcp_address']
+        if manager_params.has_key('ldb_tcp_address'):
+            extension_config['leveldb_address'] = manager_params['ldb_tcp_address']
+            extension_config['leveldb_query_address'] = manager_params['ldb_query_tcp_address']
         else:
             extension_config['leveldb_address'] = None
+            extension_config['leveldb_query_address'] = None
         extension_config['testing'] = manager_params['testing']
         with open(browser_profile_path + 'browser_params.json', 'w') as f:
             json.dump(extension_config, f)
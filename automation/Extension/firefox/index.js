@@ -23,6 +23,7 @@ exports.main = function(options, callbacks) {
     var config = {
       sqlite_address:null,
       leveldb_address:null,
+      leveldb_query_address:null,
       logger_address:null,
       disable_webdriver_self_id:true,
       cookie_instrument:true,
@@ -38,7 +39,8 @@ exports.main = function(options, callbacks) {
   loggingDB.open(config['sqlite_address'],
                  config['leveldb_address'],
                  config['logger_address'],
-                 config['crawl_id']);
+                 config['crawl_id'],
+                 config['leveldb_query_address']);
 
   // Prevent the webdriver from identifying itself in the DOM. See #91
   if (config['disable_webdriver_self_id']) {
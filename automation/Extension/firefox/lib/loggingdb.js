@@ -7,10 +7,13 @@ var visitID = null;
 var debugging = false;
 var sqliteAggregator = null;
 var ldbAggregator = null;
+var ldbQuery = null;  // asks the LevelDBAggregator whether a hash is stored
+var savedContentHashes = {};  // hashes whose content was sent this session
 var logAggregator = null;
 var listeningSocket = null;
 
-exports.open = function(sqliteAddress, ldbAddress, logAddress, curr_crawlID) {
+exports.open = function(sqliteAddress, ldbAddress, logAddress, curr_crawlID,
+                        ldbQueryAddress) {
     if (sqliteAddress == null && ldbAddress == null && logAddress == null && curr_crawlID == '') {
         console.log("Debugging, everything will output to console");
         debugging = true;
@@ -38,10 +41,18 @@ exports.open = function(sqliteAddress, ldbAddress, logAddress, curr_crawlID) {
         var rv = ldbAggregator.connect(ldbAddress[0], ldbAddress[1]);
         console.log("ldbSocket started?",rv);
     }
+    if (ldbAddress != null && ldbQueryAddress != null) {
+        ldbQuery = new socket.RequestSocket();
+        var rv = ldbQuery.connect(ldbQueryAddress[0], ldbQueryAddress[1]);
+        console.log("ldbQuerySocket started?",rv);
+        if (!rv) {
+            ldbQuery = null;  // send all new content unasked
+        }
+    }
 
 
     // Listen for incomming urls as visit ids
-    listeningSocket = new socket.ListeningSocket();
+    listeningSocket = new socket.ListeningSocket(handleDrainRequest);
     var path = system.pathFor("ProfD") + '/extension_port.txt';
     console.log("Writing listening socket port to disk at:", path);
     var file = fileIO.open(path, 'w');
@@ -54,6 +65,18 @@ exports.open = function(sqliteAddress, ldbAddress, logAddress, curr_crawlID) {
     listeningSocket.startListening();
 };
 
+// Answers a drain request of the BrowserManager, ["DRAIN", token], with a
+// marker sent to the DataAggregator after all records inserted so far
+var handleDrainRequest = function(msg) {
+    if (!Array.isArray(msg) || msg[0] != "DRAIN") {
+        return false;
+    }
+    if (sqliteAggregator != null) {
+        sqliteAggregator.send(["DRAIN", msg[1]]);
+    }
+    return true;
+};
+
 exports.close = function() {
     if (sqliteAggregator != null) {
         sqliteAggregator.close();
@@ -61,6 +84,9 @@ exports.close = function() {
     if (ldbAggregator != null) {
         ldbAggregator.close();
     }
+    if (ldbQuery != null) {
+        ldbQuery.close();
+    }
     if (logAggregator != null) {
         logAggregator.close();
     }
@@ -171,6 +197,30 @@ exports.saveContent = function(content, contentHash) {
     console.log("LDB contentHash:",contentHash,"with length",content.length);
     return;
   }
+  // send each script once, and only if the aggregator lacks it
+  // (e.g. it was saved by another browser or an earlier crawl). A hash is
+  // only marked once it is sent or known to the aggregator, so content whose
+  // query gets no answer is still sent
+  if (savedContentHashes.hasOwnProperty(contentHash)) {
+    return;
+  }
+  if (ldbQuery == null ||
+      !ldbQuery.request(contentHash, function(known) {
+        if (savedContentHashes.hasOwnProperty(contentHash)) {
+          return;  // answered for an earlier request
+        }
+        if (known == '1') {
+          savedContentHashes[contentHash] = true;
+        } else {
+          sendContent(content, contentHash);
+        }
+      })) {
+    sendContent(content, contentHash);
+  }
+}
+
+function sendContent(content, contentHash) {
+  savedContentHashes[contentHash] = true;
   ldbAggregator.send([content, contentHash]);
 }
 
@@ -8,7 +8,8 @@ var socketService = Cc["@mozilla.org/network/socket-transport-service;1"]
 
 class ListeningSocket {
   // Socket which feeds incomming messages to a queue
-  constructor() {
+  // Messages for which `handler(message)` returns true are not queued
+  constructor(handler) {
 
     console.log("Initializing a listening sever socket...");
     this._serverSocket = Cc["@mozilla.org/network/server-socket;1"]
@@ -18,6 +19,7 @@ class ListeningSocket {
 
     this.port = this._serverSocket.port;
     this.queue = []; // stores messages sent to socket
+    this._handler = handler;
     console.log("...serverSocket listening on port:",this.port);
 
   }
@@ -50,7 +52,9 @@ class ListeningSocket {
       console.error("Unsupported serialization type (",meta[1],").");
       return;
     }
-    this.queue.push(string);
+    if (!this._handler || !this._handler(string)) {
+      this.queue.push(string);
+    }
 
     var thisSocket = this; // self reference for closure
     this._inputStream.asyncWait({
@@ -103,3 +107,110 @@ class SendingSocket {
   }
 }
 exports.SendingSocket = SendingSocket;
+
+class RequestSocket {
+  // Socket to a request/response server, which answers every message with
+  // a string. Replies arrive in request order and are passed to the
+  // callback given with each request. If the connection is lost, pending
+  // callbacks get null and later requests fail.
+  constructor() {
+    this._stream = null;
+    this._inputStream = null;
+    this._bOutputStream = Cc["@mozilla.org/binaryoutputstream;1"]
+                              .createInstance(Ci.nsIBinaryOutputStream);
+    this._bInputStream = Cc["@mozilla.org/binaryinputstream;1"]
+                              .createInstance(Ci.nsIBinaryInputStream);
+    this._callbacks = [];
+    this._received = ""; // bytes of the replies not yet complete
+    this._failed = false;
+  }
+
+  connect(host, port) {
+    try {
+      var transport = socketService.createTransport(null, 0, host, port, null);
+      this._stream = transport.openOutputStream(1, 4096, 1048575);
+      this._bOutputStream.setOutputStream(this._stream);
+      this._inputStream = transport.openInputStream(0, 0, 0);
+      this._bInputStream.setInputStream(this._inputStream);
+      this._waitForReplies();
+      return true;
+    } catch (err) {
+      console.error(err,err.message);
+      return false;
+    }
+  }
+
+  request(msg, callback) {
+    // strings are sent as is, other messages as json
+    if (this._failed) {
+      return false;
+    }
+    try {
+      var serialization = 'n';
+      if (typeof msg != "string") {
+        msg = JSON.stringify(msg);
+        serialization = 'j';
+      }
+      var buff = bufferpack.pack('>Lc',[msg.length,serialization]);
+      this._bOutputStream.writeByteArray(buff, buff.length);
+      this._stream.write(msg, msg.length);
+      this._callbacks.push(callback);
+      return true;
+    } catch (err) {
+      console.error(err,err.message);
+      this._fail();
+      return false;
+    }
+  }
+
+  _waitForReplies() {
+    var thisSocket = this; // self reference for closure
+    this._inputStream.asyncWait({
+      onInputStreamReady: function() {
+        thisSocket._readReplies();
+      }
+    }, 0, 0, tm.mainThread);
+  }
+
+  _readReplies() {
+    try {
+      this._received += this._bInputStream.readBytes(
+          this._inputStream.available());
+    } catch (err) {  // the connection is closed
+      console.error(err,err.message);
+      this._fail();
+      return;
+    }
+    while (this._received.length >= 5) {
+      var header = [];
+      for (var i = 0; i < 5; i++) {
+        header.push(this._received.charCodeAt(i));
+      }
+      var msgLength = bufferpack.unpack('>Lc', header)[0];
+      if (this._received.length < 5 + msgLength) {
+        break;
+      }
+      var reply = this._received.substr(5, msgLength);
+      this._received = this._received.substr(5 + msgLength);
+      this._callbacks.shift()(reply);
+    }
+    this._waitForReplies();
+  }
+
+  _fail() {
+    // requests still waiting for a reply will not get one
+    this._failed = true;
+    var callbacks = this._callbacks;
+    this._callbacks = [];
+    for (var i = 0; i < callbacks.length; i++) {
+      callbacks[i](null);
+    }
+  }
+
+  close() {
+    this._failed = true;
+    this._stream.close();
+    this._inputStream.close();
+  }
+}
+exports.RequestSocket = RequestSocket;
@@ -1,9 +1,10 @@
 """ Support for logging with the multiprocessing module """
-from SocketInterface import serversocket
+from SocketInterface import serversocket, get_unix_socket_path
 
 from Queue import Empty as EmptyQueue
 import logging.handlers
 import logging
+import socket
 import struct
 import json
 import time
@@ -14,6 +15,15 @@ class ClientSocketHandler(logging.handlers.SocketHandler):
     """
     Make SocketHandler compatible with SocketInterface.py
     """
+    def makeSocket(self, timeout=1):
+        """ Connects to a Unix domain socket if the port is None """
+        if self.port is not None:
+            return logging.handlers.SocketHandler.makeSocket(self, timeout)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(self.host)
+        return s
+
     def makePickle(self, record):
         """
         Serializes the record via json and prepends a length/serialization
@@ -54,13 +64,27 @@ def loggingclient(logger_address, logger_port, level=logging.DEBUG):
 
     return logger
 
-def loggingserver(log_file, status_queue):
+def get_cpu_usage(process_name, start_time):
+    """
+    Returns a message with the CPU time used by the calling process and its
+    share of the wall time since <start_time>, idle time included, so that
+    the cost of waiting for data can be compared between processes
+    """
+    user_time, system_time = os.times()[:2]
+    elapsed = max(time.time() - start_time, 1e-6)
+    return ("%s used %.2fs user and %.2fs system CPU time over %.0f seconds "
+            "(%.2f%% CPU)" % (process_name, user_time, system_time, elapsed,
+                              100 * (user_time + system_time) / elapsed))
+
+def loggingserver(log_file, status_queue, unix_socket_dir=None):
     """
     A logging server to serialize writes to the log file from multiple
     processes.
 
     <log_file> location of the log file on disk
     <status_queue> is a queue connect to the TaskManager used for communication
+    <unix_socket_dir> if set, local clients connect through a Unix domain
+                      socket in this directory
     """
     # Configure the log file
     logging.basicConfig(filename=os.path.expanduser(log_file),
@@ -69,8 +93,11 @@ def loggingserver(log_file, status_queue):
             level=logging.INFO)
 
     # Sets up the serversocket to start accepting connections
-    sock = serversocket()
-    status_queue.put(sock.sock.getsockname())  # let TM know location
+    unix_path = None
+    if unix_socket_dir is not None:
+        unix_path = get_unix_socket_path(unix_socket_dir, 'logger')
+    sock = serversocket(unix_path=unix_path)
+    status_queue.put(sock.get_addresses())  # let TM know location
     sock.start_accepting()
 
     while True:
@@ -125,7 +152,7 @@ if __name__ == '__main__':
     loggingserver = mp.Process(target=loggingserver, args=(log_file, status_queue))
     loggingserver.daemon = True
     loggingserver.start()
-    server_address = status_queue.get()
+    server_address, _ = status_queue.get()
 
     # Connect main process to logging server
     rootLogger = logging.getLogger('')
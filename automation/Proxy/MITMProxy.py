@@ -1,4 +1,5 @@
-from ..SocketInterface import clientsocket
+from ..SocketInterface import clientsocket, BATCH_SIZE, DRAIN_SIGNAL
+from ..DataAggregator.LevelDBAggregator import ContentSender
 from ..MPLogger import loggingclient
 import mitm_commands
 
@@ -27,15 +28,16 @@ class InterceptingMaster (controller.Master):
         self.prev_visit_id, self.curr_visit_id = None, None  # previous and current top level domains
         self.prev_requests, self.curr_requests = set(), set()  # set of requests for previous and current site
 
-        # Open a socket to communicate with DataAggregator
-        self.db_socket = clientsocket(serialization='dill')
+        # Open a socket to communicate with DataAggregator. Rows are batched
+        # and written at least once a second.
+        self.db_socket = clientsocket(serialization='marshal',
+                                      batch_size=BATCH_SIZE, flush_interval=1)
         self.db_socket.connect(*manager_params['aggregator_address'])
 
-        # Open a socket to communicate with LevelDBAggregator
-        self.ldb_socket = None
+        # Open the connections to LevelDBAggregator
+        self.content_sender = None
         if browser_params['save_javascript_proxy']:
-            self.ldb_socket = clientsocket(serialization='dill')
-            self.ldb_socket.connect(*manager_params['ldb_address'])
+            self.content_sender = ContentSender(manager_params)
 
         # Open a socket to communicate with MPLogger
         self.logger = loggingclient(*manager_params['logger_address'])
@@ -57,17 +59,34 @@ class InterceptingMaster (controller.Master):
     def tick(self, q, timeout=0.01):
         """ new tick function used to label first-party domains and avoid race conditions when doing so """
         if self.curr_visit_id is None:  # proxy is fresh, need to get first-party domain right away
-            self.curr_visit_id = self.visit_id_queue.get()
-        elif not self.visit_id_queue.empty():  # new FP has been visited
+            visit_id = self.visit_id_queue.get()
+            if self.is_drain_request(visit_id):
+                self.send_drain_marker(visit_id[1])
+            else:
+                self.curr_visit_id = visit_id
+        elif not self.visit_id_queue.empty():  # new FP has been visited (or the visit ended)
             # drains the queue to get rid of stale messages from previous site
             while self.load_process_message(q, timeout):
                 pass
 
-            self.prev_requests, self.curr_requests = self.curr_requests, set()
-            self.prev_visit_id, self.curr_visit_id = self.curr_visit_id, self.visit_id_queue.get()
+            visit_id = self.visit_id_queue.get()
+            if self.is_drain_request(visit_id):
+                self.send_drain_marker(visit_id[1])
+            else:
+                self.prev_requests, self.curr_requests = self.curr_requests, set()
+                self.prev_visit_id, self.curr_visit_id = self.curr_visit_id, visit_id
 
         self.load_process_message(q, timeout)
 
+    def is_drain_request(self, msg):
+        """ BrowserManager.drain_visit passes (DRAIN_SIGNAL, token) down the visit id queue """
+        return type(msg) is tuple and msg[0] == DRAIN_SIGNAL
+
+    def send_drain_marker(self, token):
+        """ sends the drain marker after the records of the processed messages """
+        self.db_socket.send((DRAIN_SIGNAL, token))
+        self.db_socket.flush()
+
     def run(self):
         """ Light wrapper around run with error printing """
         try:
@@ -83,6 +102,19 @@ class InterceptingMaster (controller.Master):
             self.shutdown()
             raise
 
+    def shutdown(self):
+        """ Stops the proxy and writes out the rows still batched in db_socket """
+        if self.should_exit.is_set():
+            return
+        controller.Master.shutdown(self)
+        try:
+            self.db_socket.close()
+        except Exception:
+            excp = traceback.format_exception(*sys.exc_info())
+            self.logger.error('BROWSER %i: Could not flush the proxy data socket\n%s' % (self.browser_params['crawl_id'], excp))
+        if self.content_sender is not None:
+            self.content_sender.close()
+
     def handle_request(self, msg):
         """ Receives HTTP request, and sends it to logging function """
         msg.reply()
@@ -107,7 +139,7 @@ class InterceptingMaster (controller.Master):
         else:  # ignore responses for which we cannot match the request
             return
         mitm_commands.process_general_mitm_response(self.db_socket,
-                                                    self.ldb_socket,
+                                                    self.content_sender,
                                                     self.logger,
                                                     self.browser_params,
                                                     visit_id, msg)
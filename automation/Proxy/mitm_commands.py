@@ -39,12 +39,12 @@ def process_general_mitm_request(db_socket, browser_params, visit_id, msg):
                     "referrer, headers, visit_id, time_stamp) VALUES (?,?,?,?,?,?,?)", data))
 
 
-def process_general_mitm_response(db_socket, ldb_socket, logger, browser_params, visit_id, msg):
+def process_general_mitm_response(db_socket, content_sender, logger, browser_params, visit_id, msg):
     """ Logs a HTTP response object and, if necessary, """
     referrer = msg.request.headers['referer'][0] if len(msg.request.headers['referer']) > 0 else ''
     location = msg.response.headers['location'][0] if len(msg.response.headers['location']) > 0 else ''
 
-    content_hash = save_javascript_content(ldb_socket, logger, browser_params, msg)
+    content_hash = save_javascript_content(content_sender, logger, browser_params, msg)
 
     data = (browser_params['crawl_id'],
             encode_to_unicode(msg.request.url),
@@ -64,7 +64,7 @@ def process_general_mitm_response(db_socket, ldb_socket, logger, browser_params,
                     "VALUES (?,?,?,?,?,?,?,?,?,?,?)", data))
 
 
-def save_javascript_content(ldb_socket, logger, browser_params, msg):
+def save_javascript_content(content_sender, logger, browser_params, msg):
     """ Save javascript files de-duplicated and compressed on disk """
     if not browser_params['save_javascript_proxy']:
         return
@@ -113,6 +113,7 @@ def save_javascript_content(ldb_socket, logger, browser_params, msg):
     hasher = mmh3.hash128
     script_hash = str(hasher(script.encode('utf-8')) >> 64)
 
-    ldb_socket.send((script, script_hash))
+    # only sent if the LevelDBAggregator doesn't have it yet
+    content_sender.save(script, script_hash)
 
     return script_hash
@@ -1,38 +1,225 @@
 import Queue
 import threading
 import traceback
+import tempfile
+import select
 import socket
+import errno
+import os
+import time
 import struct
+import marshal
 import json
 import dill
 
 #TODO - Implement a cleaner shutdown for server socket
 # see: https://stackoverflow.com/questions/1148062/python-socket-accept-blocks-prevents-app-from-quitting
 
+# Message sent through the data socket to tell an aggregator to shut down.
+# It arrives on the same queue as the data, so consumers can block on that
+# queue alone instead of polling a separate status queue. A pair ending in
+# None, since no record (a query or a content/hash pair) ends in None; check
+# for it with `is_shutdown_signal`, as json delivers it as a list.
+SHUTDOWN_SIGNAL = ('SHUTDOWN', None)
+
+# First item of a (DRAIN_SIGNAL, token) marker a producer sends through its
+# data socket after the records of a visit. The DataAggregator acknowledges
+# the token once every record sent before the marker is committed.
+DRAIN_SIGNAL = 'DRAIN'
+
+RECV_SIZE = 65536  # bytes read per recv by the server connections
+BATCH_SIZE = 65536  # bytes a batching clientsocket buffers before writing
+UNIX_PATH_MAX = 107  # longest path usable for an AF_UNIX socket
+SESSION_ID_SIZE = 16  # bytes of the random id of a reconnecting clientsocket
+
+# Socket addresses are (host, port) tuples. A Unix domain socket address is
+# (path, None), as for logging.handlers.SocketHandler in Python 3, so that
+# clients can `connect(*address)` regardless of the transport.
+
+def is_shutdown_signal(msg):
+    """ Returns True if <msg> is the SHUTDOWN_SIGNAL, in any serialization """
+    return (type(msg) in (tuple, list) and len(msg) == 2 and
+            msg[1] is None and msg[0] == SHUTDOWN_SIGNAL[0])
+
+def receive_exactly(sock, msglen):
+    """ Receives exactly <msglen> bytes from <sock> """
+    msg = bytearray(msglen)
+    view = memoryview(msg)
+    received = 0
+    while received < msglen:
+        nbytes = sock.recv_into(view[received:], msglen - received)
+        if nbytes == 0:
+            raise RuntimeError("socket connection broken")
+        received += nbytes
+    return str(msg)
+
+def get_unix_socket_path(directory, name):
+    """
+    Returns a path for the unix socket of the server <name> in <directory>,
+    unique to the calling process. Falls back to the temp directory if the
+    path is too long to be bound.
+    """
+    filename = '%s-%i.sock' % (name, os.getpid())
+    path = os.path.join(os.path.expanduser(directory), filename)
+    if len(path) > UNIX_PATH_MAX:
+        path = os.path.join(tempfile.gettempdir(), filename)
+    return path
+
+class _FrameBuffer(object):
+    """
+    Receive buffer of a server connection, reassembling the framed messages.
+
+    Data is received with recv_into into a preallocated bytearray, and the
+    frames are decoded from it in place. A frame larger than the buffer is
+    received into a buffer of its own size, so each byte is copied once from
+    the socket and once into the message, regardless of the message size.
+    """
+    def __init__(self):
+        self.buf = bytearray(RECV_SIZE)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0  # the unprocessed data is buf[start:end]
+        self.frame_size = 5  # size of the incomplete frame (or its header)
+
+    def recv(self, client):
+        """ Receives from <client> once. Returns the number of bytes received """
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > RECV_SIZE:  # release the buffer of a large frame
+                self.buf = bytearray(RECV_SIZE)
+                self.view = memoryview(self.buf)
+        if self.start + self.frame_size > len(self.buf):
+            # make room for the incomplete frame at the front of the buffer
+            size = self.end - self.start
+            if self.frame_size > len(self.buf):
+                buf = bytearray(self.frame_size)
+                buf[:size] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(self.buf)
+            else:  # copy, as the source and target may overlap
+                self.buf[:size] = self.view[self.start:self.end].tobytes()
+            self.start, self.end = 0, size
+
+        nbytes = client.recv_into(self.view[self.end:], len(self.buf) - self.end)
+        self.end += nbytes
+        return nbytes
+
+    def frames(self):
+        """ Yields (msg, serialization) for each complete frame received """
+        while self.end - self.start >= 5:
+            msglen, serialization = struct.unpack_from('>Lc', self.buf, self.start)
+            frame_size = 5 + msglen
+            if self.start + frame_size > self.end:
+                self.frame_size = frame_size
+                return
+            msg = self.view[self.start+5:self.start+frame_size].tobytes()
+            self.start += frame_size
+            yield msg, serialization
+        self.frame_size = 5
+
+class _Poller(object):
+    """ Waits for readable file descriptors, with epoll if available """
+    def __init__(self):
+        self.fds = set()
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+
+    def register(self, fd):
+        self.fds.add(fd)
+        if self.epoll is not None:
+            self.epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        self.fds.discard(fd)
+        if self.epoll is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError):
+                pass  # already closed, which removes it from the epoll set
+
+    def poll(self, timeout):
+        """ Returns the readable file descriptors """
+        if self.epoll is not None:
+            return [fd for fd, _ in self.epoll.poll(timeout)]
+        return select.select(list(self.fds), [], [], timeout)[0]
+
 class serversocket:
     """
     A server socket to recieve and process string messages
     from client sockets to a central queue
     """
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, max_queue_size=0, unix_path=None,
+                 event_loop=False, handler=None):
+        """ `max_queue_size` bounds the number of messages held in the queue.
+        Once it is reached, connection threads stop reading from their client
+        sockets until the consumer catches up, so TCP flow control slows the
+        producers down. 0 (default) means an unbounded queue.
+
+        `unix_path` additionally binds a Unix domain socket at that path,
+        which local clients can use instead of TCP loopback. The TCP socket
+        stays open for clients that can't use it (e.g. the extension).
+
+        `event_loop` handles all connections in a single thread, waiting for
+        data with epoll (select where unavailable), instead of starting a
+        thread per connection. While a bounded queue is full, it stops
+        reading from every connection.
+
+        `handler` makes this a request/response server: each message is
+        passed to `handler(msg)` and the str it returns is sent back to the
+        client (see `clientsocket.request`), instead of being queued.
+        """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.bind(('localhost', 0))
         self.sock.listen(10)  # queue a max of n connect requests
+        self.unix_path = unix_path
+        self.unix_sock = None
+        self.event_loop = event_loop
+        self.handler = handler
+        self.closed = False
+        if unix_path is not None:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            self.unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_sock.bind(unix_path)
+            self.unix_sock.listen(10)
         self.verbose = verbose
-        self.queue = Queue.Queue()
+        self.queue = Queue.Queue(max_queue_size)
+        self.max_queue_size = max_queue_size
+        self.sessions = dict()  # session id -> last batch queued (see 'b')
+
+        # queue metrics, updated by the connection threads (approximate)
+        self.high_water_mark = 0  # largest queue size since the last reset
+        self.blocked_puts = 0  # messages which had to wait for space in the queue
+        self.blocked_time = 0.0  # seconds spent waiting for space in the queue
         if self.verbose:
-            print "Server bound to: " + str(self.sock.getsockname())
+            print "Server bound to: " + str(self.get_addresses())
+
+    def get_addresses(self):
+        """
+        Returns (address, tcp_address). `address` is the address local
+        clients should use: the Unix domain socket if bound, else TCP.
+        """
+        tcp_address = self.sock.getsockname()
+        if self.unix_sock is not None:
+            return (self.unix_path, None), tcp_address
+        return tcp_address, tcp_address
 
     def start_accepting(self):
-        """ Start the listener thread """
-        thread = threading.Thread(target=self._accept, args=())
-        thread.daemon = True  # stops from blocking shutdown
-        thread.start()
+        """ Start the listener threads (or the event loop thread) """
+        if self.event_loop:
+            thread = threading.Thread(target=self._serve, args=())
+            thread.daemon = True  # stops from blocking shutdown
+            thread.start()
+            return
+        for sock in [self.sock, self.unix_sock]:
+            if sock is None:
+                continue
+            thread = threading.Thread(target=self._accept, args=(sock,))
+            thread.daemon = True  # stops from blocking shutdown
+            thread.start()
 
-    def _accept(self):
+    def _accept(self, sock):
         """ Listen for connections and pass handling to a new thread """
         while True:
-            (client, address) = self.sock.accept()
+            (client, address) = sock.accept()
             thread = threading.Thread(target=self._handle_conn, args=(client, address))
             thread.daemon = True
             thread.start()
@@ -43,74 +230,272 @@ class serversocket:
         a 4-byte integer to specify the message length and 1-byte character
         to indicate the type of serialization applied to the message.
 
+        Every frame completely received is decoded before the next recv, so
+        a batching client's write costs a single syscall here.
+
         Supported serialization formats:
             'n' : no serialization
             'd' : dill pickle
             'j' : json
+            'm' : marshal
+            'b' : acknowledged batch of frames (see `_process_batch`)
         """
         if self.verbose:
             print "Thread: " + str(threading.current_thread()) + " connected to: " + str(address)
+        frame_buffer = _FrameBuffer()
         try:
             while True:
-                msg = self.receive_msg(client, 5)
-                msglen, serialization = struct.unpack('>Lc', msg)
-                if self.verbose:
-                    print "Msglen: " + str(msglen) + " is_serialized: " + str(serialization != 'n')
-                msg = self.receive_msg(client, msglen)
-                if serialization != 'n':
-                    try:
-                        if serialization == 'd': # dill serialization
-                            msg = dill.loads(msg)
-                        elif serialization == 'j': # json serialization
-                            msg = json.loads(msg)
-                        else:
-                            print "Unrecognized serialization type: %s" % serialization
-                            continue
-                    except (UnicodeDecodeError, ValueError) as e:
-                        print "Error de-serializing message: %s \n %s" % (
-                                msg, traceback.format_exc(e))
-                        continue
-                self.queue.put(msg)
+                if frame_buffer.recv(client) == 0:
+                    raise RuntimeError("socket connection broken")
+                for msg, serialization in frame_buffer.frames():
+                    self._process_msg(msg, serialization, client)
         except RuntimeError:
             if self.verbose:
                 print "Client socket: " + str(address) + " closed"
 
+    def _serve(self):
+        """
+        Event loop accepting connections and receiving their messages in a
+        single thread. Connections are handled as in `_handle_conn`.
+        Accepted connections are still served after `close()`.
+        """
+        poller = _Poller()
+        listeners = dict()
+        for sock in [self.sock, self.unix_sock]:
+            if sock is not None:
+                listeners[sock.fileno()] = sock
+                poller.register(sock.fileno())
+        connections = dict()  # fd -> (client, address, _FrameBuffer)
+
+        while True:
+            if self.closed and listeners:
+                for fd in listeners:
+                    poller.unregister(fd)
+                listeners.clear()
+            try:
+                readable = poller.poll(1)
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] in (errno.EINTR, errno.EBADF):
+                    continue  # interrupted or a listener was closed
+                raise
+
+            for fd in readable:
+                if fd in listeners:
+                    try:
+                        (client, address) = listeners[fd].accept()
+                    except socket.error:
+                        continue
+                    if self.verbose:
+                        print "Event loop connected to: " + str(address)
+                    connections[client.fileno()] = (client, address, _FrameBuffer())
+                    poller.register(client.fileno())
+                    continue
+                if fd not in connections:
+                    continue
+                client, address, frame_buffer = connections[fd]
+                try:
+                    nbytes = frame_buffer.recv(client)
+                except socket.error as e:
+                    if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    nbytes = 0
+                if nbytes == 0:
+                    if self.verbose:
+                        print "Client socket: " + str(address) + " closed"
+                    poller.unregister(fd)
+                    del connections[fd]
+                    client.close()
+                    continue
+                for msg, serialization in frame_buffer.frames():
+                    self._process_msg(msg, serialization, client)
+
+    def _process_msg(self, msg, serialization, client):
+        """ De-serialize a message and pass it to the queue (or handler) """
+        if self.verbose:
+            print "Msglen: " + str(len(msg)) + " is_serialized: " + str(serialization != 'n')
+        if serialization == 'b':
+            self._process_batch(msg, client)
+            return
+        if serialization != 'n':
+            try:
+                if serialization == 'd': # dill serialization
+                    msg = dill.loads(msg)
+                elif serialization == 'j': # json serialization
+                    msg = json.loads(msg)
+                elif serialization == 'm': # marshal serialization
+                    msg = marshal.loads(msg)
+                else:
+                    print "Unrecognized serialization type: %s" % serialization
+                    return
+            except (UnicodeDecodeError, ValueError, EOFError, TypeError) as e:
+                print "Error de-serializing message: %s \n %s" % (
+                        msg, traceback.format_exc(e))
+                return
+        if self.handler is None:
+            self._put(msg)
+            return
+        reply = self.handler(msg)
+        try:
+            client.sendall(struct.pack('>Lc', len(reply), 'n') + reply)
+        except socket.error:
+            pass  # the client is gone, the next recv ends the connection
+
+    def _process_batch(self, msg, client):
+        """
+        Queues the frames of a batch sent by a reconnecting clientsocket and
+        acknowledges it. The batch starts with the client's session id and
+        the batch's sequence number, so a batch resent after a reconnect is
+        acknowledged again but queued only once.
+        """
+        session, seq = struct.unpack_from('>%isQ' % SESSION_ID_SIZE, msg)
+        if seq > self.sessions.get(session, 0):
+            offset = SESSION_ID_SIZE + 8
+            while offset < len(msg):
+                msglen, serialization = struct.unpack_from('>Lc', msg, offset)
+                offset += 5
+                self._process_msg(msg[offset:offset+msglen], serialization, client)
+                offset += msglen
+            self.sessions[session] = seq
+        try:
+            client.sendall(struct.pack('>LcQ', 8, 'n', seq))
+        except socket.error:
+            pass  # the client is gone, and resends the batch on reconnect
+
+    def _put(self, msg):
+        """ Put a message on the queue, blocking while a bounded queue is full """
+        try:
+            self.queue.put_nowait(msg)
+        except Queue.Full:
+            self.blocked_puts += 1
+            start_time = time.time()
+            self.queue.put(msg)
+            self.blocked_time += time.time() - start_time
+        size = self.queue.qsize()
+        if size > self.high_water_mark:
+            self.high_water_mark = size
+
+    def get_queue_stats(self, reset=False):
+        """ Returns a string describing the queue metrics (and resets them) """
+        if self.max_queue_size > 0:
+            limit = str(self.max_queue_size)
+        else:
+            limit = 'unbounded'
+        stats = ("queue high-water mark %i (limit: %s), %i blocked puts "
+                 "waiting %.1f seconds" % (self.high_water_mark, limit,
+                                           self.blocked_puts, self.blocked_time))
+        if reset:
+            self.high_water_mark = self.queue.qsize()
+            self.blocked_puts = 0
+            self.blocked_time = 0.0
+        return stats
+
     def receive_msg(self, client, msglen):
-        msg = ''
-        while len(msg) < msglen:
-            chunk = client.recv(msglen-len(msg))
-            if chunk == '':
-                raise RuntimeError("socket connection broken")
-            msg = msg + chunk
-        return msg
+        """ Receives exactly <msglen> bytes from <client> """
+        return receive_exactly(client, msglen)
 
     def close(self):
+        self.closed = True
         self.sock.close()
+        if self.unix_sock is not None:
+            self.unix_sock.close()
+            if os.path.exists(self.unix_path):
+                os.remove(self.unix_path)
 
 class clientsocket:
     """A client socket for sending messages"""
-    def __init__(self, serialization='json', verbose=False):
+    def __init__(self, serialization='json', verbose=False, batch_size=0,
+                 flush_interval=None, reconnect=False):
         """ `serialization` specifies the type of serialization to use for
         non-str messages. Supported formats:
             * 'json' uses the json module. Cross-language support. (default)
             * 'dill' uses the dill pickle module. Python only.
+            * 'marshal' uses the marshal module. Python only. Much faster
+              than dill for tuples/lists of str, unicode, int, float and None
+              (i.e. DB rows). Messages marshal can't serialize (functions,
+              class instances, str subclasses, ...) are sent with dill.
+
+        `batch_size` > 0 buffers framed messages and writes them together
+        once `batch_size` bytes are buffered, on `flush()` and on `close()`.
+        `flush_interval` additionally flushes the buffer every
+        `flush_interval` seconds from a background thread, for long-lived
+        sockets which may go idle with messages still buffered.
+
+        `reconnect` sends each write (a batch, or a single message if not
+        batching) as a numbered batch, which the server acknowledges once it
+        has queued it. If the write or its acknowledgement fails, the client
+        reconnects to the server once and resends the batch; a server that
+        already queued it only acknowledges it again. Delivery is exactly
+        once as long as the server process lives. A batch the server queued
+        just before its process died is resent to its successor, which
+        receives it a second time. `request` is never resent.
         """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if serialization != 'json' and serialization != 'dill':
+        if serialization not in ('json', 'dill', 'marshal'):
             raise ValueError("Unsupported serialization type: %s" % serialization)
         self.serialization = serialization
         self.verbose = verbose
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reconnect = reconnect
+        self.session = os.urandom(SESSION_ID_SIZE)
+        self.seq = 0  # number of the last batch sent
+        self.address = None
+        self._flush_thread = None
+        self._buffer = list()
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
 
     def connect(self, host, port):
-        if self.verbose: print "Connecting to: %s:%i" % (host, port)
-        self.sock.connect((host, port))
+        """ Connects to (host, port), or to the Unix domain socket at `host`
+        if `port` is None """
+        if self.verbose: print "Connecting to: %s:%s" % (host, port)
+        if self.address is not None:  # reconnecting
+            self.sock.close()
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.address = (host, port)
+        if port is None:
+            self.sock.close()
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(host)
+        else:
+            self.sock.connect((host, port))
+        if (self.batch_size > 0 and self.flush_interval is not None and
+                self._flush_thread is None):
+            self._flush_thread = threading.Thread(target=self._flush_periodically, args=())
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
 
     def send(self, msg):
         """
         Sends an arbitrary python object to the connected socket. Serializes
-        using dill if not str, and prepends msg len (4-bytes) and
-        serialization type (1-byte).
+        using the chosen serialization if not str, and prepends msg len
+        (4-bytes) and serialization type (1-byte).
         """
+        msg = self._frame(msg)
+        if self.batch_size <= 0:
+            self._send_bytes(msg)
+            return
+        with self._lock:
+            self._buffer.append(msg)
+            self._buffered += len(msg)
+            if self._buffered >= self.batch_size:
+                self._flush_buffer()
+
+    def request(self, msg):
+        """
+        Sends <msg> to a request/response server (see `serversocket`) and
+        returns the str it replies with. Such a server answers every message,
+        so use only `request` to talk to it.
+        """
+        msg = self._frame(msg)
+        with self._lock:
+            self._send_all(msg)
+            msglen, _ = struct.unpack('>Lc', receive_exactly(self.sock, 5))
+            return receive_exactly(self.sock, msglen)
+
+    def _frame(self, msg):
+        """ Serializes <msg> and prepends the frame header """
         #if input not string, serialize to string
         if type(msg) is not str:
             if self.serialization == 'dill':
@@ -119,6 +504,13 @@ class clientsocket:
             elif self.serialization == 'json':
                 msg = json.dumps(msg)
                 serialization = 'j'
+            elif self.serialization == 'marshal':
+                try:
+                    msg = marshal.dumps(msg, 2)
+                    serialization = 'm'
+                except ValueError:  # unmarshallable object
+                    msg = dill.dumps(msg)
+                    serialization = 'd'
             else:
                 raise ValueError("Unsupported serialization type set: %s" % serialization)
         else:
@@ -127,16 +519,68 @@ class clientsocket:
         if self.verbose: print "Sending message with serialization %s" % serialization
 
         #prepend with message length
-        msg = struct.pack('>Lc', len(msg), serialization) + msg
+        return struct.pack('>Lc', len(msg), serialization) + msg
+
+    def flush(self):
+        """ Write out all buffered messages """
+        with self._lock:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        """ Writes the buffer to the socket. Caller must hold `_lock` """
+        if self._buffered == 0:
+            return
+        msg = ''.join(self._buffer)
+        self._buffer = list()
+        self._buffered = 0
+        self._send_bytes(msg)
+
+    def _flush_periodically(self):
+        """ Timer thread flushing the buffer until the socket is closed """
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (socket.error, RuntimeError):
+                # the socket is broken, the next send or close will raise
+                return
+
+    def _send_bytes(self, msg):
+        if not self.reconnect:
+            self._send_all(msg)
+            return
+        self.seq += 1
+        batch = self.session + struct.pack('>Q', self.seq) + msg
+        batch = struct.pack('>Lc', len(batch), 'b') + batch
+        try:
+            self._send_batch(batch)
+        except (socket.error, RuntimeError):
+            if self.verbose: print "Reconnecting to: %s:%s" % self.address
+            self.connect(*self.address)
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        """ Writes a batch and waits until the server acknowledges it """
+        self._send_all(batch)
+        msglen, _ = struct.unpack('>Lc', receive_exactly(self.sock, 5))
+        seq, = struct.unpack('>Q', receive_exactly(self.sock, msglen))
+        if seq != self.seq:
+            raise RuntimeError("batch %i acknowledged as %i" % (self.seq, seq))
+
+    def _send_all(self, msg):
+        view = memoryview(msg)  # slicing a memoryview doesn't copy
         totalsent = 0
         while totalsent < len(msg):
-            sent = self.sock.send(msg[totalsent:])
+            sent = self.sock.send(view[totalsent:])
             if sent == 0:
                 raise RuntimeError("socket connection broken")
             totalsent = totalsent + sent
 
     def close(self):
-        self.sock.close()
+        self._closed.set()
+        try:
+            self.flush()
+        finally:
+            self.sock.close()
 
 if __name__ == '__main__':
     import sys
@@ -1,18 +1,25 @@
-from BrowserManager import Browser
+from BrowserManager import Browser, DRAIN_TIMEOUT
 from DataAggregator import DataAggregator, LevelDBAggregator
-from SocketInterface import clientsocket
+from SocketInterface import clientsocket, SHUTDOWN_SIGNAL
 from Errors import CommandExecutionError
 from utilities.platform_utils import get_version, get_configuration_string
+from utilities.db_utils import apply_sqlite_profile
+from utilities.build_indexes import build_indexes
+from utilities.merge_shards import get_shard_path, merge_shards
 import CommandSequence
 import MPLogger
 
 from multiprocess import Process, Queue
 from Queue import Empty as EmptyQueue
+from Queue import Queue as WorkQueue
 from tblib import pickling_support
 pickling_support.install()
 from six import reraise
+import traceback
 import cPickle
 import threading
+import weakref
+import sys
 import copy
 import os
 import sqlite3
@@ -20,9 +27,98 @@ import time
 import json
 import psutil
 
-SLEEP_CONS = 0.1  # command sleep constant (in seconds)
 BROWSER_MEMORY_LIMIT = 1500 # in MB
 
+
+class StartBarrier(object):
+    """
+    Blocks the command threads running a synchronized command sequence
+    until all <num_browsers> of them have reached it
+    """
+    def __init__(self, num_browsers):
+        self.condition = threading.Condition()
+        self.remaining = num_browsers
+        self.arrived = set()
+
+    def _arrive(self):
+        """ counts the calling thread once; <self.condition> must be held """
+        thread = threading.current_thread()
+        if thread in self.arrived:
+            return
+        self.arrived.add(thread)
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.condition.notifyAll()
+
+    def wait(self):
+        with self.condition:
+            self._arrive()
+            while self.remaining > 0:
+                self.condition.wait()
+
+    def leave(self):
+        """
+        counts the calling thread without waiting for the others, for a
+        command thread that skips or fails the sequence before reaching
+        the barrier. Does nothing if the thread already arrived
+        """
+        with self.condition:
+            self._arrive()
+
+
+class CommandSequenceFuture(object):
+    """
+    Outcome of a command sequence queued for a browser. `visit_id` is set
+    once a browser starts the sequence
+    """
+    def __init__(self, command_sequence):
+        self.command_sequence = command_sequence
+        self.visit_id = None
+        self._succeeded = None
+        self._done = threading.Event()
+
+    def set_result(self, succeeded):
+        self._succeeded = succeeded
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Blocks until the sequence has run (or <timeout> seconds have passed)
+        Returns True if all of its commands succeeded, False if one failed
+        or the sequence was skipped because the TaskManager was closing, and
+        None on timeout
+        """
+        if not self._done.wait(timeout):
+            return None
+        return self._succeeded
+
+
+class SubmittedFutures(object):
+    """
+    Iterator over the CommandSequenceFutures of a `submit_many` call, in the
+    order of the submitted sequences. The futures are queued here as the
+    sequences are submitted; the submitting thread only holds a weak
+    reference, so futures of an iterator that was dropped are not kept
+    """
+    def __init__(self):
+        self.queue = WorkQueue()
+        self.exc_info = None  # raised once the futures are consumed
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        future = self.queue.get()
+        if future is None:
+            self.queue.put(None)  # any further call also stops
+            if self.exc_info is not None:
+                reraise(*self.exc_info)
+            raise StopIteration
+        return future
+
 def load_default_params(num_browsers=1):
     """
     Loads num_browsers copies of the default browser_params dictionary.
@@ -81,6 +177,7 @@ class TaskManager:
         self.closing = False
         self.failure_status = None
         self.threadlock = threading.Lock()
+        self.browser_freed = threading.Condition()  # notified as command threads finish
         self.failurecount = 0
         if manager_params['failure_limit'] is not None:
             self.failure_limit = manager_params['failure_limit']
@@ -94,6 +191,7 @@ class TaskManager:
         if not os.path.exists(manager_params['data_directory']):
             os.mkdir(manager_params['data_directory'])
         self.db = sqlite3.connect(db_path)
+        apply_sqlite_profile(self.db, manager_params['sqlite_profile'])
         with open(os.path.join(os.path.dirname(__file__), 'schema.sql'), 'r') as f:
             self.db.executescript(f.read())
         self.db.commit()
@@ -101,8 +199,9 @@ class TaskManager:
         # sets up logging server + connect a client
         self.logging_status_queue = None
         self.loggingserver = self._launch_loggingserver()
-        # socket location: (address, port)
-        self.manager_params['logger_address'] = self.logging_status_queue.get()
+        # socket locations: (address, port) for local clients and over tcp
+        (self.manager_params['logger_address'],
+         self.manager_params['logger_tcp_address']) = self.logging_status_queue.get()
         self.logger = MPLogger.loggingclient(*self.manager_params['logger_address'])
 
         # Mark if LDBAggregator is needed (if js is enabled on any browser)
@@ -116,11 +215,16 @@ class TaskManager:
         self._launch_aggregators()
 
         # open client socket
-        self.sock = clientsocket(serialization='dill')
+        self.sock = clientsocket(serialization='marshal')
         self.sock.connect(*self.manager_params['aggregator_address'])
 
         self._save_configuration(browser_params)
 
+        # one DataAggregator per browser (if sharded), launched once crawl_ids are known
+        self.shard_aggregators = list()
+        if self.manager_params['sharded_aggregators']:
+            self._launch_shard_aggregators(browser_params)
+
         # read the last used site visit id
         cur = self.db.cursor()
         cur.execute("SELECT MAX(visit_id) from site_visits")
@@ -131,6 +235,7 @@ class TaskManager:
 
         # sets up the BrowserManager(s) + associated queues
         self.browsers = self._initialize_browsers(browser_params)  # List of the Browser(s)
+        self._start_command_threads()
         self._launch_browsers()
 
         # start the manager watchdog
@@ -169,7 +274,14 @@ class TaskManager:
         """ initialize the browser classes, each its unique set of parameters """
         browsers = list()
         for i in xrange(self.num_browsers):
-            browsers.append(Browser(self.manager_params, browser_params[i]))
+            manager_params = self.manager_params
+            if self.shard_aggregators:
+                # send the data of this browser to its own shard
+                manager_params = dict(self.manager_params)
+                manager_params['aggregator_address'] = self.shard_aggregators[i]['address']
+                manager_params['aggregator_tcp_address'] = self.shard_aggregators[i]['tcp_address']
+                manager_params['aggregator_drain_address'] = self.shard_aggregators[i]['drain_address']
+            browsers.append(Browser(manager_params, browser_params[i]))
 
         return browsers
 
@@ -199,9 +311,12 @@ class TaskManager:
         Periodically checks the following:
         - memory consumption of all browsers every 10 seconds
         - presence of processes that are no longer in use
+        - the number of command sequences queued for each browser
         """
         while not self.closing:
             time.sleep(10)
+            self.logger.debug("Command sequences queued or running per browser: %s" %
+                              self.get_backlog())
 
             # Check browser memory usage
             for browser in self.browsers:
@@ -247,7 +362,11 @@ class TaskManager:
                              args=(self.manager_params, self.aggregator_status_queue))
         self.data_aggregator.daemon = True
         self.data_aggregator.start()
-        self.manager_params['aggregator_address'] = self.aggregator_status_queue.get()  # socket location: (address, port)
+        # socket locations: (address, port) for local clients and over tcp
+        (self.manager_params['aggregator_address'],
+         self.manager_params['aggregator_tcp_address']) = self.aggregator_status_queue.get()
+        # queried by browsers to wait until the records of a visit are committed
+        self.manager_params['aggregator_drain_address'] = self.aggregator_status_queue.get()[0]
 
         # LevelDB Aggregator
         if self.ldb_enabled:
@@ -256,13 +375,70 @@ class TaskManager:
                                  args=(self.manager_params, self.ldb_status_queue))
             self.ldb_aggregator.daemon = True
             self.ldb_aggregator.start()
-            self.manager_params['ldb_address'] = self.ldb_status_queue.get()  # socket location: (address, port)
+            (self.manager_params['ldb_address'],
+             self.manager_params['ldb_tcp_address']) = self.ldb_status_queue.get()
+            # queried by producers before sending content
+            (self.manager_params['ldb_query_address'],
+             self.manager_params['ldb_query_tcp_address']) = self.ldb_status_queue.get()
+
+    def _launch_shard_aggregators(self, browser_params):
+        """
+        Launches one DataAggregator per browser, each writing to its own shard
+        of the crawl database. The shards are merged into the crawl database
+        when the TaskManager shuts down.
+        """
+        with open(os.path.join(os.path.dirname(__file__), 'schema.sql'), 'r') as f:
+            schema = f.read()
+        for params in browser_params:
+            shard_path = get_shard_path(self.manager_params['database_name'],
+                                        params['crawl_id'])
+            db = sqlite3.connect(shard_path)
+            db.executescript(schema)
+            db.commit()
+            db.close()
+
+            shard_params = dict(self.manager_params)
+            shard_params['database_name'] = shard_path
+            status_queue = Queue()
+            aggregator = Process(target=DataAggregator.DataAggregator,
+                                 args=(shard_params, status_queue))
+            aggregator.daemon = True
+            aggregator.start()
+            address, tcp_address = status_queue.get()  # socket locations
+            drain_address = status_queue.get()[0]
+            self.shard_aggregators.append({
+                'crawl_id': params['crawl_id'],
+                'database_name': shard_path,
+                'process': aggregator,
+                'address': address,
+                'tcp_address': tcp_address,
+                'drain_address': drain_address
+            })
+
+    def _kill_shard_aggregators(self):
+        """ Terminates the shard aggregators and merges their shards """
+        for shard in self.shard_aggregators:
+            self.logger.debug("Telling the DataAggregator of shard %i to shut down..." % shard['crawl_id'])
+            self._send_shutdown_signal(shard['address'])
+        for shard in self.shard_aggregators:
+            shard['process'].join(300)
+
+        start_time = time.time()
+        shards = [shard['database_name'] for shard in self.shard_aggregators]
+        num_rows, merged = merge_shards(self.manager_params['database_name'],
+                                        shards, logger=self.logger)
+        for shard in merged:
+            os.remove(shard)
+        for shard in set(shards) - set(merged):
+            self.logger.error("Kept shard %s, which did not fully merge" % shard)
+        self.logger.debug("Merged %i rows from %i shards in %f seconds" % (
+            num_rows, len(merged), time.time() - start_time))
 
     def _kill_aggregators(self):
         """ Terminates the aggregators gracefully """
         # DataAggregator
         self.logger.debug("Telling the DataAggregator to shut down...")
-        self.aggregator_status_queue.put("DIE")
+        self._send_shutdown_signal(self.manager_params['aggregator_address'])
         start_time = time.time()
         self.data_aggregator.join(300)
         self.logger.debug("DataAggregator took " + str(time.time() - start_time) + " seconds to close")
@@ -270,16 +446,31 @@ class TaskManager:
         # LevelDB Aggregator
         if self.ldb_enabled:
             self.logger.debug("Telling the LevelDBAggregator to shut down...")
-            self.ldb_status_queue.put("DIE")
+            self._send_shutdown_signal(self.manager_params['ldb_address'])
             start_time = time.time()
             self.ldb_aggregator.join(300)
             self.logger.debug("LevelDBAggregator took " + str(time.time() - start_time) + " seconds to close")
 
+        # Shard aggregators
+        if self.shard_aggregators:
+            self._kill_shard_aggregators()
+
+    def _send_shutdown_signal(self, address):
+        """ Sends the shutdown signal through the aggregator's data socket """
+        sock = clientsocket()
+        sock.connect(*address)
+        sock.send(SHUTDOWN_SIGNAL)
+        sock.close()
+
     def _launch_loggingserver(self):
         """ sets up logging server """
         self.logging_status_queue = Queue()
+        unix_socket_dir = None
+        if self.manager_params['unix_sockets']:
+            unix_socket_dir = self.manager_params['data_directory']
         loggingserver = Process(target=MPLogger.loggingserver,
-                             args=(self.manager_params['log_file'], self.logging_status_queue, ))
+                             args=(self.manager_params['log_file'], self.logging_status_queue,
+                                   unix_socket_dir))
         loggingserver.daemon = True
         loggingserver.start()
         return loggingserver
@@ -297,8 +488,16 @@ class TaskManager:
         <during_init> flag to indicator if this shutdown is occuring during the TaskManager initialization
         """
         self.closing = True
+        # feeders stop once their pending put returns, and the submit thread
+        # fails the sequences left in the queue, so every future is resolved
+        # before the submit thread is stopped
+        for thread in self.feeder_threads:
+            thread.join()
+        self.submit_queue.put(None)  # stops the thread handing out submitted sequences
+        self.submit_thread.join()
 
         for browser in self.browsers:
+            browser.work_queue.put(None)  # stops the command thread
             browser.shutdown_browser(during_init)
             if failure:
                 self.sock.send(("UPDATE crawl SET finished = -1 WHERE crawl_id = ?",
@@ -310,6 +509,14 @@ class TaskManager:
         self.db.close()  # close db connection
         self.sock.close()  # close socket to data aggregator
         self._kill_aggregators()
+
+        # indexes are only built after ingest to keep inserts fast during the
+        # crawl, and before the logging server stops so that the time is logged
+        if not failure and self.manager_params['build_indexes']:
+            start_time = time.time()
+            build_indexes(self.manager_params['database_name'])
+            self.logger.info("Built crawl database indexes in %.1f seconds" %
+                             (time.time() - start_time))
         self._kill_loggingserver()
 
     def _cleanup_before_fail(self, during_init=False):
@@ -351,100 +558,220 @@ class TaskManager:
 
     def _distribute_command(self, command_sequence, index=None):
         """
-        parses command type and issues command(s) to the proper browser
+        parses command type and queues command(s) for the proper browser
         <index> specifies the type of command this is:
         = None  -> first come, first serve
         =  #    -> index of browser to send command to
         = *     -> sends command to all browsers
         = **    -> sends command to all browsers (synchronized)
+        Only first come, first serve waits for a browser to be ready; the
+        other types are queued behind the browsers' current work
         """
+        start_barrier = None
         if index is None:
-            #send to first browser available
-            command_executed = False
-            while True:
-                for browser in self.browsers:
-                    if browser.ready():
-                        browser.current_timeout = command_sequence.total_timeout
-                        thread = self._start_thread(browser, command_sequence)
-                        command_executed = True
-                        break
-                if command_executed:
-                    break
-                time.sleep(SLEEP_CONS)
-
+            #send to first browser available, which _queue_command claims
+            browsers = [None]
         elif 0 <= index < len(self.browsers):
             #send the command to this specific browser
-            while True:
-                if self.browsers[index].ready():
-                    self.browsers[index].current_timeout = command_sequence.total_timeout
-                    thread = self._start_thread(self.browsers[index], command_sequence)
-                    break
-                time.sleep(SLEEP_CONS)
+            browsers = [self.browsers[index]]
         elif index == '*':
             #send the command to all browsers
-            command_executed = [False] * len(self.browsers)
-            while False in command_executed:
-                for i in xrange(len(self.browsers)):
-                    if self.browsers[i].ready() and not command_executed[i]:
-                        self.browsers[i].current_timeout = command_sequence.total_timeout
-                        thread = self._start_thread(self.browsers[i], command_sequence)
-                        command_executed[i] = True
-                time.sleep(SLEEP_CONS)
+            browsers = self.browsers
         elif index == '**':
             #send the command to all browsers and sync it
-            condition = threading.Condition()  # Used to block threads until ready
-            command_executed = [False] * len(self.browsers)
-            while False in command_executed:
-                for i in xrange(len(self.browsers)):
-                    if self.browsers[i].ready() and not command_executed[i]:
-                        self.browsers[i].current_timeout = command_sequence.total_timeout
-                        thread = self._start_thread(self.browsers[i], command_sequence, condition)
-                        command_executed[i] = True
-                time.sleep(SLEEP_CONS)
-            with condition:
-                condition.notifyAll()  # All browsers loaded, tell them to start
+            browsers = self.browsers
+            start_barrier = StartBarrier(len(browsers))
         else:
             self.logger.info("Command index type is not supported or out of range")
             return
 
+        futures = list()
+        for browser in browsers:
+            future = self._queue_command(browser, command_sequence, start_barrier)
+            if future is None:
+                return
+            futures.append(future)
+
         if command_sequence.blocking:
-            thread.join()
+            for future in futures:
+                future.result()
             self._check_failure_status()
 
-    def _start_thread(self, browser, command_sequence, condition=None):
-        """  starts the command execution thread """
+    def _claim_ready_browser(self, browsers):
+        """
+        blocks until one of <browsers> is ready and returns it, counting the
+        command sequence about to be queued for it. The browser is chosen
+        and claimed under <self.browser_freed>, so concurrent callers never
+        claim the same free browser. Command threads notify it when they
+        finish a command sequence, so a free browser is handed its next
+        command immediately
+        """
+        with self.browser_freed:
+            while True:
+                for browser in browsers:
+                    if browser.ready():
+                        browser.num_pending += 1
+                        return browser
+                self.browser_freed.wait()
+
+    def _claim_browser(self, browser):
+        """ counts a command sequence about to be queued for <browser> """
+        with self.browser_freed:
+            browser.num_pending += 1
 
-        # Check status flags before starting thread
+    def _queue_command(self, browser, command_sequence, start_barrier=None):
+        """
+        queues the command sequence for the command thread of <browser>, or
+        of the first browser to be ready if <browser> is None
+        returns its CommandSequenceFuture
+        """
+        # Check status flags before queueing the command sequence
         if self.closing:
             self.logger.error("Attempted to execute command on a closed TaskManager")
             return
         self._check_failure_status()
 
-        browser.set_visit_id(self.next_visit_id)
-        self.sock.send(("INSERT INTO site_visits (visit_id, crawl_id, site_url) VALUES (?,?,?)",
-                        (self.next_visit_id, browser.crawl_id, command_sequence.url)))
-        self.next_visit_id += 1
+        future = CommandSequenceFuture(command_sequence)
+        if browser is None:
+            browser = self._claim_ready_browser(self.browsers)
+        else:
+            self._claim_browser(browser)
+        self._put_command(browser, command_sequence, start_barrier, future)
+        return future
 
-        # Start command execution thread
-        args = (browser, command_sequence, condition)
-        thread = threading.Thread(target=self._issue_command, args=args)
-        browser.command_thread = thread
-        thread.daemon = True
-        thread.start()
-        return thread
+    def _put_command(self, browser, command_sequence, start_barrier, future):
+        """
+        adds the command sequence to the work queue of <browser>, which the
+        caller has claimed
+        """
+        browser.work_queue.put((command_sequence, start_barrier, future))
 
-    def _issue_command(self, browser, command_sequence, condition=None):
+    def _start_command_threads(self):
+        """
+        starts one long-lived command thread per browser, and the thread
+        handing the sequences passed to `submit_many` to free browsers
+        """
+        self.submit_queue = WorkQueue(self.manager_params['submit_queue_size'])
+        self.feeder_threads = list()
+        self.submit_thread = threading.Thread(target=self._run_submit_thread, args=())
+        self.submit_thread.daemon = True
+        self.submit_thread.start()
+        for browser in self.browsers:
+            browser.work_queue = WorkQueue()
+            thread = threading.Thread(target=self._run_command_thread,
+                                      args=(browser,))
+            browser.command_thread = thread
+            thread.daemon = True
+            thread.start()
+
+    def _run_command_thread(self, browser):
+        """
+        runs the command sequences queued for <browser> one at a time until
+        it receives None. Sequences queued after the TaskManager started
+        closing (or failing) are skipped
+        """
+        while True:
+            item = browser.work_queue.get()
+            if item is None:
+                browser.work_queue.task_done()
+                return
+            command_sequence, start_barrier, future = item
+            succeeded = False
+            try:
+                if self.closing or self.failure_status:
+                    continue
+                future.visit_id = self._start_visit(browser, command_sequence)
+                succeeded = self._issue_command(browser, command_sequence,
+                                                start_barrier)
+            except Exception:
+                self.logger.error("BROWSER %i: Exception in command thread\n%s" % (
+                    browser.crawl_id, traceback.format_exc()))
+            finally:
+                # the other browsers of a synchronized sequence must not wait
+                # for one that never reached the barrier
+                if start_barrier is not None:
+                    start_barrier.leave()
+                with self.browser_freed:
+                    browser.num_pending -= 1
+                    self.browser_freed.notifyAll()
+                future.set_result(succeeded)
+                browser.work_queue.task_done()
+
+    def _run_submit_thread(self):
+        """
+        hands the sequences of the submit queue, in order, to whichever
+        browser is ready first, until it receives None
+        """
+        while True:
+            item = self.submit_queue.get()
+            if item is None:
+                self.submit_queue.task_done()
+                return
+            command_sequence, future = item
+            try:
+                if self.closing or self.failure_status:
+                    future.set_result(False)
+                    continue
+                browser = self._claim_ready_browser(self.browsers)
+                self._put_command(browser, command_sequence, None, future)
+            finally:
+                self.submit_queue.task_done()
+
+    def _feed_submit_queue(self, command_sequences, futures_ref):
+        """
+        moves the sequences of the iterable <command_sequences> to the
+        bounded submit queue, blocking while it is full, so the iterable is
+        only consumed as fast as the browsers run the sequences
+        """
+        futures = None
+        try:
+            for command_sequence in command_sequences:
+                if self.closing or self.failure_status:
+                    break
+                future = CommandSequenceFuture(command_sequence)
+                self.submit_queue.put((command_sequence, future))
+                futures = futures_ref()
+                if futures is not None:
+                    futures.queue.put(future)
+                futures = None
+        except Exception:
+            self.logger.error("Exception while reading the sequences passed "
+                              "to submit_many\n%s" % traceback.format_exc())
+            futures = futures_ref()
+            if futures is not None:
+                futures.exc_info = sys.exc_info()
+        finally:
+            futures = futures_ref()
+            if futures is not None:
+                futures.queue.put(None)
+
+    def _start_visit(self, browser, command_sequence):
+        """
+        assigns the next visit id to <browser> and records the site visit
+        returns the visit id
+        """
+        with self.threadlock:
+            visit_id = self.next_visit_id
+            self.next_visit_id += 1
+        browser.set_visit_id(visit_id)
+        browser.current_timeout = command_sequence.total_timeout
+        self.sock.send(("INSERT INTO site_visits (visit_id, crawl_id, site_url) VALUES (?,?,?)",
+                        (visit_id, browser.crawl_id, command_sequence.url)))
+        return visit_id
+
+    def _issue_command(self, browser, command_sequence, start_barrier=None):
         """
         sends command tuple to the BrowserManager
+        returns True if all commands of the sequence succeeded
         """
         browser.is_fresh = False  # since we are issuing a command, the BrowserManager is no longer a fresh instance
 
-        # if this is a synced call, block on condition
-        if condition is not None:
-            with condition:
-                condition.wait()
+        # if this is a synced call, block until all browsers are loaded
+        if start_barrier is not None:
+            start_barrier.wait()
 
         reset = command_sequence.reset
+        sequence_succeeded = True
         start_time = None  # tracks when a site visit started, so that flash/profile
                            # cookies can be properly tracked.
         for command_and_timeout in command_sequence.commands_with_timeout:
@@ -475,7 +802,7 @@ class TaskManager:
                         'CommandSequence': command_sequence,
                         'Exception': status[1]
                     }
-                    return
+                    return False
                 else:
                     command_succeeded = 0
                     self.logger.info("BROWSER %i: Received failure status while"
@@ -490,6 +817,7 @@ class TaskManager:
                             (browser.crawl_id, command[0], command_arguments, command_succeeded)))
 
             if command_succeeded != 1:
+                sequence_succeeded = False
                 with self.threadlock:
                     self.failurecount += 1
                 if self.failurecount > self.failure_limit:
@@ -500,7 +828,7 @@ class TaskManager:
                         'ErrorType': 'ExceedCommandFailureLimit',
                         'CommandSequence': command_sequence
                     }
-                    return
+                    return False
                 browser.restart_required = True
             else:
                 with self.threadlock:
@@ -509,12 +837,13 @@ class TaskManager:
             if browser.restart_required:
                 break
 
-        # Sleep after executing CommandSequence to provide extra time for
-        # internal buffers to drain. Stopgap in support of #135
-        time.sleep(2)
+        # Wait until the records of this visit are committed, so that they
+        # are neither lost in a restart nor interleaved with the next visit
+        if not browser.restart_required:
+            self._drain_visit(browser)
 
         if self.closing:
-            return
+            return sequence_succeeded
 
         if browser.restart_required or reset:
             success = browser.restart_browser_manager(clear_profile = reset)
@@ -526,12 +855,68 @@ class TaskManager:
                     'ErrorType': 'ExceedLaunchFailureLimit',
                     'CommandSequence': command_sequence
                 }
-                return
+                return False
             browser.restart_required = False
+        return sequence_succeeded
+
+    def _drain_visit(self, browser):
+        """
+        Asks the BrowserManager to wait for the DataAggregator to acknowledge
+        the records of the current visit sent by the BrowserManager, proxy and
+        extension (see BrowserManager.drain_visit). A BrowserManager which
+        does not answer in time is restarted, so that its late answer is not
+        taken for the status of the next command
+        """
+        start_time = time.time()
+        browser.command_queue.put(('DRAIN', browser.curr_visit_id))
+        try:
+            status = browser.status_queue.get(True, DRAIN_TIMEOUT + 10)
+        except EmptyQueue:
+            status = None
+        if status != "OK":
+            self.logger.info("BROWSER %i: Failed to drain the records of visit "
+                             "%i, restarting browser manager" % (
+                                 browser.crawl_id, browser.curr_visit_id))
+            browser.restart_required = True
+            return
+        self.logger.debug("BROWSER %i: Drained the records of visit %i in "
+                          "%.3f seconds" % (browser.crawl_id,
+                                            browser.curr_visit_id,
+                                            time.time() - start_time))
+
+    def get_backlog(self):
+        """ returns {crawl_id: number of command sequences queued or running} """
+        return dict((browser.crawl_id, browser.num_pending)
+                    for browser in self.browsers)
 
     def execute_command_sequence(self, command_sequence, index=None):
         self._distribute_command(command_sequence, index)
 
+    def submit_many(self, command_sequences):
+        """
+        Submits every CommandSequence of the iterable <command_sequences>
+        first come, first serve, and returns at once. The iterable may be a
+        generator: sequences are taken from it in the background as the
+        bounded submit queue (manager_params['submit_queue_size']) has
+        room, so a long site list is never held in memory as a whole.
+        Returns an iterator over a CommandSequenceFuture per sequence, in
+        order, which is empty if the TaskManager is closed. close() waits
+        for all submitted sequences to run.
+        """
+        futures = SubmittedFutures()
+        if self.closing:
+            self.logger.error("Attempted to execute command on a closed TaskManager")
+            futures.queue.put(None)
+            return futures
+        self._check_failure_status()
+
+        thread = threading.Thread(target=self._feed_submit_queue,
+                                  args=(command_sequences, weakref.ref(futures)))
+        thread.daemon = True
+        self.feeder_threads.append(thread)
+        thread.start()
+        return futures
+
     # DEFINITIONS OF HIGH LEVEL COMMANDS
     # NOTE: These wrappers are provided for convenience. To issue sequential
     # commands to the same browser in a single 'visit', use the CommandSequence
@@ -559,4 +944,13 @@ class TaskManager:
         if self.closing:
             self.logger.error("TaskManager already closed")
             return
+        # runs the rest of the sequences passed to submit_many, and the
+        # command sequences still queued for the browsers
+        for thread in self.feeder_threads:
+            thread.join()
+        self.submit_queue.join()
+        for browser in self.browsers:
+            browser.work_queue.join()
+        # sequences passed to submit_many only report a failure here
+        self._check_failure_status()
         self._shutdown_manager()
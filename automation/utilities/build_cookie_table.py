@@ -1,9 +1,15 @@
+from collections import OrderedDict
 from urlparse import urlparse
+from functools import wraps
+from datetime import datetime
 from netlib.odict import ODictCaseless
+from multiprocess import Pool, cpu_count
+import itertools
 import sqlite3
 import json
 import time
 import os
+import re
 
 # This should be the modified Cookie.py included
 # the standard lib Cookie.py has many bugs
@@ -29,25 +35,98 @@ def encode_to_unicode(string):
             encoded = unicode(string, 'UTF-8', errors='ignore')
     return encoded
 
+# RFC 1123 dates (and the dashed form of RFC 850) as sent by nearly all
+# servers, parsed without strptime. Years before 1900 take the strptime path.
+RFC1123_RE = re.compile(r'^(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), (\d{1,2})[ -]'
+                        r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[ -]'
+                        r'(19\d\d|[2-9]\d{3}) (\d{2}):(\d{2}):(\d{2}) GMT$',
+                        re.IGNORECASE)
+MONTHS = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+          'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+
+DATE_CACHE_SIZE = 10000  # distinct expires strings kept by select_date_format
+
+def lru_cache(maxsize):
+    """
+    Memoizes a function of one hashable argument, evicting the least
+    recently used result once <maxsize> results are cached
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(arg):
+            cache = wrapper.cache
+            try:
+                result = cache.pop(arg)
+                wrapper.hits += 1
+            except KeyError:
+                result = function(arg)
+                wrapper.misses += 1
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[arg] = result
+            return result
+        wrapper.cache = OrderedDict()
+        wrapper.hits = 0
+        wrapper.misses = 0
+        wrapper.uncached = function
+        return wrapper
+    return decorator
+
+def parse_rfc1123_date(date_string):
+    """
+    Fast path for RFC 1123 dates. Returns None if <date_string> is not
+    one, or is not a valid date, in which case strptime decides
+    """
+    match = RFC1123_RE.match(date_string)
+    if match is None:
+        return None
+    day, month, year, hour, minute, second = match.groups()
+    try:
+        date = datetime(int(year), MONTHS[month.lower()], int(day),
+                        int(hour), int(minute), int(second))
+    except ValueError:
+        return None
+    return "%04d-%02d-%02d %02d:%02d:%02d" % (date.year, date.month, date.day,
+                                              date.hour, date.minute,
+                                              date.second)
+
+def parse_date(date_string):
+    """
+    Tries the format that matched last before the rest of DATE_FORMATS.
+    The formats are mutually exclusive, so the order does not change results
+    """
+    last_format = parse_date.last_format
+    try:
+        return time.strptime(date_string, last_format)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        if date_format == last_format:
+            continue
+        try:
+            time_obj = time.strptime(date_string, date_format)
+        except ValueError:
+            continue
+        parse_date.last_format = date_format
+        return time_obj
+    return None
+parse_date.last_format = DATE_FORMATS[0]
+
+@lru_cache(DATE_CACHE_SIZE)
 def select_date_format(date_string):
     """ Try different formats for date and output a standard form accepted by sqlite3 """
     if date_string == '' or date_string == '0':
         return None
+    date = parse_rfc1123_date(date_string)
+    if date is not None:
+        return date
+
+    time_obj = parse_date(date_string)
+    # time.strftime() doesn't work for years < 1900
+    if time_obj is not None and time_obj.tm_year >= 1900:
+        return time.strftime("%Y-%m-%d %H:%M:%S", time_obj)
     else:
-        for date_format in DATE_FORMATS:
-            try:
-                time_obj = time.strptime(date_string, date_format)
-                break
-            except ValueError:
-                if date_format == DATE_FORMATS[len(DATE_FORMATS)-1]:
-                    return None
-                pass
-
-        # time.strftime() doesn't work for years < 1900
-        if time_obj.tm_year >= 1900:
-            return time.strftime("%Y-%m-%d %H:%M:%S", time_obj)
-        else:
-            return None
+        return None
 
 def get_path(path_string, url):
     """ Parse path. Defaults to the path of the request URL that generated the
@@ -129,11 +208,105 @@ def parse_cookies(cookie_string, verbose, url = None, response_cookie = False):
         pass
     return queries
 
-def build_http_cookie_table(database, verbose=False):
-    """ Extracts all http-cookie data from HTTP headers and generates a new table """
+def load_header(header_str):
+    """ Loads a header stored by the proxy into an ODictCaseless """
+    header = ODictCaseless()
+    try:
+        header.load_state(json.loads(header_str))
+    except ValueError: #XXX temporary shim -- should be removed
+        header.load_state(eval(header_str))
+    return header
+
+def parse_request_cookie_rows(rows, verbose=False):
+    """
+    Parses rows of (id, crawl_id, headers, time_stamp) from http_requests_proxy
+    into rows of http_request_cookies
+    """
+    cookies = list()
+    for req_id, crawl_id, header_str, time_stamp in rows:
+        header = load_header(header_str)
+        for cookie_str in header['Cookie']:
+            for query in parse_cookies(cookie_str, verbose):
+                cookies.append((crawl_id, req_id)+query+(time_stamp,))
+    return cookies
+
+def parse_response_cookie_rows(rows, verbose=False):
+    """
+    Parses rows of (id, crawl_id, url, headers, time_stamp) from
+    http_responses_proxy into rows of http_response_cookies
+    """
+    cookies = list()
+    for resp_id, crawl_id, req_url, header_str, time_stamp in rows:
+        header = load_header(header_str)
+        for cookie_str in header['Set-Cookie']:
+            for query in parse_cookies(cookie_str, verbose, url=req_url, response_cookie=True):
+                cookies.append((crawl_id, resp_id)+query+(time_stamp,))
+    return cookies
+
+REQUEST_HEADERS_QUERY = "SELECT id, crawl_id, headers, time_stamp FROM http_requests_proxy \
+                         WHERE id > ? AND id <= ? ORDER BY id"
+REQUEST_COOKIES_INSERT = "INSERT INTO http_request_cookies \
+                          (crawl_id, header_id, name, value, accessed) \
+                          VALUES (?,?,?,?,?)"
+RESPONSE_HEADERS_QUERY = "SELECT id, crawl_id, url, headers, time_stamp FROM http_responses_proxy \
+                          WHERE id > ? AND id <= ? ORDER BY id"
+RESPONSE_COOKIES_INSERT = "INSERT INTO http_response_cookies \
+                           (crawl_id, header_id, name, \
+                           value, domain, path, expires, max_age, \
+                           httponly, secure, comment, version, accessed) \
+                           VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)"
+
+def parse_id_range(args):
+    """
+    Parser stage: reads the headers with start_id < id <= end_id from the
+    crawl database over its own connection and returns the parsed cookie rows.
+    Runs in the worker processes, so only the id range is sent to a worker.
+    """
+    database, headers_query, parse_rows, start_id, end_id, verbose = args
+    con = sqlite3.connect(database)
+    rows = con.execute(headers_query, (start_id, end_id)).fetchall()
+    con.close()
+    return parse_rows(rows, verbose)
+
+def process_headers(con, database, cookie_table, header_table, headers_query,
+                    cookies_insert, parse_rows, batch_size, verbose, pool=None):
+    """
+    Parses the headers with an id above the high-water mark of <cookie_table>
+    in chunks of <batch_size> header ids and writes each chunk with executemany.
+    The high-water mark is the largest header_id already in <cookie_table>,
+    so an interrupted run continues where the last committed chunk ended.
+    If a <pool> is given, the chunks are parsed by its worker processes while
+    this process stays the single writer. Results are written in id order,
+    which keeps the high-water mark valid.
+    """
+    cur = con.cursor()
+    cur.execute("SELECT MAX(header_id) FROM %s" % cookie_table)
+    last_id = cur.fetchone()[0] or 0
+    cur.execute("SELECT MAX(id) FROM %s" % header_table)
+    max_id = cur.fetchone()[0] or 0
+    chunks = ((database, headers_query, parse_rows, start_id,
+               min(start_id + batch_size, max_id), verbose)
+              for start_id in xrange(last_id, max_id, batch_size))
+    if pool is None:
+        results = itertools.imap(parse_id_range, chunks)
+    else:
+        results = pool.imap(parse_id_range, chunks)
+    commit = 0
+    for cookies in results:
+        cur.executemany(cookies_insert, cookies)
+        con.commit()
+        commit += len(cookies)
+        if verbose: print str(commit) + " Cookies Processed"
+    return commit
+
+def build_http_cookie_table(database, verbose=False, batch_size=10000,
+                            num_processes=1):
+    """
+    Extracts all http-cookie data from HTTP headers and generates a new table
+    With <num_processes> > 1 the headers are parsed by a process pool
+    """
     con = sqlite3.connect(database)
     cur1 = con.cursor()
-    cur2 = con.cursor()
 
     cur1.execute("CREATE TABLE IF NOT EXISTS http_request_cookies ( \
                     id INTEGER PRIMARY KEY AUTOINCREMENT, \
@@ -159,67 +332,26 @@ def build_http_cookie_table(database, verbose=False):
                     accessed DATETIME);")
     con.commit()
 
+    pool = Pool(num_processes) if num_processes > 1 else None
+
     # Parse http request cookies
-    commit = 0
-    last_commit = 0
-    cur1.execute("SELECT id, crawl_id, headers, time_stamp FROM http_requests_proxy \
-                    WHERE id NOT IN (SELECT header_id FROM http_request_cookies)")
-    row = cur1.fetchone()
-    while row is not None:
-        req_id, crawl_id, header_str, time_stamp = row
-        header = ODictCaseless()
-        try:
-            header.load_state(json.loads(header_str))
-        except ValueError: #XXX temporary shim -- should be removed
-            header.load_state(eval(header_str))
-        for cookie_str in header['Cookie']:
-            queries = parse_cookies(cookie_str, verbose)
-            for query in queries:
-                cur2.execute("INSERT INTO http_request_cookies \
-                            (crawl_id, header_id, name, value, accessed) \
-                            VALUES (?,?,?,?,?)",
-                            (crawl_id, req_id)+query+(time_stamp,))
-                commit += 1
-        if commit % 10000 == 0 and commit != 0 and commit != last_commit:
-            last_commit = commit
-            con.commit()
-            if verbose: print str(commit) + " Cookies Processed"
-        row = cur1.fetchone()
-    con.commit()
+    process_headers(con, database, 'http_request_cookies', 'http_requests_proxy',
+                    REQUEST_HEADERS_QUERY, REQUEST_COOKIES_INSERT,
+                    parse_request_cookie_rows, batch_size, verbose, pool)
     print "Processing HTTP Request Cookies Complete"
 
     # Parse http response cookies
-    commit = 0
-    last_commit = 0
-    cur1.execute("SELECT id, crawl_id, url, headers, time_stamp FROM http_responses_proxy \
-                    WHERE id NOT IN (SELECT header_id FROM http_response_cookies)")
-    row = cur1.fetchone()
-    while row is not None:
-        resp_id, crawl_id, req_url, header_str, time_stamp = row
-        header = ODictCaseless()
-        try:
-            header.load_state(json.loads(header_str))
-        except ValueError: #XXX temporary shim -- should be removed
-            header.load_state(eval(header_str))
-        for cookie_str in header['Set-Cookie']:
-            queries = parse_cookies(cookie_str, verbose, url=req_url, response_cookie=True)
-            for query in queries:
-                cur2.execute("INSERT INTO http_response_cookies \
-                            (crawl_id, header_id, name, \
-                            value, domain, path, expires, max_age, \
-                            httponly, secure, comment, version, accessed) \
-                            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                            (crawl_id, resp_id)+query+(time_stamp,))
-                commit += 1
-        if commit % 10000 == 0 and commit != 0 and commit != last_commit:
-            last_commit = commit
-            con.commit()
-            if verbose: print str(commit) + " Cookies Processed"
-        row = cur1.fetchone()
-    con.commit()
+    process_headers(con, database, 'http_response_cookies', 'http_responses_proxy',
+                    RESPONSE_HEADERS_QUERY, RESPONSE_COOKIES_INSERT,
+                    parse_response_cookie_rows, batch_size, verbose, pool)
     print "Processing HTTP Response Cookies Complete"
+
+    if pool is not None:
+        pool.close()
+        pool.join()
     con.close()
 
 if __name__=='__main__':
     import sys
-    build_http_cookie_table(sys.argv[1], verbose=True)
+    num_processes = int(sys.argv[2]) if len(sys.argv) > 2 else cpu_count()
+    build_http_cookie_table(sys.argv[1], verbose=True, num_processes=num_processes)
@@ -0,0 +1,54 @@
+import sqlite3
+
+# Secondary indexes built once the crawl has finished. Building them after
+# ingest keeps the insert speed of the DataAggregator unchanged during the
+# crawl. (visit_id, crawl_id) covers the natural joins with site_visits.
+INDEXES = [
+    ('site_visits', ('crawl_id',)),
+    ('http_requests', ('visit_id', 'crawl_id')),
+    ('http_responses', ('visit_id', 'crawl_id')),
+    ('http_requests_proxy', ('visit_id', 'crawl_id')),
+    ('http_responses_proxy', ('visit_id', 'crawl_id')),
+    ('javascript', ('visit_id', 'crawl_id')),
+    ('javascript', ('script_url',)),
+    ('javascript', ('symbol', 'script_url')),
+    ('javascript_cookies', ('visit_id', 'crawl_id')),
+    ('profile_cookies', ('visit_id', 'crawl_id')),
+    ('flash_cookies', ('visit_id', 'crawl_id')),
+]
+
+
+def get_index_name(table, columns):
+    """ Name of the index on <columns> of <table> """
+    return 'idx_%s_%s' % (table, '_'.join(columns))
+
+
+def build_indexes(database, verbose=False):
+    """
+    Creates the secondary indexes in INDEXES on an existing crawl database
+    Tables which do not exist in <database> are skipped
+    Returns the names of the indexes that were created or already existed
+    """
+    con = sqlite3.connect(database)
+    cur = con.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    tables = set(row[0] for row in cur.fetchall())
+
+    built = list()
+    for table, columns in INDEXES:
+        if table not in tables:
+            continue
+        index_name = get_index_name(table, columns)
+        cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+            index_name, table, ', '.join(columns)))
+        con.commit()
+        built.append(index_name)
+        if verbose: print "Built index " + index_name
+    cur.execute("ANALYZE")
+    con.commit()
+    con.close()
+    return built
+
+if __name__=='__main__':
+    import sys
+    build_indexes(sys.argv[1], verbose=True)
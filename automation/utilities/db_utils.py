@@ -1,7 +1,25 @@
 import sqlite3
+import json
 import os
 import plyvel
 
+# Named PRAGMA presets for crawl databases, selected through
+# manager_params['sqlite_profile'] and applied on connect
+SQLITE_PROFILES = {
+    # SQLite defaults: rollback journal, fsync on every commit
+    'durable': [('journal_mode', 'DELETE'),
+                ('synchronous', 'FULL')],
+    # write-ahead log, fsync only at checkpoints
+    'fast': [('journal_mode', 'WAL'),
+             ('synchronous', 'NORMAL')],
+    # 'fast' plus a 256MB page cache, 1GB memory map and in-memory temp tables
+    'bulk': [('journal_mode', 'WAL'),
+             ('synchronous', 'NORMAL'),
+             ('cache_size', -256 * 1024),
+             ('mmap_size', 2**30),
+             ('temp_store', 'MEMORY')],
+}
+
 
 def query_db(db, query, params=None):
     """Run a query against the given db.
@@ -17,6 +35,22 @@ def query_db(db, query, params=None):
     return rows
 
 
+def apply_sqlite_profile(con, profile):
+    """Apply the PRAGMA settings of the named `profile` to connection `con`
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        open connection to the crawl database
+    profile : str
+        one of the keys of `SQLITE_PROFILES`
+    """
+    if profile not in SQLITE_PROFILES:
+        raise ValueError("Unsupported sqlite profile: %s" % profile)
+    for pragma, value in SQLITE_PROFILES[profile]:
+        con.execute("PRAGMA %s = %s" % (pragma, value))
+
+
 def get_javascript_content(data_directory):
     """Yield key, value pairs from the deduplicated leveldb content database
 
@@ -34,6 +68,84 @@ def get_javascript_content(data_directory):
     db.close()
 
 
+class ContentStore(object):
+    """Random access to the deduplicated leveldb content database by hash
+
+    Opens `javascript.ldb` and its metadata side database
+    `javascript_meta.ldb`, which maps each content hash to the size of the
+    content in bytes and the time the LevelDBAggregator first stored it.
+    Content saved by crawls that predate the metadata has none. LevelDB
+    allows a single process per database, so the store can only be opened
+    once the crawl has finished.
+
+    Parameters
+    ----------
+    data_directory : str
+        root directory of the crawl files containing `javascript.ldb`
+    """
+    def __init__(self, data_directory):
+        self.db = plyvel.DB(os.path.join(data_directory, 'javascript.ldb'),
+                            create_if_missing=False,
+                            compression='snappy')
+        meta_path = os.path.join(data_directory, 'javascript_meta.ldb')
+        self.meta_db = None
+        if os.path.isdir(meta_path):
+            self.meta_db = plyvel.DB(meta_path, create_if_missing=False)
+
+    def get(self, content_hash):
+        """Return the content stored under `content_hash`, or None"""
+        return self.db.get(str(content_hash))
+
+    def get_many(self, content_hashes):
+        """Return the contents of `content_hashes` in input order
+
+        Each distinct hash is looked up once, in key order and against a
+        single snapshot. Missing hashes yield None.
+        """
+        content_hashes = [str(content_hash) for content_hash in content_hashes]
+        snapshot = self.db.snapshot()
+        contents = dict()
+        for content_hash in sorted(set(content_hashes)):
+            contents[content_hash] = snapshot.get(content_hash)
+        snapshot.close()
+        return [contents[content_hash] for content_hash in content_hashes]
+
+    def exists(self, content_hash):
+        """Return True if content is stored under `content_hash`
+
+        Checks the small metadata entry first, so that the content itself is
+        only read for hashes without metadata.
+        """
+        content_hash = str(content_hash)
+        if self.get_metadata(content_hash) is not None:
+            return True
+        return self.db.get(content_hash) is not None
+
+    def get_metadata(self, content_hash):
+        """Return (size, first_seen) for `content_hash`, or None
+
+        `size` is the length of the stored content in bytes and `first_seen`
+        the unix time at which the LevelDBAggregator first stored it.
+        """
+        if self.meta_db is None:
+            return None
+        metadata = self.meta_db.get(str(content_hash))
+        if metadata is None:
+            return None
+        return tuple(json.loads(metadata))
+
+    def close(self):
+        self.db.close()
+        if self.meta_db is not None:
+            self.meta_db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def get_javascript_entries(db, all_columns=False):
     if all_columns:
         select_columns = "*"
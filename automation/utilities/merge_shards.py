@@ -0,0 +1,115 @@
+import sqlite3
+import os
+
+# Tables written by the TaskManager itself. These always go to the canonical
+# database, so their (empty) copies in the shards are skipped during a merge.
+TASK_MANAGER_TABLES = set(['task', 'crawl', 'site_visits', 'CrawlHistory'])
+
+# Tables whose INTEGER PRIMARY KEY is data rather than a row id. pages.id is
+# the inner window id Firefox assigns, which pages.parent_id and
+# content_policy.page_id refer to, so it is copied as is.
+KEYED_TABLES = set(['pages'])
+
+# Tables that deduplicate by design (a UNIQUE constraint or a key that several
+# browsers may report). Rows already in the canonical database are skipped.
+DEDUPLICATED_TABLES = set(['xpath', 'pages'])
+
+
+def get_shard_path(database, crawl_id):
+    """ Location of the shard of <database> written by browser <crawl_id> """
+    root, ext = os.path.splitext(database)
+    return '%s-shard-%i%s' % (root, crawl_id, ext)
+
+
+def get_columns(con, schema, table):
+    """ Returns a list of (name, is_integer_primary_key) for each column """
+    columns = list()
+    for row in con.execute("PRAGMA %s.table_info(%s)" % (schema, table)):
+        name, col_type, pk = row[1], row[2], row[5]
+        columns.append((name, pk == 1 and col_type.upper() == 'INTEGER'))
+    return columns
+
+
+def merge_table(con, table, sql, existing):
+    """
+    Copies the rows of <table> from the attached shard into the main database
+    of <con>, creating it from the shard's <sql> if it is not in <existing>.
+    Returns the number of rows copied
+    """
+    if table not in existing:
+        con.execute(sql)
+    main_columns = set(name for name, _ in get_columns(con, 'main', table))
+    columns = [name for name, is_row_id in get_columns(con, 'shard', table)
+               if name in main_columns and
+               (not is_row_id or table in KEYED_TABLES)]
+    column_str = ', '.join(columns)
+    insert = "INSERT OR IGNORE" if table in DEDUPLICATED_TABLES else "INSERT"
+    cur = con.execute("%s INTO main.%s (%s) SELECT %s FROM shard.%s" % (
+        insert, table, column_str, column_str, table))
+    return cur.rowcount
+
+
+def merge_shards(database, shards, verbose=False, logger=None):
+    """
+    Copies the rows of every shard in <shards> into the canonical <database>
+    Tables missing from <database> are created from the shard's schema.
+    visit_id and crawl_id are assigned centrally by the TaskManager, so they
+    are copied as is. Row ids (INTEGER PRIMARY KEY) are re-assigned by the
+    canonical database, except in KEYED_TABLES. Each shard is merged in one
+    transaction: if one of its tables fails to merge, the error is reported
+    to <logger> (or printed) and the shard is rolled back, so that it can be
+    merged again once fixed, while the other shards are still merged.
+    Returns the number of rows copied and the list of shards merged, which
+    are safe to delete
+    """
+    def report(msg):
+        if logger is not None:
+            logger.error(msg)
+        else:
+            print msg
+
+    con = sqlite3.connect(database)
+    # transactions are managed explicitly, as the sqlite3 module would
+    # otherwise commit before each CREATE TABLE of a shard's merge
+    con.isolation_level = None
+    total_rows = 0
+    merged = list()
+    for shard in shards:
+        try:
+            con.execute("ATTACH DATABASE ? AS shard", (shard,))
+        except sqlite3.Error as e:
+            report("Could not open shard %s: %s" % (shard, e))
+            continue
+        tables = con.execute("SELECT name, sql FROM shard.sqlite_master "
+                             "WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+                             ).fetchall()
+        existing = set(row[0] for row in con.execute(
+            "SELECT name FROM main.sqlite_master WHERE type='table'"))
+        complete = True
+        shard_rows = 0
+        con.execute("BEGIN")
+        for table, sql in tables:
+            if table in TASK_MANAGER_TABLES:
+                continue
+            try:
+                num_rows = merge_table(con, table, sql, existing)
+            except sqlite3.Error as e:
+                report("Could not merge table %s from %s: %s" % (table, shard, e))
+                complete = False
+                continue
+            shard_rows += num_rows
+            if verbose: print "Merged %i rows of %s from %s" % (num_rows, table, shard)
+        if complete:
+            con.execute("COMMIT")
+            total_rows += shard_rows
+            merged.append(shard)
+        else:
+            con.execute("ROLLBACK")
+            report("Rolled back the merge of %s" % shard)
+        con.execute("DETACH DATABASE shard")
+    con.close()
+    return total_rows, merged
+
+if __name__=='__main__':
+    import sys
+    merge_shards(sys.argv[1], sys.argv[2:], verbose=True)
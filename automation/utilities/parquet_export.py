@@ -0,0 +1,186 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlite3
+import os
+
+AUTOMATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTENSION_DATA_DIR = os.path.join(AUTOMATION_DIR, 'Extension', 'firefox', 'data')
+
+# Schema files defining the exported tables
+SCHEMA_FILES = [os.path.join(AUTOMATION_DIR, 'schema.sql'),
+                os.path.join(EXTENSION_DATA_DIR, 'create_http_requests_table.sql'),
+                os.path.join(EXTENSION_DATA_DIR, 'create_http_responses_table.sql'),
+                os.path.join(EXTENSION_DATA_DIR, 'create_javascript_table.sql')]
+
+EXPORT_TABLES = ['site_visits', 'http_requests', 'http_responses',
+                 'javascript', 'profile_cookies']
+
+# Columns holding highly repetitive URLs/domains, stored dictionary-encoded
+DICTIONARY_COLUMNS = set(['url', 'site_url', 'top_level_url', 'script_url',
+                          'referrer', 'location', 'triggering_origin',
+                          'loading_origin', 'loading_href', 'baseDomain',
+                          'host'])
+
+CHUNK_SIZE = 100000  # rows per parquet row group
+
+
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+
+# sqlite stores any value in any column, so text or blobs that do not convert
+# to the column type are exported as null rather than aborting the export
+def _to_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if INT64_MIN <= value <= INT64_MAX else None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_bool(value):
+    return None if value is None else bool(value)
+
+
+def _to_unicode(value):
+    if value is None or type(value) is unicode:
+        return value
+    if type(value) is str:
+        return unicode(value, 'utf-8', errors='ignore')
+    return unicode(value)
+
+
+def get_arrow_type(declared_type):
+    """
+    Maps a declared sqlite column type to an arrow type and a converter for
+    the stored values, following sqlite's type affinity rules
+    """
+    declared_type = declared_type.upper()
+    if 'INT' in declared_type:
+        return pa.int64(), _to_int
+    if 'BOOL' in declared_type:
+        return pa.bool_(), _to_bool
+    if ('REAL' in declared_type or 'FLOA' in declared_type or
+            'DOUB' in declared_type):
+        return pa.float64(), _to_float
+    return pa.string(), _to_unicode
+
+
+def load_table_schemas(schema_files=SCHEMA_FILES):
+    """
+    Returns {table: [(column, declared_type), ...]} as defined by the schema
+    files, so that column types do not depend on the contents of a crawl
+    """
+    con = sqlite3.connect(':memory:')
+    for schema_file in schema_files:
+        with open(schema_file, 'r') as f:
+            con.executescript(f.read())
+    schemas = dict()
+    tables = con.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                         "AND name NOT LIKE 'sqlite_%'").fetchall()
+    for (table,) in tables:
+        schemas[table] = [(row[1], row[2]) for row in
+                          con.execute("PRAGMA table_info(%s)" % table)]
+    con.close()
+    return schemas
+
+
+def export_table(con, table, columns, output_directory, chunk_size=CHUNK_SIZE,
+                 verbose=False):
+    """
+    Streams <table> into one parquet file per crawl_id, at
+    <output_directory>/<table>/crawl_id=<crawl_id>/<table>.parquet
+    Rows are sorted by visit_id (if present) and written in row groups of
+    <chunk_size> rows, so readers can skip row groups by their visit_id range
+    The table is read in one pass ordered by crawl_id, which switches to the
+    next file as the crawl_id changes, since it has no index to look up a
+    single crawl_id
+    Returns the number of rows exported
+    """
+    names = [name for name, _ in columns]
+    types = [get_arrow_type(declared_type) for _, declared_type in columns]
+    schema = pa.schema([pa.field(name, arrow_type)
+                        for name, (arrow_type, _) in zip(names, types)])
+    dictionary_columns = [name for name in names if name in DICTIONARY_COLUMNS]
+    order = 'visit_id, rowid' if 'visit_id' in names else 'rowid'
+    crawl_id_index = names.index('crawl_id')
+
+    def write_rows(writer, rows):
+        arrays = list()
+        for i, (arrow_type, convert) in enumerate(types):
+            arrays.append(pa.array([convert(row[i]) for row in rows],
+                                   type=arrow_type))
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    def open_writer(crawl_id):
+        directory = os.path.join(output_directory, table, 'crawl_id=%s' % crawl_id)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return pq.ParquetWriter(os.path.join(directory, table + '.parquet'),
+                                schema, use_dictionary=dictionary_columns)
+
+    cur = con.execute("SELECT %s FROM %s ORDER BY crawl_id, %s" % (
+        ', '.join(names), table, order))
+    num_rows = 0
+    writer = None
+    crawl_id = None
+    pending = list()  # rows of <crawl_id> for the next row group
+    rows = cur.fetchmany(chunk_size)
+    while rows:
+        for row in rows:
+            if writer is None or row[crawl_id_index] != crawl_id:
+                if writer is not None:
+                    if pending:
+                        write_rows(writer, pending)
+                    writer.close()
+                crawl_id = row[crawl_id_index]
+                writer = open_writer(crawl_id)
+                pending = list()
+            pending.append(row)
+            if len(pending) == chunk_size:
+                write_rows(writer, pending)
+                pending = list()
+        num_rows += len(rows)
+        rows = cur.fetchmany(chunk_size)
+    if writer is not None:
+        if pending:
+            write_rows(writer, pending)
+        writer.close()
+    if verbose: print "Exported %i rows of %s" % (num_rows, table)
+    return num_rows
+
+
+def export_crawl(database, output_directory, tables=EXPORT_TABLES,
+                 chunk_size=CHUNK_SIZE, verbose=False):
+    """
+    Exports <tables> of the crawl <database> to partitioned parquet files in
+    <output_directory>. Tables missing from the crawl database are skipped
+    Returns {table: number of rows exported}
+    """
+    schemas = load_table_schemas()
+    con = sqlite3.connect(database)
+    existing = set(row[0] for row in con.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'"))
+    exported = dict()
+    for table in tables:
+        if table not in existing:
+            continue
+        # columns added to the schema files after the crawl ran are skipped
+        crawl_columns = set(row[1] for row in
+                            con.execute("PRAGMA table_info(%s)" % table))
+        columns = [(name, declared_type) for name, declared_type in schemas[table]
+                   if name in crawl_columns]
+        exported[table] = export_table(con, table, columns,
+                                       output_directory, chunk_size, verbose)
+    con.close()
+    return exported
+
+if __name__=='__main__':
+    import sys
+    export_crawl(sys.argv[1], sys.argv[2], verbose=True)
@@ -67,6 +67,12 @@ class AnalysisCrawler(BaseCrawler):
            Sites are expected as list including protocol, e.g. http://www.hdm-stuttgart.de'''
         self._set_dbname(sites, self.db_prefix, self.bpath, self.CRAWL_TYPE)
         manager = TaskManager.TaskManager(self.managerpar, [self.browserpar])
+        # sequences are generated as browsers pull them from the manager
+        manager.submit_many(self._command_sequences(sites))
+        manager.close()
+
+    def _command_sequences(self, sites):
+        '''Yields the command sequence for each site'''
         for site in sites:
             # we run a stateless crawl (fresh profile for each page)
             command_sequence = CommandSequence.CommandSequence(site, reset=True)
@@ -75,8 +81,7 @@ class AnalysisCrawler(BaseCrawler):
             # dump_profile_cookies/dump_flash_cookies closes the current tab.
             command_sequence.dump_profile_cookies(self.DEF_COOKIE_TIME)
             command_sequence.dump_flash_cookies(self.DEF_COOKIE_TIME)
-            manager.execute_command_sequence(command_sequence, index=None)
-        manager.close()
+            yield command_sequence
 
 class DetectionCrawler(BaseCrawler):
     '''Crawler generating data for detection algorithm
@@ -0,0 +1,152 @@
+from os.path import join, dirname, realpath
+import random
+import sqlite3
+import json
+import time
+
+from ..automation.utilities import build_cookie_table
+from openwpmtest import OpenWPMTest
+
+AUTOMATION_DIR = join(dirname(dirname(realpath(__file__))), 'automation')
+TIME_STAMP = u'2017-01-01 00:00:00.000000'
+NUM_COOKIES = 100000
+
+
+def strptime_select_date_format(date_string):
+    """The uncached strptime loop select_date_format replaces."""
+    if date_string == '' or date_string == '0':
+        return None
+    for date_format in build_cookie_table.DATE_FORMATS:
+        try:
+            time_obj = time.strptime(date_string, date_format)
+            break
+        except ValueError:
+            pass
+    else:
+        return None
+    if time_obj.tm_year >= 1900:
+        return time.strftime("%Y-%m-%d %H:%M:%S", time_obj)
+    return None
+
+
+def expires_corpus(num_cookies):
+    """
+    Returns <num_cookies> expires strings drawn from a few hundred distinct
+    values, mostly RFC 1123 with some legacy formats, session and bad dates
+    """
+    random.seed(0)
+    distinct = list()
+    for i in xrange(300):
+        expires = time.gmtime(1483228800 + i * 86413)
+        distinct.append(time.strftime('%a, %d %b %Y %H:%M:%S GMT', expires))
+    for i in xrange(30):
+        expires = time.gmtime(1483228800 + i * 3600 * 24 * 31)
+        distinct.append(time.strftime('%a, %d-%b-%Y %H:%M:%S GMT', expires))
+        distinct.append(time.strftime('%a, %d-%b-%y %H:%M:%S GMT', expires))
+    distinct += ['', '0', 'Thu, 01 Jan 1970 00:00:00 GMT',
+                 'Mon, 01 Jan 1800 00:00:00 GMT', 'Wed, 31 Feb 2018 00:00:00 GMT',
+                 'Tue, 30 Jun 2015 23:59:60 GMT', 'Sun, 01-01-2017 00:00:00 GMT',
+                 'tomorrow', '-1']
+    return [random.choice(distinct) for _ in xrange(num_cookies)]
+
+
+class TestBuildCookieTable(OpenWPMTest):
+    """Check the http cookie tables built from proxy headers."""
+
+    def create_db(self):
+        db = join(self.tmpdir, 'crawl-data.sqlite')
+        con = sqlite3.connect(db)
+        with open(join(AUTOMATION_DIR, 'schema.sql')) as f:
+            con.executescript(f.read())
+        con.close()
+        return db
+
+    def insert_headers(self, db, num_headers):
+        con = sqlite3.connect(db)
+        for i in xrange(num_headers):
+            request_headers = [['Cookie', 'id=%i; session=abc' % i],
+                               ['Host', 'example.com']]
+            con.execute("INSERT INTO http_requests_proxy (crawl_id, url, "
+                        "method, referrer, headers, visit_id, time_stamp) "
+                        "VALUES (?,?,?,?,?,?,?)",
+                        (1, u'http://example.com/', u'GET', u'',
+                         json.dumps(request_headers), 1, TIME_STAMP))
+            response_headers = [
+                ['Set-Cookie', 'id=%i; Domain=example.com; Path=/; '
+                               'Expires=Wed, 21 Oct 2037 07:28:00 GMT' % i]]
+            con.execute("INSERT INTO http_responses_proxy (crawl_id, url, "
+                        "method, referrer, response_status, "
+                        "response_status_text, headers, location, visit_id, "
+                        "time_stamp) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                        (1, u'http://example.com/a/b', u'GET', u'', 200,
+                         u'OK', json.dumps(response_headers), u'', 1,
+                         TIME_STAMP))
+        con.commit()
+        con.close()
+
+    def test_incremental_build(self):
+        db = self.create_db()
+        self.insert_headers(db, 25)
+        build_cookie_table.build_http_cookie_table(db, batch_size=10)
+
+        con = sqlite3.connect(db)
+        assert con.execute("SELECT COUNT(*) FROM http_request_cookies"
+                           ).fetchone()[0] == 50
+        assert con.execute("SELECT COUNT(*) FROM http_response_cookies"
+                           ).fetchone()[0] == 25
+        row = con.execute("SELECT name, value, domain, path, expires "
+                          "FROM http_response_cookies WHERE header_id = 3"
+                          ).fetchone()
+        assert row == (u'id', u'2', u'.example.com', u'/',
+                       u'2037-10-21 07:28:00')
+        con.close()
+
+        # a second run only parses headers added since the first one
+        self.insert_headers(db, 5)
+        build_cookie_table.build_http_cookie_table(db, batch_size=10)
+        con = sqlite3.connect(db)
+        assert con.execute("SELECT COUNT(*) FROM http_request_cookies"
+                           ).fetchone()[0] == 60
+        assert con.execute("SELECT COUNT(DISTINCT header_id) "
+                           "FROM http_response_cookies").fetchone()[0] == 30
+        con.close()
+
+    def test_parallel_build(self):
+        db = self.create_db()
+        self.insert_headers(db, 45)
+        build_cookie_table.build_http_cookie_table(db, batch_size=10,
+                                                   num_processes=3)
+
+        con = sqlite3.connect(db)
+        assert con.execute("SELECT COUNT(*) FROM http_request_cookies"
+                           ).fetchone()[0] == 90
+        # the single writer inserts the chunks in header id order
+        header_ids = [row[0] for row in con.execute(
+            "SELECT header_id FROM http_response_cookies ORDER BY id")]
+        assert header_ids == range(1, 46)
+        con.close()
+
+    def test_select_date_format(self):
+        """The cached fast path agrees with the strptime loop."""
+        for expires in set(expires_corpus(NUM_COOKIES)):
+            assert (build_cookie_table.select_date_format(expires) ==
+                    strptime_select_date_format(expires))
+        assert (build_cookie_table.select_date_format(
+            'Wed, 21 Oct 2037 07:28:00 GMT') == '2037-10-21 07:28:00')
+        assert build_cookie_table.select_date_format(
+            'Mon, 01 Jan 1800 00:00:00 GMT') is None
+
+    def test_select_date_format_throughput(self):
+        corpus = expires_corpus(NUM_COOKIES)
+        results = dict()
+        for name, parse in [
+                ('strptime loop', strptime_select_date_format),
+                ('uncached', build_cookie_table.select_date_format.uncached),
+                ('cached', build_cookie_table.select_date_format)]:
+            start_time = time.time()
+            for expires in corpus:
+                parse(expires)
+            results[name] = NUM_COOKIES / (time.time() - start_time)
+        print
+        for name in ['strptime loop', 'uncached', 'cached']:
+            print "%-14s %10.0f dates/s" % (name + ':', results[name])
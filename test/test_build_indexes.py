@@ -0,0 +1,45 @@
+from os.path import join, dirname, realpath
+import sqlite3
+
+from ..automation.utilities import build_indexes
+from openwpmtest import OpenWPMTest
+
+AUTOMATION_DIR = join(dirname(dirname(realpath(__file__))), 'automation')
+
+
+class TestBuildIndexes(OpenWPMTest):
+    """Check the post-crawl index stage on an empty crawl database."""
+
+    def create_db(self):
+        db = join(self.tmpdir, 'crawl-data.sqlite')
+        con = sqlite3.connect(db)
+        with open(join(AUTOMATION_DIR, 'schema.sql')) as f:
+            con.executescript(f.read())
+        with open(join(AUTOMATION_DIR, 'Extension', 'firefox', 'data',
+                       'create_javascript_table.sql')) as f:
+            con.executescript(f.read())
+        con.close()
+        return db
+
+    def test_indexes_built(self):
+        db = self.create_db()
+        built = build_indexes.build_indexes(db)
+        # http_requests is created by the extension and is missing here
+        assert 'idx_http_requests_visit_id_crawl_id' not in built
+        assert 'idx_javascript_symbol_script_url' in built
+
+        con = sqlite3.connect(db)
+        rows = con.execute("SELECT name FROM sqlite_master "
+                           "WHERE type='index'").fetchall()
+        names = set(row[0] for row in rows)
+        assert set(built).issubset(names)
+
+        # lookups by visit_id use the new index instead of a full scan
+        plan = con.execute("EXPLAIN QUERY PLAN SELECT site_url, name "
+                           "FROM site_visits NATURAL JOIN profile_cookies "
+                           "WHERE crawl_id = 1").fetchall()
+        assert 'idx_profile_cookies_visit_id_crawl_id' in str(plan)
+        con.close()
+
+        # building the indexes again is a no-op
+        assert build_indexes.build_indexes(db) == built
@@ -0,0 +1,236 @@
+from os.path import join, dirname, realpath
+from collections import OrderedDict
+from multiprocess import Process, Queue
+import sqlite3
+import time
+
+from ..automation.DataAggregator import DataAggregator
+from ..automation.SocketInterface import (clientsocket, SHUTDOWN_SIGNAL,
+                                          DRAIN_SIGNAL)
+from openwpmtest import OpenWPMTest
+
+AUTOMATION_DIR = join(dirname(dirname(realpath(__file__))), 'automation')
+JAVASCRIPT_SQL = join(AUTOMATION_DIR, 'Extension', 'firefox', 'data',
+                      'create_javascript_table.sql')
+JAVASCRIPT_INSERT = ("INSERT INTO javascript (crawl_id, visit_id, script_url, "
+                     "script_line, script_col, func_name, script_loc_eval, "
+                     "call_stack, symbol, operation, value, arguments, "
+                     "time_stamp) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)")
+SITE_VISITS_INSERT = ("INSERT INTO site_visits (visit_id, crawl_id, site_url) "
+                      "VALUES (?,?,?)")
+NUM_ROWS = 100000
+
+
+def synthetic_javascript_row(i):
+    """Return a synthetic `javascript` row as sent by the extension."""
+    return [1, i / 100, u'http://example.com/script.js', u'12', u'34',
+            u'fingerprint', u'', u'', u'window.navigator.userAgent',
+            u'get', u'Mozilla/5.0', u'', u'2017-01-01T00:00:00.000Z']
+
+
+class DummyLogger(object):
+    def error(self, msg):
+        raise AssertionError(msg)
+
+
+class RecordingCursor(object):
+    """A cursor recording the first keyword of each statement it runs."""
+    def __init__(self, db):
+        self.curr = db.cursor()
+        self.connection = self
+        self.statements = list()
+
+    def execute(self, statement, *args):
+        self.statements.append(statement.split()[0])
+        return self.curr.execute(statement, *args)
+
+    def executemany(self, statement, args_list):
+        self.statements.append(statement.split()[0])
+        return self.curr.executemany(statement, args_list)
+
+
+class TestDataAggregator(OpenWPMTest):
+    """Check the query encoding of the DataAggregator."""
+
+    def get_cursor(self):
+        db = sqlite3.connect(':memory:')
+        with open(join(AUTOMATION_DIR, 'schema.sql')) as f:
+            db.executescript(f.read())
+        with open(JAVASCRIPT_SQL) as f:
+            db.executescript(f.read())
+        db.isolation_level = None  # as opened by the DataAggregator
+        return db, db.cursor()
+
+    def test_compiled_encoder(self):
+        db, curr = self.get_cursor()
+        encoder = DataAggregator.compile_encoder(JAVASCRIPT_INSERT, 13, curr)
+        assert encoder is not DataAggregator.encode_args
+
+        row = synthetic_javascript_row(0)
+        row[2] = 'http://example.com/\xe4.js'
+        assert encoder(row) == DataAggregator.encode_args(row)
+
+        # any value in any column, numeric (crawl_id) or text (script_url)
+        for value in [1, 2L, 1.5, True, None, u'\xe4', 'a', '\xe4', '12',
+                      synthetic_javascript_row]:
+            for column in [0, 2]:
+                row = synthetic_javascript_row(0)
+                row[column] = value
+                encoded = encoder(row)
+                assert encoded == DataAggregator.encode_args(row)
+                assert ([type(arg) for arg in encoded] ==
+                        [type(arg) for arg in DataAggregator.encode_args(row)])
+        db.close()
+
+    def test_login_arguments_redacted(self):
+        db, curr = self.get_cursor()
+        statement = ("INSERT INTO CrawlHistory (crawl_id, command, arguments, "
+                     "bool_success) VALUES (?,?,?,?)")
+        encoder = DataAggregator.compile_encoder(statement, 4, curr)
+        assert encoder((1, 'LOGIN', 'secret', 1))[2] != 'secret'
+        args = encoder((1, 'RUN_CUSTOM_FUNCTION', synthetic_javascript_row, 1))
+        assert args[2] == str(synthetic_javascript_row)
+        db.close()
+
+    def test_process_query(self):
+        db, curr = self.get_cursor()
+        pending = OrderedDict()
+        encoders = dict()
+        for i in xrange(10):
+            query = (JAVASCRIPT_INSERT, synthetic_javascript_row(i))
+            DataAggregator.process_query(query, pending, encoders, curr,
+                                         DummyLogger())
+        assert len(encoders) == 1
+        DataAggregator.flush_pending(pending, db, curr, DummyLogger())
+        assert curr.execute(
+            "SELECT COUNT(*) FROM javascript").fetchone()[0] == 10
+        db.close()
+
+    def test_write_failed_group(self):
+        """A group that fails part way is written once, row by row."""
+        db, curr = self.get_cursor()
+        pending = OrderedDict()
+        rows = [(i, 1, u'http://example.com/%i' % i) for i in xrange(5)]
+        rows[3] = (3, 1, 'http://example.com/\xe4')  # not bound by sqlite3
+        pending[(SITE_VISITS_INSERT, 3)] = rows
+        DataAggregator.flush_pending(pending, db, curr, DummyLogger())
+        assert curr.execute("SELECT visit_id, site_url FROM site_visits "
+                            "ORDER BY rowid").fetchall() == [
+            (0, u'http://example.com/0'), (1, u'http://example.com/1'),
+            (2, u'http://example.com/2'), (3, u'http://example.com/'),
+            (4, u'http://example.com/4')]
+        assert not pending
+        db.close()
+
+    def test_statement_without_args(self):
+        """Pending rows are committed in one transaction before a DDL."""
+        db, _ = self.get_cursor()
+        curr = RecordingCursor(db)
+        pending = OrderedDict()
+        encoders = dict()
+        for visit_id in xrange(2):
+            DataAggregator.process_query(
+                (SITE_VISITS_INSERT, (visit_id, 1, u'http://example.com/')),
+                pending, encoders, curr, DummyLogger())
+            DataAggregator.process_query(
+                ("INSERT INTO CrawlHistory (crawl_id, command) VALUES (?,?)",
+                 (1, u'GET')),
+                pending, encoders, curr, DummyLogger())
+        del curr.statements[:]  # PRAGMA queries of the encoders
+        DataAggregator.process_query(
+            ("CREATE TABLE IF NOT EXISTS links (url TEXT)", ()),
+            pending, encoders, curr, DummyLogger())
+        assert curr.statements == [
+            'BEGIN',
+            'SAVEPOINT', 'INSERT', 'RELEASE',
+            'SAVEPOINT', 'INSERT', 'RELEASE',
+            'COMMIT', 'CREATE']
+        assert db.execute("SELECT COUNT(*) FROM site_visits").fetchone()[0] == 2
+        assert not pending
+        db.close()
+
+    def test_encoder_throughput(self):
+        """Compare the generic per-cell encoding with the compiled encoder."""
+        db, curr = self.get_cursor()
+        rows = [synthetic_javascript_row(i) for i in xrange(NUM_ROWS)]
+
+        start_time = time.time()
+        for row in rows:
+            DataAggregator.encode_args(row)
+        generic = NUM_ROWS / (time.time() - start_time)
+
+        encoder = DataAggregator.compile_encoder(JAVASCRIPT_INSERT, 13, curr)
+        start_time = time.time()
+        for row in rows:
+            encoder(row)
+        compiled = NUM_ROWS / (time.time() - start_time)
+
+        for row in rows[::1000]:
+            assert encoder(row) == DataAggregator.encode_args(row)
+
+        print "\ngeneric encoding:  %10.0f rows/s" % generic
+        print "compiled encoder:  %10.0f rows/s" % compiled
+        db.close()
+
+    def test_drain_acks_expire(self):
+        drain_acks = DataAggregator.DrainAcks()
+        drain_acks.ack(['1-1-manager'])
+        assert drain_acks.handle_query(['1-1-manager', 1]) == '1'
+        # a token acknowledged after its request timed out is not kept
+        assert drain_acks.handle_query(['1-2-manager', 0.01]) == '0'
+        drain_acks.ack(['1-2-manager'])
+        assert not drain_acks.tokens and not drain_acks.expired
+        # tokens that are never acknowledged are only kept for a while
+        for visit_id in xrange(DataAggregator.MAX_EXPIRED_TOKENS + 10):
+            drain_acks.handle_query(['1-%i-proxy' % visit_id, 0])
+        assert len(drain_acks.expired) == DataAggregator.MAX_EXPIRED_TOKENS
+        assert '1-0-proxy' not in drain_acks.expired
+
+    def test_drain_acknowledgement(self):
+        db_path = join(self.tmpdir, 'crawl-data.sqlite')
+        db = sqlite3.connect(db_path)
+        with open(join(AUTOMATION_DIR, 'schema.sql')) as f:
+            db.executescript(f.read())
+        db.close()
+        manager_params = {'database_name': db_path, 'sqlite_profile': 'durable',
+                          'logger_address': ('127.0.0.1', 1),
+                          'data_directory': self.tmpdir, 'unix_sockets': False,
+                          'aggregator_queue_size': 0,
+                          'aggregator_event_loop': False}
+        status_queue = Queue()
+        aggregator = Process(target=DataAggregator.DataAggregator,
+                             args=(manager_params, status_queue))
+        aggregator.daemon = True
+        aggregator.start()
+        address = status_queue.get(True, 10)[0]
+        drain_address = status_queue.get(True, 10)[0]
+
+        # the rows of a visit, followed by the marker on the same connection
+        sock = clientsocket(serialization='marshal', batch_size=2**16)
+        sock.connect(*address)
+        for i in xrange(10):
+            sock.send((SITE_VISITS_INSERT, (i, 1, u'http://example.com/')))
+        sock.send((DRAIN_SIGNAL, '1-1-manager'))
+        sock.flush()
+        extension_sock = clientsocket(serialization='json')
+        extension_sock.connect(*address)
+        extension_sock.send([DRAIN_SIGNAL, '1-1-extension'])
+
+        drain_sock = clientsocket()
+        drain_sock.connect(*drain_address)
+        start_time = time.time()
+        assert drain_sock.request(['1-1-manager', 10]) == '1'
+        elapsed = time.time() - start_time
+        db = sqlite3.connect(db_path)
+        assert db.execute("SELECT COUNT(*) FROM site_visits").fetchone()[0] == 10
+        db.close()
+        assert drain_sock.request(['1-1-extension', 10]) == '1'
+        assert drain_sock.request(['1-2-manager', 0.1]) == '0'  # never sent
+        print "\ndrain acknowledged in %.1f ms" % (elapsed * 1000)
+
+        sock.send(SHUTDOWN_SIGNAL)
+        sock.close()
+        extension_sock.close()
+        drain_sock.close()
+        aggregator.join(30)
+        assert not aggregator.is_alive()
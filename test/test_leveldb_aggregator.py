@@ -0,0 +1,205 @@
+from os.path import join, getsize
+import random
+import plyvel
+import time
+import os
+
+from ..automation.DataAggregator import LevelDBAggregator
+from ..automation.SocketInterface import serversocket
+from ..automation.utilities.db_utils import ContentStore
+from openwpmtest import OpenWPMTest
+
+NUM_SCRIPTS = 2000
+JS_TOKENS = ['function', 'var', 'return', 'window', 'document', '(', ')',
+             '{', '}', ';', '=', '.', 'this', 'prototype', 'navigator',
+             'userAgent', 'if', 'else', '0', '1', '"use strict"', 'e', 't',
+             'n', 'r', 'i', 'o', 'a', 's', 'u']
+DEFAULT_PARAMS = {'leveldb_lru_cache_size': 10**9,
+                  'leveldb_write_buffer_size': 128*10**4,
+                  'leveldb_compression': 'snappy',
+                  'leveldb_batch_size': 100,
+                  'leveldb_bulk_load': False}
+
+
+def synthetic_scripts(num_scripts):
+    """
+    Returns <num_scripts> (content, hash) pairs of minified-looking scripts
+    of 1KB to 500KB built from a pool of 1KB chunks, a fifth of them repeats
+    """
+    random.seed(0)
+    chunks = [u''.join(random.choice(JS_TOKENS) for _ in xrange(250))
+              for _ in xrange(500)]
+    scripts = list()
+    for i in xrange(num_scripts):
+        if i % 5 == 4:
+            scripts.append(random.choice(scripts))
+            continue
+        num_chunks = min(int(random.paretovariate(1.0) * 10), 500)
+        content = u''.join(random.choice(chunks) for _ in xrange(num_chunks))
+        scripts.append((content, str(i)))
+    return scripts
+
+
+def get_size(directory):
+    return sum(getsize(join(directory, f)) for f in os.listdir(directory))
+
+
+class TestLevelDBAggregator(OpenWPMTest):
+    """Check the content deduplication of the LevelDBAggregator."""
+
+    def get_db(self, name='javascript.ldb'):
+        return plyvel.DB(join(self.tmpdir, name), create_if_missing=True)
+
+    def test_duplicates_in_pending_batch(self):
+        db = self.get_db()
+        meta_db = self.get_db('javascript_meta.ldb')
+        known_hashes = LevelDBAggregator.HashCache(db)
+        batch = db.write_batch()
+        meta_batch = meta_db.write_batch()
+        counter = 0
+        for i in xrange(10):
+            content_hash = '%i' % (i % 3)
+            counter = LevelDBAggregator.process_content(
+                u'script %s' % content_hash, content_hash, batch, meta_batch,
+                known_hashes, counter, None)
+        assert counter == 3  # duplicates of pending items are dropped
+        LevelDBAggregator.write_batches(batch, meta_batch)
+        assert db.get('2') == 'script 2'
+        assert known_hashes.hits == 7
+        assert '70.0% hit rate' in known_hashes.get_stats()
+        db.close()
+        meta_db.close()
+
+    def test_duplicates_in_database(self):
+        db = self.get_db()
+        db.put('1', 'script 1')
+        known_hashes = LevelDBAggregator.HashCache(db)
+        assert known_hashes.is_duplicate('1')
+        assert known_hashes.is_duplicate('1')
+        assert not known_hashes.is_duplicate('2')
+        assert known_hashes.db_hits == 1
+        assert known_hashes.hits == 1
+        db.close()
+
+    def test_content_sender(self):
+        db = self.get_db()
+        db.put('1', 'script 1')
+        known_hashes = LevelDBAggregator.HashCache(db)
+        data_sock = serversocket()
+        data_sock.start_accepting()
+        query_sock = serversocket(handler=known_hashes.handle_query)
+        query_sock.start_accepting()
+        manager_params = {'ldb_address': data_sock.get_addresses()[0],
+                          'ldb_query_address': query_sock.get_addresses()[0]}
+
+        sender = LevelDBAggregator.ContentSender(manager_params)
+        assert not sender.save(u'script 1', 1)  # known to the aggregator
+        assert sender.save(u'script 2', 2)
+        assert not sender.save(u'script 2', 2)  # sent before
+        sender.close()
+        assert data_sock.queue.get(True, 10) == (u'script 2', '2')
+        assert data_sock.queue.qsize() == 0
+        assert known_hashes.queries == 2 and known_hashes.query_hits == 1
+        data_sock.close()
+        query_sock.close()
+        db.close()
+
+    def test_leveldb_options(self):
+        options, batch_size = LevelDBAggregator.get_leveldb_options(DEFAULT_PARAMS)
+        assert options['write_buffer_size'] == 128*10**4
+        assert batch_size == 100
+        bulk_params = dict(DEFAULT_PARAMS, leveldb_bulk_load=True)
+        options, batch_size = LevelDBAggregator.get_leveldb_options(bulk_params)
+        assert options['write_buffer_size'] == LevelDBAggregator.BULK_WRITE_BUFFER_SIZE
+        assert batch_size == LevelDBAggregator.BULK_BATCH_SIZE
+
+    def test_bulk_load_throughput(self):
+        """Compare the default options with the bulk load mode."""
+        scripts = synthetic_scripts(NUM_SCRIPTS)
+        num_bytes = sum(len(content) for content, _ in scripts)
+        results = list()
+        for name, manager_params in [
+                ('default', DEFAULT_PARAMS),
+                ('bulk load', dict(DEFAULT_PARAMS, leveldb_bulk_load=True))]:
+            db_path = join(self.tmpdir, name + '.ldb')
+            options, batch_size = LevelDBAggregator.get_leveldb_options(
+                manager_params)
+            start_time = time.time()
+            db = plyvel.DB(db_path, **options)
+            meta_db = plyvel.DB(db_path + '.meta', create_if_missing=True)
+            known_hashes = LevelDBAggregator.HashCache(db)
+            batch = db.write_batch()
+            meta_batch = meta_db.write_batch()
+            counter = 0
+            for content, content_hash in scripts:
+                counter = LevelDBAggregator.process_content(
+                    content, content_hash, batch, meta_batch, known_hashes,
+                    counter, None)
+                if counter >= batch_size:
+                    counter = 0
+                    LevelDBAggregator.write_batches(batch, meta_batch)
+            LevelDBAggregator.write_batches(batch, meta_batch)
+            if manager_params['leveldb_bulk_load']:
+                db.compact_range()
+            db.close()
+            meta_db.close()
+            elapsed = time.time() - start_time
+            results.append((name, num_bytes / 2.0**20 / elapsed,
+                            get_size(db_path) / 2.0**20))
+
+            db = plyvel.DB(db_path)
+            assert db.get(scripts[0][1]) == scripts[0][0].encode('utf-8')
+            db.close()
+        print "\n%i scripts, %.1f MB" % (NUM_SCRIPTS, num_bytes / 2.0**20)
+        for name, rate, size in results:
+            print "%-10s %6.1f MB/s, %6.1f MB on disk" % (name + ':', rate, size)
+
+
+class TestContentStore(OpenWPMTest):
+    """Check random access to the content saved by the LevelDBAggregator."""
+
+    def save_scripts(self, scripts):
+        db = plyvel.DB(join(self.tmpdir, 'javascript.ldb'),
+                       create_if_missing=True)
+        meta_db = plyvel.DB(join(self.tmpdir, 'javascript_meta.ldb'),
+                            create_if_missing=True)
+        known_hashes = LevelDBAggregator.HashCache(db)
+        batch = db.write_batch()
+        meta_batch = meta_db.write_batch()
+        for content, content_hash in scripts:
+            LevelDBAggregator.process_content(content, content_hash, batch,
+                                              meta_batch, known_hashes, 0, None)
+        LevelDBAggregator.write_batches(batch, meta_batch)
+        db.close()
+        meta_db.close()
+
+    def test_random_access(self):
+        start_time = time.time()
+        self.save_scripts([(u'var a = 1;', 'a1'), (u'caf\xe9', 12345),
+                           (u'var a = 1;', 'a1')])
+        with ContentStore(self.tmpdir) as store:
+            assert store.get('a1') == 'var a = 1;'
+            assert store.get(u'12345') == u'caf\xe9'.encode('utf-8')
+            assert store.get('missing') is None
+            assert store.exists(12345)
+            assert not store.exists('missing')
+            assert store.get_many(['12345', 'missing', 'a1', '12345']) == [
+                u'caf\xe9'.encode('utf-8'), None, 'var a = 1;',
+                u'caf\xe9'.encode('utf-8')]
+            assert store.get_many([]) == []
+
+            size, first_seen = store.get_metadata('12345')
+            assert size == 5  # bytes, not characters
+            assert start_time <= first_seen <= time.time()
+            assert store.get_metadata('missing') is None
+
+    def test_content_without_metadata(self):
+        """Content saved before the metadata side database existed."""
+        db = plyvel.DB(join(self.tmpdir, 'javascript.ldb'),
+                       create_if_missing=True)
+        db.put('1', 'script 1')
+        db.close()
+        with ContentStore(self.tmpdir) as store:
+            assert store.exists('1')
+            assert store.get_metadata('1') is None
+            assert store.get_many(['1']) == ['script 1']
@@ -0,0 +1,149 @@
+from os.path import join, dirname, realpath
+import sqlite3
+
+from ..automation.utilities import merge_shards
+from openwpmtest import OpenWPMTest
+
+AUTOMATION_DIR = join(dirname(dirname(realpath(__file__))), 'automation')
+EXTENSION_DATA_DIR = join(AUTOMATION_DIR, 'Extension', 'firefox', 'data')
+EXTENSION_SQL = [join(EXTENSION_DATA_DIR, 'create_%s_table.sql' % table)
+                 for table in ['http_requests', 'pages', 'content_policy']]
+
+
+class DummyLogger(object):
+    def __init__(self):
+        self.errors = list()
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+
+class TestMergeShards(OpenWPMTest):
+    """Check that per-browser shards merge into the crawl database."""
+
+    def create_db(self, path, extension_tables=False):
+        con = sqlite3.connect(path)
+        with open(join(AUTOMATION_DIR, 'schema.sql')) as f:
+            con.executescript(f.read())
+        if extension_tables:
+            for sql_file in EXTENSION_SQL:
+                with open(sql_file) as f:
+                    con.executescript(f.read())
+        return con
+
+    def insert_shard_rows(self, con, crawl_id, visit_ids):
+        for visit_id in visit_ids:
+            con.execute("INSERT INTO profile_cookies (crawl_id, visit_id, "
+                        "name, value) VALUES (?,?,?,?)",
+                        (crawl_id, visit_id, u'id', u'%i' % visit_id))
+            con.execute("INSERT INTO http_requests (crawl_id, visit_id, url, "
+                        "method, referrer, headers, content_policy_type, "
+                        "time_stamp) VALUES (?,?,?,?,?,?,?,?)",
+                        (crawl_id, visit_id, u'http://example.com/', u'GET',
+                         u'', u'[]', 6, u'2017-01-01T00:00:00.000Z'))
+        con.commit()
+        con.close()
+
+    def test_merge(self):
+        db = join(self.tmpdir, 'crawl-data.sqlite')
+        self.create_db(db).close()
+        shards = list()
+        for crawl_id, visit_ids in [(1, [1, 3, 4]), (2, [2, 5])]:
+            shard = merge_shards.get_shard_path(db, crawl_id)
+            con = self.create_db(shard, extension_tables=True)
+            self.insert_shard_rows(con, crawl_id, visit_ids)
+            shards.append(shard)
+
+        assert merge_shards.merge_shards(db, shards) == (10, shards)
+
+        con = sqlite3.connect(db)
+        for table in ['profile_cookies', 'http_requests']:
+            rows = con.execute("SELECT crawl_id, visit_id FROM %s "
+                               "ORDER BY visit_id" % table).fetchall()
+            assert rows == [(1, 1), (2, 2), (1, 3), (1, 4), (2, 5)]
+            ids = con.execute("SELECT id FROM %s" % table).fetchall()
+            assert len(set(ids)) == 5
+        con.close()
+
+    def test_merge_keys_and_conflicts(self):
+        db = join(self.tmpdir, 'crawl-data.sqlite')
+        self.create_db(db).close()
+        shards = list()
+        for crawl_id in [1, 2]:
+            shard = merge_shards.get_shard_path(db, crawl_id)
+            con = self.create_db(shard, extension_tables=True)
+            # page ids are inner window ids, which other rows refer to
+            window_id = crawl_id * 1000
+            con.execute("INSERT INTO pages (id, crawl_id, visit_id, location, "
+                        "parent_id) VALUES (?,?,?,?,?)",
+                        (window_id, crawl_id, crawl_id, u'http://a.com/', -1))
+            con.execute("INSERT INTO pages (id, crawl_id, visit_id, location, "
+                        "parent_id) VALUES (?,?,?,?,?)",
+                        (window_id + 1, crawl_id, crawl_id, u'http://b.com/',
+                         window_id))
+            con.execute("INSERT INTO content_policy (crawl_id, page_id, "
+                        "visit_id) VALUES (?,?,?)",
+                        (crawl_id, window_id + 1, crawl_id))
+            # both browsers store the same xpath, which is unique
+            con.execute("INSERT INTO xpath (name, url, xpath) VALUES (?,?,?)",
+                        (u'login', u'http://a.com/', u'//form'))
+            # a table without deduplication, which fails to merge twice
+            con.execute("CREATE TABLE ids (id INTEGER PRIMARY KEY, "
+                        "name TEXT UNIQUE)")
+            con.execute("INSERT INTO ids (name) VALUES ('same')")
+            con.commit()
+            con.close()
+            shards.append(shard)
+
+        logger = DummyLogger()
+        num_rows, merged = merge_shards.merge_shards(db, shards, logger=logger)
+        # the second shard is rolled back because of its conflicting table
+        assert merged == shards[:1]
+        assert num_rows == 5
+        assert 'ids' in logger.errors[0] and shards[1] in logger.errors[1]
+
+        con = sqlite3.connect(db)
+        assert con.execute("SELECT id, parent_id FROM pages ORDER BY id"
+                           ).fetchall() == [(1000, -1), (1001, 1000)]
+        assert con.execute("SELECT page_id FROM content_policy ORDER BY id"
+                           ).fetchall() == [(1001,)]
+        assert con.execute("SELECT COUNT(*) FROM xpath").fetchone()[0] == 1
+        assert con.execute("SELECT COUNT(*) FROM ids").fetchone()[0] == 1
+        con.close()
+
+    def test_merge_failed_shard_again(self):
+        db = join(self.tmpdir, 'crawl-data.sqlite')
+        self.create_db(db).close()
+        con = sqlite3.connect(db)
+        con.execute("CREATE TABLE b (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+        con.execute("INSERT INTO b (name) VALUES ('same')")
+        con.commit()
+        con.close()
+        shard = merge_shards.get_shard_path(db, 1)
+        con = sqlite3.connect(shard)
+        con.execute("CREATE TABLE a (id INTEGER PRIMARY KEY, name TEXT)")
+        con.executemany("INSERT INTO a (name) VALUES (?)", [('x',), ('y',)])
+        con.execute("CREATE TABLE b (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+        con.execute("INSERT INTO b (name) VALUES ('same')")
+        con.commit()
+        con.close()
+
+        # a kept shard leaves the canonical database unchanged, so merging
+        # it again does not duplicate the tables that did merge
+        for _ in xrange(2):
+            assert merge_shards.merge_shards(db, [shard], logger=DummyLogger()
+                                             ) == (0, [])
+        con = sqlite3.connect(db)
+        assert con.execute("SELECT name FROM sqlite_master WHERE name='a'"
+                           ).fetchall() == []
+        assert con.execute("SELECT COUNT(*) FROM b").fetchone()[0] == 1
+        con.close()
+
+        con = sqlite3.connect(db)
+        con.execute("DELETE FROM b")
+        con.commit()
+        con.close()
+        assert merge_shards.merge_shards(db, [shard]) == (3, [shard])
+        con = sqlite3.connect(db)
+        assert con.execute("SELECT COUNT(*) FROM a").fetchone()[0] == 2
+        con.close()
@@ -0,0 +1,87 @@
+from os.path import join, isfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlite3
+
+from ..automation.utilities import parquet_export
+from openwpmtest import OpenWPMTest
+
+
+class TestParquetExport(OpenWPMTest):
+    """Check the parquet export of crawl tables."""
+
+    def create_db(self):
+        db = join(self.tmpdir, 'crawl-data.sqlite')
+        con = sqlite3.connect(db)
+        for schema_file in parquet_export.SCHEMA_FILES:
+            with open(schema_file) as f:
+                con.executescript(f.read())
+        for visit_id, crawl_id in [(1, 1), (2, 2), (3, 1)]:
+            con.execute("INSERT INTO site_visits (visit_id, crawl_id, "
+                        "site_url) VALUES (?,?,?)",
+                        (visit_id, crawl_id, u'http://example.com/'))
+            for i in xrange(5):
+                con.execute("INSERT INTO http_requests (crawl_id, visit_id, "
+                            "url, method, referrer, headers, is_XHR, "
+                            "content_policy_type, time_stamp) "
+                            "VALUES (?,?,?,?,?,?,?,?,?)",
+                            (crawl_id, visit_id, u'http://tracker.com/%i' % i,
+                             u'GET', u'', u'[]', i % 2, 6,
+                             u'2017-01-01T00:00:00.000Z'))
+        con.commit()
+        con.close()
+        return db
+
+    def test_export(self):
+        db = self.create_db()
+        output_dir = join(self.tmpdir, 'parquet')
+        exported = parquet_export.export_crawl(db, output_dir, chunk_size=4)
+        assert exported['site_visits'] == 3
+        assert exported['http_requests'] == 15
+        assert exported['javascript'] == 0
+        assert 'http_responses' in exported
+
+        path = join(output_dir, 'http_requests', 'crawl_id=1',
+                    'http_requests.parquet')
+        assert isfile(path)
+        table = pq.read_table(path)
+        assert table.num_rows == 10
+        assert table.schema.field_by_name('visit_id').type == pa.int64()
+        assert table.schema.field_by_name('is_XHR').type == pa.bool_()
+        assert table.schema.field_by_name('url').type == pa.string()
+        assert table.column('visit_id').to_pylist() == [1] * 5 + [3] * 5
+        assert table.column('content_policy_type').to_pylist() == [6] * 10
+        # each partition holds the rows of its crawl only
+        table = pq.read_table(join(output_dir, 'http_requests', 'crawl_id=2',
+                                   'http_requests.parquet'))
+        assert table.column('crawl_id').to_pylist() == [2] * 5
+
+        # rows are chunked into row groups, urls are dictionary-encoded
+        metadata = pq.ParquetFile(path).metadata
+        assert metadata.num_row_groups == 3
+        names = [parquet_export.load_table_schemas()['http_requests'][i][0]
+                 for i in xrange(metadata.num_columns)]
+        url_column = metadata.row_group(0).column(names.index('url'))
+        assert any('DICTIONARY' in encoding
+                   for encoding in url_column.encodings)
+
+    def test_export_mistyped_values(self):
+        """Values sqlite stored despite the column type are exported as null."""
+        db = self.create_db()
+        con = sqlite3.connect(db)
+        for content_policy_type in [u'n/a', u'12', 1e30]:
+            con.execute("INSERT INTO http_requests (crawl_id, visit_id, url, "
+                        "method, referrer, headers, content_policy_type, "
+                        "time_stamp) VALUES (?,?,?,?,?,?,?,?)",
+                        (4, 4, u'http://example.com/', u'GET', u'', u'[]',
+                         content_policy_type, u'2017-01-01T00:00:00.000Z'))
+        con.commit()
+        con.close()
+        output_dir = join(self.tmpdir, 'parquet')
+        exported = parquet_export.export_crawl(db, output_dir)
+        assert exported['http_requests'] == 18
+
+        table = pq.read_table(join(output_dir, 'http_requests', 'crawl_id=4',
+                                   'http_requests.parquet'))
+        assert table.column('content_policy_type').to_pylist() == [
+            None, 12, None]
@@ -0,0 +1,330 @@
+from os.path import exists
+from multiprocess import Process, Queue
+import threading
+import resource
+import time
+
+from ..automation.SocketInterface import (serversocket, clientsocket,
+                                          get_unix_socket_path, RECV_SIZE,
+                                          SHUTDOWN_SIGNAL, is_shutdown_signal)
+from openwpmtest import OpenWPMTest
+
+NUM_MSGS = 20000
+LARGE_MSG_SIZE = 32 * 2 ** 20
+NUM_SENDERS = 50
+RESPONSE_ROW = (1, u'http://example.com/script.js', u'GET', u'', 200, 'OK',
+                '[["Content-Type", "text/javascript"]]', u'', 7,
+                '2017-01-01 00:00:00.000000', None)
+
+
+def send_rows(address, num_msgs):
+    """Sender process connecting to a server and sending <num_msgs> rows."""
+    client = clientsocket(serialization='marshal')
+    client.connect(*address)
+    for i in xrange(num_msgs):
+        client.send(('INSERT INTO http_responses_proxy VALUES '
+                     '(?,?,?,?,?,?,?,?,?,?,?)', RESPONSE_ROW))
+    client.close()
+
+
+def forward_msgs(unix_path, status_queue, msg_queue):
+    """Server process passing every message it queues on to <msg_queue>."""
+    server = serversocket(unix_path=unix_path)
+    server.start_accepting()
+    status_queue.put(server.get_addresses())
+    while True:
+        msg_queue.put(server.queue.get())
+
+
+def transfer_large_payloads(status_queue):
+    """
+    Process passing large messages from a client to a server. It reports
+    whether they arrived intact, the growth of its peak memory in KB and the
+    time taken, so that the peak is not one reached by an earlier test.
+    """
+    server = serversocket()
+    server.start_accepting()
+    client = clientsocket(serialization='marshal')
+    client.connect(*server.get_addresses()[0])
+    script = 'x' * LARGE_MSG_SIZE
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    intact = True
+    for i in xrange(5):
+        client.send((script, 'hash%i' % i))
+        client.send('small')
+        received = server.queue.get(True, 30)
+        intact = (intact and received == (script, 'hash%i' % i) and
+                  server.queue.get(True, 30) == 'small')
+        del received
+    elapsed = time.time() - start_time
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    client.close()
+    server.close()
+    status_queue.put((intact, growth, elapsed))
+
+
+class TestSocketInterface(OpenWPMTest):
+    """Check the serversocket / clientsocket message passing."""
+
+    def get_connected_pair(self, serialization='json', batch_size=0,
+                           flush_interval=None, **kwargs):
+        server = serversocket(**kwargs)
+        server.start_accepting()
+        client = clientsocket(serialization=serialization,
+                              batch_size=batch_size,
+                              flush_interval=flush_interval)
+        client.connect(*server.get_addresses()[0])
+        return server, client
+
+    def test_bounded_queue(self):
+        num_msgs = 100
+        server, client = self.get_connected_pair(max_queue_size=10)
+
+        def send_all():
+            for i in xrange(num_msgs):
+                client.send(('INSERT INTO t (a) VALUES (?)', (i,)))
+        sender = threading.Thread(target=send_all)
+        sender.daemon = True
+        sender.start()
+
+        # the connection thread stops reading once the queue is full
+        start_time = time.time()
+        while server.blocked_puts == 0 and time.time() - start_time < 10:
+            time.sleep(0.01)
+        assert server.queue.qsize() == 10
+        assert server.high_water_mark == 10
+
+        received = [server.queue.get(True, 10)[1][0] for _ in xrange(num_msgs)]
+        assert received == range(num_msgs)
+        assert 'high-water mark 10 (limit: 10)' in server.get_queue_stats()
+
+        sender.join()
+        client.close()
+        server.close()
+
+    def test_marshal_serialization(self):
+        server, client = self.get_connected_pair(serialization='marshal')
+        def function_msg(x): return x
+        client.send(('INSERT INTO t VALUES (?,?,?,?)', (1, 2.5, None, u'\xe4')))
+        client.send(['a', {'b': 1}])
+        client.send(function_msg)  # unmarshallable, falls back to dill
+        assert server.queue.get(True, 10) == (
+            'INSERT INTO t VALUES (?,?,?,?)', (1, 2.5, None, u'\xe4'))
+        assert server.queue.get(True, 10) == ['a', {'b': 1}]
+        assert server.queue.get(True, 10)(3) == 3
+        client.close()
+        server.close()
+
+    def test_serialization_throughput(self):
+        """Compare end-to-end message rates of the serialization types."""
+        query = ('INSERT INTO http_responses_proxy VALUES '
+                 '(?,?,?,?,?,?,?,?,?,?,?)', RESPONSE_ROW)
+        results = dict()
+        for serialization in ['dill', 'json', 'marshal', 'marshal batched']:
+            if serialization == 'marshal batched':
+                server, client = self.get_connected_pair('marshal',
+                                                         batch_size=65536)
+            else:
+                server, client = self.get_connected_pair(serialization)
+            start_time = time.time()
+            for _ in xrange(NUM_MSGS):
+                client.send(query)
+            client.flush()
+            for _ in xrange(NUM_MSGS):
+                server.queue.get(True, 10)
+            results[serialization] = NUM_MSGS / (time.time() - start_time)
+            client.close()
+            server.close()
+        print
+        for serialization in ['dill', 'json', 'marshal', 'marshal batched']:
+            print "%-16s %10.0f msgs/s" % (serialization + ':',
+                                         results[serialization])
+
+    def test_batching(self):
+        server, client = self.get_connected_pair('marshal', batch_size=1000)
+        client.send(('INSERT INTO t (a) VALUES (?)', (0,)))
+        time.sleep(0.1)
+        assert server.queue.qsize() == 0  # still buffered
+
+        # flushed once batch_size bytes are buffered
+        for i in xrange(1, 100):
+            client.send(('INSERT INTO t (a) VALUES (?)', (i,)))
+        first = server.queue.get(True, 10)
+        assert first[1] == (0,)
+        assert client._buffered < 1000
+
+        # big frames are read across several recvs, and close() flushes
+        big_msg = 'x' * (3 * RECV_SIZE + 7)
+        client.send(big_msg)
+        client.send('last')
+        client.close()
+        received = [server.queue.get(True, 10) for _ in xrange(101)]
+        assert [msg[1][0] for msg in received[:99]] == range(1, 100)
+        assert received[99] == big_msg
+        assert received[100] == 'last'
+        server.close()
+
+    def test_flush_interval(self):
+        server, client = self.get_connected_pair('marshal', batch_size=10**6,
+                                                 flush_interval=0.1)
+        client.send(('INSERT INTO t (a) VALUES (?)', (1,)))
+        assert server.queue.get(True, 10) == ('INSERT INTO t (a) VALUES (?)', (1,))
+        client.close()
+        server.close()
+
+    def test_unix_socket(self):
+        unix_path = get_unix_socket_path(self.tmpdir, 'test')
+        server, client = self.get_connected_pair('marshal', unix_path=unix_path)
+        address, tcp_address = server.get_addresses()
+        assert address == (unix_path, None)
+        client.send(('INSERT INTO t (a) VALUES (?)', (1,)))
+        assert server.queue.get(True, 10)[1] == (1,)
+
+        # the tcp socket stays available for the extension
+        tcp_client = clientsocket()
+        tcp_client.connect(*tcp_address)
+        tcp_client.send(['tcp'])
+        assert server.queue.get(True, 10) == ['tcp']
+        tcp_client.close()
+        client.close()
+        server.close()
+        assert not exists(unix_path)
+
+    def test_large_payloads(self):
+        """Multi-MB messages are received without repeated copies."""
+        status_queue = Queue()
+        process = Process(target=transfer_large_payloads, args=(status_queue,))
+        process.start()
+        intact, growth, elapsed = status_queue.get(True, 120)
+        process.join()
+        assert intact
+
+        # the client holds the script and its frame, the server its receive
+        # buffer and the message (ru_maxrss is in KB)
+        print "\n%.0f MB/s, peak memory grew by %.1f MB" % (
+            5 * LARGE_MSG_SIZE / 2 ** 20 / elapsed, growth / 1024.0)
+        assert 0 < growth * 1024 < 5 * LARGE_MSG_SIZE
+
+    def test_event_loop(self):
+        server, client = self.get_connected_pair('marshal', event_loop=True)
+        num_threads = threading.active_count()
+        other_client = clientsocket(serialization='marshal')
+        other_client.connect(*server.get_addresses()[0])
+        client.send(('INSERT INTO t (a) VALUES (?)', (1,)))
+        other_client.send('x' * (3 * RECV_SIZE))
+        received = [server.queue.get(True, 10) for _ in xrange(2)]
+        assert ('INSERT INTO t (a) VALUES (?)', (1,)) in received
+        assert 'x' * (3 * RECV_SIZE) in received
+        assert threading.active_count() == num_threads  # no connection threads
+        other_client.close()
+
+        # accepted connections are served until they close
+        server.close()
+        client.send(SHUTDOWN_SIGNAL)
+        assert is_shutdown_signal(server.queue.get(True, 10))
+        client.close()
+
+    def test_concurrent_senders_throughput(self):
+        """Compare thread-per-connection and event loop with 50 senders."""
+        num_msgs = 2000
+        results = dict()
+        for event_loop in [False, True]:
+            server = serversocket(event_loop=event_loop)
+            server.start_accepting()
+            senders = [Process(target=send_rows,
+                               args=(server.get_addresses()[0], num_msgs))
+                       for _ in xrange(NUM_SENDERS)]
+            start_time = time.time()
+            for sender in senders:
+                sender.start()
+            for _ in xrange(NUM_SENDERS * num_msgs):
+                server.queue.get(True, 30)
+            results[event_loop] = NUM_SENDERS * num_msgs / (time.time() - start_time)
+            for sender in senders:
+                sender.join()
+            server.close()
+        print "\nthread per connection: %10.0f msgs/s" % results[False]
+        print "event loop:            %10.0f msgs/s" % results[True]
+
+    def test_reconnect(self):
+        server = serversocket()
+        server.start_accepting()
+        client = clientsocket(serialization='marshal', batch_size=1000,
+                              reconnect=True)
+        client.connect(*server.get_addresses()[0])
+        client.send(['first'])
+        client.flush()
+        assert server.queue.get(True, 10) == ['first']
+
+        client.sock.close()  # the connection breaks
+        client.send(['second'])
+        client.flush()
+        assert server.queue.get(True, 10) == ['second']
+        client.close()
+        server.close()
+
+    def test_reconnect_resends_batch_once(self):
+        """A batch resent after its acknowledgement was lost is queued once."""
+        server = serversocket()
+        server.start_accepting()
+        client = clientsocket(serialization='marshal', batch_size=1000,
+                              reconnect=True)
+        client.connect(*server.get_addresses()[0])
+        send_batch = client._send_batch
+
+        def lose_first_ack(batch):
+            client._send_batch = send_batch
+            client._send_all(batch)
+            raise RuntimeError("socket connection broken")
+        client._send_batch = lose_first_ack
+        for i in xrange(3):
+            client.send(['row', i])
+        client.flush()
+        client.send(['row', 3])
+        client.close()
+        received = [server.queue.get(True, 10) for _ in xrange(4)]
+        assert received == [['row', i] for i in xrange(4)]
+        time.sleep(0.1)
+        assert server.queue.empty()
+        server.close()
+
+    def test_reconnect_server_restart(self):
+        unix_path = get_unix_socket_path(self.tmpdir, 'restart')
+        status_queue = Queue()
+        first_msgs = Queue()
+        first_server = Process(target=forward_msgs,
+                               args=(unix_path, status_queue, first_msgs))
+        first_server.daemon = True
+        first_server.start()
+        address = status_queue.get(True, 10)[0]
+        client = clientsocket(serialization='marshal', batch_size=1000,
+                              reconnect=True)
+        client.connect(*address)
+        for i in xrange(3):
+            client.send(['row', i])
+        client.flush()  # returns once the server has queued the batch
+        assert [first_msgs.get(True, 10) for _ in xrange(3)] == [
+            ['row', i] for i in xrange(3)]
+        first_server.terminate()
+        first_server.join()
+
+        # a new server at the same address receives only the next batch
+        second_server = serversocket(unix_path=unix_path)
+        second_server.start_accepting()
+        for i in xrange(3, 6):
+            client.send(['row', i])
+        client.close()
+        assert [second_server.queue.get(True, 10) for _ in xrange(3)] == [
+            ['row', i] for i in xrange(3, 6)]
+        assert second_server.queue.empty()
+        second_server.close()
+
+    def test_request(self):
+        server, client = self.get_connected_pair(
+            'marshal', handler=lambda msg: str(len(msg)))
+        assert client.request('abc') == '3'
+        assert client.request(['a', 'b']) == '2'
+        assert server.queue.qsize() == 0
+        client.close()
+        server.close()
@@ -0,0 +1,74 @@
+from os.path import join, dirname, realpath
+import sqlite3
+import time
+
+from ..automation.utilities import db_utils
+from openwpmtest import OpenWPMTest
+
+HTTP_REQUESTS_SQL = join(dirname(dirname(realpath(__file__))), 'automation',
+                         'Extension', 'firefox', 'data',
+                         'create_http_requests_table.sql')
+NUM_ROWS = 50000
+COMMIT_BATCH_SIZE = 1000
+
+
+def synthetic_http_request(i):
+    """Return a synthetic row for the `http_requests` table."""
+    url = u'http://tracker%i.example.com/pixel.gif?id=%i' % (i % 97, i)
+    return (1, i / 50, url, u'http://example.com/', u'GET',
+            u'http://example.com/', u'[["Accept","*/*"]]', 0, 0, 0, 1, 1,
+            u'http://example.com', u'http://example.com',
+            u'http://example.com/', u'', 3, None,
+            u'2017-01-01T00:00:00.000Z')
+
+
+class TestSqliteProfile(OpenWPMTest):
+    """Check the `sqlite_profile` presets and report insert throughput."""
+
+    def connect(self, profile):
+        con = sqlite3.connect(join(self.tmpdir, profile + '.sqlite'))
+        db_utils.apply_sqlite_profile(con, profile)
+        with open(HTTP_REQUESTS_SQL) as f:
+            con.executescript(f.read())
+        return con
+
+    def test_profile_pragmas_applied(self):
+        for profile in db_utils.SQLITE_PROFILES:
+            con = self.connect(profile)
+            journal_mode = con.execute("PRAGMA journal_mode").fetchone()[0]
+            expected = dict(db_utils.SQLITE_PROFILES[profile])
+            assert journal_mode.upper() == expected['journal_mode']
+            con.close()
+
+    def test_unsupported_profile(self):
+        con = sqlite3.connect(':memory:')
+        try:
+            db_utils.apply_sqlite_profile(con, 'unknown')
+            assert False, "Unsupported profile did not raise"
+        except ValueError:
+            pass
+        con.close()
+
+    def test_insert_throughput(self):
+        """Insert synthetic `http_requests` rows under each preset."""
+        statement = ("INSERT INTO http_requests (crawl_id, visit_id, url, "
+                     "top_level_url, method, referrer, headers, is_XHR, "
+                     "is_frame_load, is_full_page, is_third_party_channel, "
+                     "is_third_party_window, triggering_origin, "
+                     "loading_origin, loading_href, req_call_stack, "
+                     "content_policy_type, post_body, time_stamp) "
+                     "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)")
+        rows = [synthetic_http_request(i) for i in xrange(NUM_ROWS)]
+        for profile in sorted(db_utils.SQLITE_PROFILES):
+            con = self.connect(profile)
+            start_time = time.time()
+            for i in xrange(0, NUM_ROWS, COMMIT_BATCH_SIZE):
+                con.executemany(statement, rows[i:i + COMMIT_BATCH_SIZE])
+                con.commit()
+            elapsed = time.time() - start_time
+            print "sqlite_profile %-8s: %8.0f rows/s" % (
+                profile, NUM_ROWS / elapsed)
+            count = con.execute(
+                "SELECT COUNT(*) FROM http_requests").fetchone()[0]
+            assert count == NUM_ROWS
+            con.close()
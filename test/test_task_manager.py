@@ -0,0 +1,363 @@
+from Queue import Queue
+import threading
+import pytest
+import logging
+import random
+import sqlite3
+import time
+
+from ..automation import TaskManager
+from ..automation.Errors import CommandExecutionError
+from ..automation.BrowserManager import Browser
+from ..automation.CommandSequence import CommandSequence
+
+NUM_BROWSERS = 20
+NUM_VISITS = 400
+NUM_EMPTY_VISITS = 20000
+SUBMIT_QUEUE_SIZE = 5
+POLL_INTERVAL = 0.1  # sleep between passes of the former polling dispatch
+
+
+class DummySocket(object):
+    def __init__(self):
+        self.sent = list()
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def close(self):
+        pass
+
+
+class SimulatedBrowser(Browser):
+    """A Browser without a BrowserManager process."""
+    def __init__(self, crawl_id):
+        self.crawl_id = crawl_id
+        self.command_thread = None
+        self.work_queue = None
+        self.num_pending = 0
+        self.current_timeout = None
+        self.visits = list()
+
+    def shutdown_browser(self, during_init):
+        pass
+
+
+class SimulatedTaskManager(TaskManager.TaskManager):
+    """A TaskManager without child processes."""
+    def __init__(self, num_browsers):
+        self.manager_params = {'submit_queue_size': SUBMIT_QUEUE_SIZE,
+                               'build_indexes': False}
+        self.closing = False
+        self.failure_status = None
+        self.threadlock = threading.Lock()
+        self.browser_freed = threading.Condition()
+        self.logger = logging.getLogger('test_task_manager')
+        self.sock = DummySocket()
+        self.db = sqlite3.connect(':memory:')
+        self.next_visit_id = 1
+        self.browsers = [SimulatedBrowser(crawl_id)
+                         for crawl_id in xrange(1, num_browsers + 1)]
+        self._start_command_threads()
+
+    def _kill_aggregators(self):
+        pass
+
+    def _kill_loggingserver(self):
+        pass
+
+
+def get_manager(num_browsers, visit_durations):
+    """
+    Returns a TaskManager without child processes whose browsers simulate
+    each visit by sleeping for the next of <visit_durations>
+    """
+    manager = SimulatedTaskManager(num_browsers)
+    durations = iter(visit_durations)
+    lock = threading.Lock()
+
+    def issue_command(browser, command_sequence, start_barrier=None):
+        if start_barrier is not None:
+            start_barrier.wait()
+        with lock:
+            duration = next(durations)
+        if duration:
+            time.sleep(duration)
+        browser.visits.append(command_sequence.url)
+        return True
+    manager._issue_command = issue_command
+    return manager
+
+
+def polling_distribute(manager, command_sequence):
+    """The polling loop _distribute_command used for index=None."""
+    while True:
+        for browser in manager.browsers:
+            if browser.ready():
+                manager._queue_command(browser, command_sequence)
+                return
+        time.sleep(POLL_INTERVAL)
+
+
+def thread_per_sequence_distribute(manager, command_sequence):
+    """The former dispatch, which started a thread per command sequence."""
+    browser = manager._claim_ready_browser(manager.browsers)
+
+    def run():
+        try:
+            manager._start_visit(browser, command_sequence)
+            manager._issue_command(browser, command_sequence)
+        finally:
+            with manager.browser_freed:
+                browser.num_pending -= 1
+                manager.browser_freed.notifyAll()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
+def join_all(manager):
+    """Waits until the browsers have run all queued command sequences."""
+    with manager.browser_freed:
+        while not all(browser.ready() for browser in manager.browsers):
+            manager.browser_freed.wait()
+
+
+class TestDistributeCommand(object):
+    """Check the dispatch of command sequences to free browsers."""
+
+    def test_index_types(self):
+        manager = get_manager(3, [0.01] * 100)
+        for i in xrange(9):
+            manager.execute_command_sequence(
+                CommandSequence('http://example.com/%i' % i))
+        manager.execute_command_sequence(
+            CommandSequence('http://example.com/one'), index=1)
+        manager.execute_command_sequence(
+            CommandSequence('http://example.com/all'), index='*')
+        manager.execute_command_sequence(
+            CommandSequence('http://example.com/sync'), index='**')
+        manager.execute_command_sequence(
+            CommandSequence('http://example.com/last', blocking=True), index=2)
+        join_all(manager)
+
+        assert sum(len(browser.visits) for browser in manager.browsers) == 17
+        assert 'http://example.com/one' in manager.browsers[1].visits
+        assert manager.browsers[2].visits[-1] == 'http://example.com/last'
+        for browser in manager.browsers:
+            assert 'http://example.com/all' in browser.visits
+            assert 'http://example.com/sync' in browser.visits
+            assert browser.ready()
+        assert manager.next_visit_id == 18
+        assert manager.get_backlog() == {1: 0, 2: 0, 3: 0}
+
+    def test_backlog(self):
+        manager = get_manager(2, [0.05] * 10)
+        for i in xrange(5):
+            manager.execute_command_sequence(
+                CommandSequence('http://example.com/%i' % i), index=0)
+        # sequences for a specific browser are queued without waiting
+        assert manager.get_backlog() == {1: 5, 2: 0}
+        manager.execute_command_sequence(CommandSequence('http://example.com/'))
+        assert manager.browsers[1].num_pending == 1  # the free browser
+        join_all(manager)
+        assert manager.browsers[0].visits == [
+            'http://example.com/%i' % i for i in xrange(5)]
+        assert manager.get_backlog() == {1: 0, 2: 0}
+
+    def test_sync_start_failure(self):
+        """A synchronized sequence runs on the other browsers if one fails."""
+        manager = get_manager(3, [0] * 10)
+        start_visit = manager._start_visit
+
+        def failing_start_visit(browser, command_sequence):
+            if browser.crawl_id == 2:
+                raise RuntimeError("could not record the visit")
+            return start_visit(browser, command_sequence)
+        manager._start_visit = failing_start_visit
+        manager.execute_command_sequence(
+            CommandSequence('http://example.com/sync'), index='**')
+
+        thread = threading.Thread(target=join_all, args=(manager,))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive()
+        assert [len(browser.visits) for browser in manager.browsers] == [1, 0, 1]
+
+    def test_concurrent_dispatch(self):
+        """Concurrent first come, first serve calls claim distinct browsers."""
+        manager = get_manager(NUM_BROWSERS, [0.5] * NUM_BROWSERS)
+        threads = [threading.Thread(
+            target=manager.execute_command_sequence,
+            args=(CommandSequence('http://example.com/%i' % i),))
+            for i in xrange(NUM_BROWSERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert manager.get_backlog() == dict(
+            (crawl_id, 1) for crawl_id in xrange(1, NUM_BROWSERS + 1))
+        join_all(manager)
+        assert all(len(browser.visits) == 1 for browser in manager.browsers)
+
+    def test_dispatch_throughput(self):
+        """Compare polling with event-driven dispatch on short visits."""
+        random.seed(0)
+        durations = [random.uniform(0.05, 0.5) for _ in xrange(NUM_VISITS)]
+        results = list()
+        for name, distribute in [
+                ('polling', polling_distribute),
+                ('event-driven', lambda manager, command_sequence:
+                 manager._distribute_command(command_sequence))]:
+            manager = get_manager(NUM_BROWSERS, durations)
+            start_time = time.time()
+            for i in xrange(NUM_VISITS):
+                distribute(manager, CommandSequence('http://localhost/%i' % i))
+            join_all(manager)
+            elapsed = time.time() - start_time
+            assert sum(len(b.visits) for b in manager.browsers) == NUM_VISITS
+            results.append((name, NUM_VISITS * 3600 / elapsed))
+        print "\n%i browsers, %i visits of %.2fs on average" % (
+            NUM_BROWSERS, NUM_VISITS, sum(durations) / NUM_VISITS)
+        for name, rate in results:
+            print "%-14s %9.0f visits/hour" % (name + ':', rate)
+
+    def test_submit_many(self):
+        manager = get_manager(3, [1] * 3 + [0] * 47)
+        consumed = list()
+
+        def command_sequences():
+            for i in xrange(50):
+                consumed.append(i)
+                yield CommandSequence('http://example.com/%i' % i)
+        futures = manager.submit_many(command_sequences())
+        # while the browsers run their first sequence, the generator is read
+        # ahead by no more than the submit queue, the sequence waiting for a
+        # free browser and the one waiting for room in the queue
+        deadline = time.time() + 10
+        while len(consumed) < 3 + SUBMIT_QUEUE_SIZE and time.time() < deadline:
+            time.sleep(0.01)
+        assert 3 + SUBMIT_QUEUE_SIZE <= len(consumed) <= 3 + SUBMIT_QUEUE_SIZE + 2
+
+        futures = list(futures)
+        assert [future.command_sequence.url for future in futures] == [
+            'http://example.com/%i' % i for i in xrange(50)]
+        assert all(future.result(10) for future in futures)
+        assert len(set(future.visit_id for future in futures)) == 50
+        assert sum(len(browser.visits) for browser in manager.browsers) == 50
+
+    def test_submit_many_error(self):
+        manager = get_manager(2, [0] * 10)
+
+        def command_sequences():
+            yield CommandSequence('http://example.com/')
+            raise ValueError("bad site list")
+        futures = manager.submit_many(command_sequences())
+        future = next(futures)
+        assert future.result(10)
+        with pytest.raises(ValueError):
+            next(futures)
+
+    def test_submit_many_closed(self):
+        manager = get_manager(1, [])
+        manager.closing = True
+        futures = manager.submit_many(
+            CommandSequence('http://example.com/%i' % i) for i in xrange(5))
+        assert list(futures) == []
+
+    def test_close_after_failure(self):
+        """close() raises the failure of a sequence passed to submit_many."""
+        manager = get_manager(2, [0] * 50)
+        issue_command = manager._issue_command
+
+        def failing_issue_command(browser, command_sequence, start_barrier=None):
+            if command_sequence.url == 'http://example.com/5':
+                manager.failure_status = {
+                    'ErrorType': 'ExceedCommandFailureLimit',
+                    'CommandSequence': command_sequence
+                }
+                return False
+            return issue_command(browser, command_sequence, start_barrier)
+        manager._issue_command = failing_issue_command
+        futures = manager.submit_many(
+            CommandSequence('http://example.com/%i' % i) for i in xrange(50))
+        with pytest.raises(CommandExecutionError):
+            manager.close()
+        futures = list(futures)
+        assert all(future.done() for future in futures)
+        assert not all(future.result() for future in futures)
+        finished = [args for query, args in manager.sock.sent
+                    if query.startswith("UPDATE crawl SET finished")]
+        assert len(finished) == 2
+        assert all("finished = -1" in query for query, args in manager.sock.sent
+                   if query.startswith("UPDATE crawl SET finished"))
+
+    def test_fail_during_submit_many(self):
+        """A failure shutdown resolves every future of a blocked feeder."""
+        manager = get_manager(2, [0.2] * 100)
+        consumed = list()
+
+        def command_sequences():
+            for i in xrange(100):
+                consumed.append(i)
+                yield CommandSequence('http://example.com/%i' % i)
+        futures = manager.submit_many(command_sequences())
+        # the feeder is blocked on the full submit queue
+        deadline = time.time() + 10
+        while len(consumed) < 2 + SUBMIT_QUEUE_SIZE and time.time() < deadline:
+            time.sleep(0.01)
+        manager.failure_status = {
+            'ErrorType': 'ExceedCommandFailureLimit',
+            'CommandSequence': None
+        }
+        manager._cleanup_before_fail()
+
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.extend(f.result() for f in futures))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive()
+        # the feeder reads the sequence after its last put before stopping
+        assert len(results) in (len(consumed) - 1, len(consumed))
+        assert not all(results)
+
+    def test_command_thread_overhead(self):
+        """Compare a thread per sequence with long-lived command threads."""
+        results = list()
+        for name, distribute in [
+                ('thread per sequence', thread_per_sequence_distribute),
+                ('command threads', lambda manager, command_sequence:
+                 manager._distribute_command(command_sequence))]:
+            manager = get_manager(NUM_BROWSERS, [0] * NUM_EMPTY_VISITS)
+            start_time = time.time()
+            for i in xrange(NUM_EMPTY_VISITS):
+                distribute(manager, CommandSequence('http://localhost/%i' % i))
+            join_all(manager)
+            elapsed = time.time() - start_time
+            assert sum(len(b.visits) for b in manager.browsers) == NUM_EMPTY_VISITS
+            results.append((name, NUM_EMPTY_VISITS / elapsed))
+        print "\n%i browsers, %i empty command sequences" % (
+            NUM_BROWSERS, NUM_EMPTY_VISITS)
+        for name, rate in results:
+            print "%-20s %9.0f sequences/s" % (name + ':', rate)
+
+    def test_drain_visit(self):
+        manager = SimulatedTaskManager(1)
+        browser = manager.browsers[0]
+        browser.curr_visit_id = 7
+        browser.command_queue = Queue()
+        browser.status_queue = Queue()
+        browser.restart_required = False
+
+        browser.status_queue.put("OK")
+        manager._drain_visit(browser)
+        assert browser.command_queue.get_nowait() == ('DRAIN', 7)
+        assert not browser.restart_required
+
+        # a BrowserManager that fails to drain is restarted
+        browser.status_queue.put(('FAILED', None))
+        manager._drain_visit(browser)
+        assert browser.restart_required